@@ -0,0 +1,298 @@
+import math
+import random
+from array import array
+from bisect import bisect_right
+from statistics import NormalDist
+from typing import Dict, Iterator, Tuple
+
+# helper files
+import pseudoreads
+import get_kmer_hit_counts
+import classification_output
+import progress
+
+"""
+abundance_estimation.py
+
+Estimates what percentage of a query's pseudoreads are classified as each contaminant from a
+subsample of them, for routine QC that needs the percentages rather than a call for every read.
+
+The query is read through once to count its bases and note where in the file every
+INDEX_INTERVAL-th of them is, without keeping the sequence. Its pseudoreads (the same ones as in
+pseudoreads.py) are then classified in a fixed order picked from the seed, in rounds: first
+INITIAL_SAMPLE_SIZE of them, and then twice as many as before every round, until the confidence interval of every estimate
+(the percentage of pseudoreads classified, and the percentage of the classified ones classified
+as each taxon) is at most the target width, or every pseudoread has been classified. A sample
+grown this way is the same as one drawn at its final size, so the rounds cost nothing extra.
+The pseudoreads of a round are read from the file in the order they are in it, each from the
+closest noted position before it, so memory stays bounded however long the query is (and a
+gzip compressed query is decompressed at most once a round).
+
+There are two ways to order the pseudoreads:
+
+  - stratified (the default): the first 2^m pseudoreads of the order are one from each of 2^m
+    equal stretches of the query (at the same, random, offset in all of them), so that a sample
+    of any size covers the whole query evenly and a contaminant confined to one stretch of it
+    (e.g. the phiX174 in covid-contaminated-with-phiX174.txt) is neither over- nor undersampled
+  - random: a simple random sample, without replacement
+
+The intervals are Wilson score intervals, narrowed by the finite population correction, so an
+estimate from every pseudoread has no width at all. For the stratified order they are those of a
+simple random sample, which are conservative unless the contaminants recur at regular intervals
+along the query.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# How the pseudoreads can be ordered for sampling (see the top of this file)
+SAMPLING_METHODS = ["stratified", "random"]
+
+# Number of pseudoreads classified in the first round
+INITIAL_SAMPLE_SIZE = 1024
+
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_SEED = 0
+
+# Every how many bases of the query its position in the file is noted
+INDEX_INTERVAL = 4096
+
+def radical_inverse(i : int) -> float:
+  """
+  The base 2 radical inverse of i (its binary digits mirrored around the point), the i-th point
+  of the van der Corput sequence, whose first 2^m points are one in each of 2^m equal intervals of [0, 1).
+  """
+  inverse = 0.0
+  weight = 0.5
+  while i:
+    if i & 1:
+      inverse += weight
+    i >>= 1
+    weight /= 2
+  return inverse
+
+def sample_order(num_reads : int, seed : int = DEFAULT_SEED, sampling : str = "stratified") -> Iterator[int]:
+  """
+  Yield the numbers (from 0) of all num_reads pseudoreads once each, in the order they are sampled in.
+  """
+  rng = random.Random(seed)
+  sampled = set()
+  if sampling == "stratified":
+    offset = rng.random()
+    # once 2^m is at least num_reads, every pseudoread has been yielded
+    for i in range(2 * num_reads):
+      read_number = int((radical_inverse(i) + offset) % 1.0 * num_reads)
+      if read_number not in sampled:
+        sampled.add(read_number)
+        yield read_number
+  else:
+    # drawing at random until half of them are sampled, and shuffling the rest
+    while 2 * len(sampled) < num_reads:
+      read_number = rng.randrange(num_reads)
+      if read_number not in sampled:
+        sampled.add(read_number)
+        yield read_number
+  remaining = [read_number for read_number in range(num_reads) if read_number not in sampled]
+  rng.shuffle(remaining)
+  yield from remaining
+
+def wilson_interval(count : int, n : int, population : int, z : float) -> Tuple[float, float]:
+  """
+  The Wilson score interval of the proportion count / n, where the n were sampled without
+  replacement out of a population of that size.
+  """
+  if n == 0:
+    return 0.0, 1.0
+  p = count / n
+  # the finite population correction, as a larger effective sample size
+  correction = (population - n) / (population - 1) if population > 1 else 0.0
+  if correction <= 0:
+    return p, p
+  n = n / correction
+  denominator = 1 + z * z / n
+  center = (p + z * z / (2 * n)) / denominator
+  half_width = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+  return max(0.0, center - half_width), min(1.0, center + half_width)
+
+class AbundanceEstimate:
+  """
+  The estimated percentages of a query's pseudoreads classified, and classified as each taxon,
+  with their confidence intervals, from the summary of the pseudoreads sampled.
+  """
+  def __init__(
+      self,
+      summary : classification_output.ClassificationSummary,
+      num_reads : int,
+      sampling : str,
+      seed : int,
+      confidence : float,
+      num_rounds : int = 0):
+    self.summary = summary
+    self.num_reads = num_reads
+    self.sampling = sampling
+    self.seed = seed
+    self.confidence = confidence
+    self.num_rounds = num_rounds
+
+  def intervals(self) -> Tuple[Tuple[float, float, float], Dict[str, Tuple[float, float, float]]]:
+    """
+    @return: the (estimate, low, high) fraction of the pseudoreads classified, and of the
+             classified ones classified as each taxonomy id, by how many were sampled
+    """
+    z = NormalDist().inv_cdf((1 + self.confidence) / 2)
+    summary = self.summary
+    classified = (
+      summary.num_reads_classified / max(1, summary.num_reads),
+      *wilson_interval(summary.num_reads_classified, summary.num_reads, self.num_reads, z)
+    )
+    # the classified pseudoreads sampled are a sample of the classified pseudoreads, at the same rate
+    num_classified = round(classified[0] * self.num_reads)
+    taxa = {}
+    for taxonomy_id, count in sorted(summary.read_counts.items(), key=lambda item: -item[1]):
+      taxa[taxonomy_id] = (
+        count / summary.num_reads_classified,
+        *wilson_interval(count, summary.num_reads_classified, num_classified, z)
+      )
+    return classified, taxa
+
+  def max_width(self) -> float:
+    """
+    The width of the widest of the intervals, as a fraction.
+    """
+    classified, taxa = self.intervals()
+    return max(high - low for _, low, high in [classified, *taxa.values()])
+
+  def to_dict(self) -> Dict[str, object]:
+    """
+    The estimate as a JSON serializable dictionary (see result_cache.py).
+    """
+    return {
+      "summary": self.summary.to_dict(),
+      "num_reads": self.num_reads,
+      "sampling": self.sampling,
+      "seed": self.seed,
+      "confidence": self.confidence,
+      "num_rounds": self.num_rounds,
+    }
+
+  @classmethod
+  def from_dict(cls, values : Dict[str, object]) -> "AbundanceEstimate":
+    return cls(
+      classification_output.ClassificationSummary.from_dict(values["summary"]),
+      values["num_reads"],
+      values["sampling"],
+      values["seed"],
+      values["confidence"],
+      values["num_rounds"],
+    )
+
+class QueryReader:
+  """
+  Reads pseudoreads at any position of a query FASTA file (gzip compressed if it ends in .gz)
+  without holding its sequence, from the file offsets of every interval-th base.
+  """
+  def __init__(self, query_filename : str, interval : int = INDEX_INTERVAL):
+    # the first base of the line that every interval-th base is on, and where that line is in the file
+    self.positions = array('Q')
+    self.offsets = array('Q')
+    self.num_bases = 0
+    with pseudoreads.open_fasta_file(query_filename, binary=True) as fp:
+      offset = 0
+      for line in fp:
+        if not line.startswith(b'>'):
+          if self.num_bases >= len(self.positions) * interval:
+            self.positions.append(self.num_bases)
+            self.offsets.append(offset)
+          self.num_bases += len(line.strip())
+        offset += len(line)
+    self.fp = pseudoreads.open_fasta_file(query_filename, binary=True)
+    # the last line read, and the position of its first base
+    self.line = b""
+    self.line_start = -1
+
+  def read(self, start : int, length : int) -> str:
+    """
+    The length bases of the query's sequence (as in pseudoreads.read_fasta_file) from start on.
+    Reading forwards from the last line read, rather than seeking, whenever that is no further back.
+    """
+    entry = bisect_right(self.positions, start) - 1
+    if not self.positions[entry] <= self.line_start <= start:
+      self.fp.seek(self.offsets[entry])
+      self.line = b""
+      self.line_start = self.positions[entry]
+    end = start + length
+    parts = [self.line[max(0, start - self.line_start):end - self.line_start]]
+    while self.line_start + len(self.line) < end:
+      line = self.fp.readline()
+      if not line:
+        break
+      if line.startswith(b'>'):
+        continue
+      self.line_start += len(self.line)
+      self.line = line.strip()
+      parts.append(self.line[max(0, start - self.line_start):end - self.line_start])
+    return b"".join(parts).decode()
+
+  def close(self) -> None:
+    self.fp.close()
+
+  def __enter__(self) -> "QueryReader":
+    return self
+
+  def __exit__(self, *exc_info) -> None:
+    self.close()
+
+def estimate_abundances(
+    query_filename : str,
+    kmer_to_lca,
+    k : int,
+    target_width : float,
+    seed : int = DEFAULT_SEED,
+    sampling : str = "stratified",
+    confidence : float = DEFAULT_CONFIDENCE,
+    initial_sample_size : int = INITIAL_SAMPLE_SIZE,
+    host_filter = None) -> AbundanceEstimate:
+  """
+  Classify a growing sample of the pseudoreads of query_filename against kmer_to_lca
+  (see the top of this file) until every interval is at most target_width wide.
+
+  @param target_width: the widest an interval may be, in percentage points
+  @param host_filter: if given, the host_depletion.HostFilter that the sampled pseudoreads
+    are depleted by before they are classified (they count as sampled, but not classified)
+  """
+  read_length = pseudoreads.READ_LENGTH
+  step_size = read_length - pseudoreads.READ_OVERLAP
+  with QueryReader(query_filename) as query:
+    num_reads = (query.num_bases - read_length) // step_size + 1 if query.num_bases >= read_length else 0
+
+    summary = classification_output.ClassificationSummary()
+    estimate = AbundanceEstimate(summary, num_reads, sampling, seed, confidence)
+    order = sample_order(num_reads, seed, sampling)
+    sample_size = min(num_reads, max(1, initial_sample_size))
+    with progress.task("estimate", unit="reads", total=num_reads) as estimate_progress:
+      while summary.num_reads < num_reads:
+        num_kmers = 0
+        # in file order, so the query is read forwards (the summary doesn't depend on the order)
+        for read_number in sorted(next(order) for _ in range(sample_size - summary.num_reads)):
+          pseudoread = query.read(read_number * step_size, read_length)
+          if host_filter is not None and host_filter.is_host(pseudoread):
+            summary.add_depleted()
+            continue
+          kmer_lcas = get_kmer_hit_counts.get_kmer_lcas_from_psuedoread(pseudoread, kmer_to_lca, k)
+          hit_counts = get_kmer_hit_counts.count_kmer_hits(kmer_lcas)
+          summary.add(hit_counts, classification_output.classify(hit_counts))
+          summary.num_ambiguous_kmers += kmer_lcas.count(get_kmer_hit_counts.AMBIGUOUS_KMER)
+          num_kmers += len(kmer_lcas)
+        estimate_progress.advance(sample_size - estimate_progress.done, kmers=num_kmers)
+        estimate.num_rounds += 1
+        if 100 * estimate.max_width() <= target_width:
+          break
+        sample_size = min(num_reads, 2 * sample_size)
+  return estimate
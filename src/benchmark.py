@@ -0,0 +1,370 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import multiprocessing
+from typing import Dict, List, Optional
+
+# helper files
+import kmer_to_lca_mapping
+import kmer_database
+import succinct_index
+import query_pipeline
+import classification_output
+import synthetic_data
+from metrics import peak_rss_bytes
+
+"""
+benchmark.py
+
+A reproducible benchmark suite for the contamination classifier.
+
+Generates a synthetic dataset with synthetic_data.py (reference genomes, taxonomy
+and a contaminated query assembly, all from a fixed seed), then for every
+combination of k and database backend times, separately,
+
+  - build: building the k-mer to LCA database from the reference genomes
+  - load:  loading a persisted database back into memory (for backends that persist one)
+  - query: classifying the pseudoreads of the query with the query pipeline (query_pipeline.py)
+
+and records the peak resident set size (RSS) after each stage. The peak RSS of a process
+only ever grows, so every case is built in a fresh process of its own, and a database that
+is persisted is loaded and queried in yet another one, where its peak isn't hidden under
+that of the build. (The dict backend is queried where it was built, as it isn't persisted.)
+
+Results are written as JSON so that runs on different commits can be compared,
+either by hand or with the --compare option.
+
+How to run
+----------
+
+$ python3 src/benchmark.py --genome-size 10M --num-taxa 100 --k 21 31 --output bench.json
+
+$ python3 src/benchmark.py --compare old-bench.json new-bench.json
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Version of the results file layout, bump this if the layout changes
+RESULTS_FORMAT_VERSION = 1
+
+# Database backends that can be benchmarked.
+# Each backend builds a database and returns something supporting the same
+# lookups as the kmer_to_lca dictionary, i.e. `kmer in db` and `db[kmer]`.
+# A backend that persists its database to disk also provides a load function.
+
+def build_dict_backend(dataset : Dict[str, object], k : int, work_directory : str, options : Dict[str, object]):
+  return kmer_to_lca_mapping.build_database(
+    dataset["reference_directory"],
+    dataset["custom_taxonomy_ids_filename"],
+    k,
+    dataset["taxonomy_id_to_parent_id"]
+  )
+
+def build_external_backend(dataset : Dict[str, object], k : int, work_directory : str, options : Dict[str, object]):
+  kmer_database.build_database_external(
+    dataset["reference_directory"],
+    dataset["custom_taxonomy_ids_filename"],
+    k,
+    dataset["taxonomy_id_to_parent_id"],
+    os.path.join(work_directory, "index.kdb"),
+    options["max_memory"]
+  )
+
+def load_external_backend(dataset : Dict[str, object], k : int, work_directory : str, options : Dict[str, object]):
+  return kmer_database.load_kmer_index(os.path.join(work_directory, "index.kdb"))
+
+def build_sharded_backend(dataset : Dict[str, object], k : int, work_directory : str, options : Dict[str, object]):
+  build_external_backend(dataset, k, work_directory, options)
+  shutil.rmtree(os.path.join(work_directory, "shards"), ignore_errors=True)
+  kmer_database.shard_kmer_index(
+    os.path.join(work_directory, "index.kdb"), os.path.join(work_directory, "shards"), options["shard_prefix_length"]
+  )
+
+def load_sharded_backend(dataset : Dict[str, object], k : int, work_directory : str, options : Dict[str, object]):
+  return kmer_database.ShardedKmerIndex(os.path.join(work_directory, "shards"))
+
+def build_succinct_backend(dataset : Dict[str, object], k : int, work_directory : str, options : Dict[str, object]):
+  build_external_backend(dataset, k, work_directory, options)
+  succinct_index.build_succinct_index(os.path.join(work_directory, "index.kdb"), os.path.join(work_directory, "index.ski"))
+
+def load_succinct_backend(dataset : Dict[str, object], k : int, work_directory : str, options : Dict[str, object]):
+  return succinct_index.load_succinct_index(os.path.join(work_directory, "index.ski"))
+
+BACKENDS = {
+  # name: (build function, load function or None)
+  "dict": (build_dict_backend, None),
+  "external": (build_external_backend, load_external_backend),
+  "sharded": (build_sharded_backend, load_sharded_backend),
+  "succinct": (build_succinct_backend, load_succinct_backend),
+}
+
+def run_build(dataset : Dict[str, object], k : int, backend : str, work_directory : str, options : Dict[str, object]) -> Dict[str, object]:
+  """
+  Time the build stage of one (k, backend) combination, and, for a backend that doesn't
+  persist its database, the query stage too, since the database only exists in this process.
+  Meant to be run in a fresh process (see run_in_subprocess).
+  """
+  build, load = BACKENDS[backend]
+  result : Dict[str, object] = {}
+
+  # the database build prints a line per reference, which would drown the benchmark output
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    start_time = time.perf_counter()
+    database = build(dataset, k, work_directory, options)
+    result["build_seconds"] = time.perf_counter() - start_time
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+  result["build_peak_rss_bytes"] = peak_rss_bytes()
+
+  if load is None:
+    result["load_seconds"] = None
+    result["load_peak_rss_bytes"] = peak_rss_bytes()
+    result["database_kmers"] = len(database)
+    run_query(dataset, k, database, options, result)
+  return result
+
+def run_load_and_query(dataset : Dict[str, object], k : int, backend : str, work_directory : str, options : Dict[str, object]) -> Dict[str, object]:
+  """
+  Time the load and query stages of one (k, backend) combination whose database was persisted
+  by run_build. Meant to be run in a fresh process of its own (see run_in_subprocess), so that
+  the peak RSS of the build doesn't hide how much memory the loaded database takes.
+  """
+  _, load = BACKENDS[backend]
+  result : Dict[str, object] = {}
+  start_time = time.perf_counter()
+  database = load(dataset, k, work_directory, options)
+  result["load_seconds"] = time.perf_counter() - start_time
+  result["load_peak_rss_bytes"] = peak_rss_bytes()
+  result["database_kmers"] = len(database)
+  run_query(dataset, k, database, options, result)
+  return result
+
+def run_query(dataset : Dict[str, object], k : int, database, options : Dict[str, object], result : Dict[str, object]) -> None:
+  """
+  Time the query stage against database, run through the same pipeline as main.py, adding its counts, throughput and peak RSS to result.
+  """
+  start_time = time.perf_counter()
+  summary = classification_output.ClassificationSummary()
+  pipeline = query_pipeline.QueryPipeline(
+    database, k, num_workers=options["query_threads"], batch_size=options["batch_size"], queue_depth=options["queue_depth"]
+  )
+  counters = pipeline.run(dataset["query_filename"], summary)
+  query_seconds = time.perf_counter() - start_time
+  num_kmers = counters.get("lookups", 0) + counters.get("ambiguous_kmers_skipped", 0)
+
+  result["query_seconds"] = query_seconds
+  result["query_reads"] = summary.num_reads
+  result["query_kmers"] = num_kmers
+  result["query_hits"] = counters.get("hits", 0)
+  result["query_reads_per_second"] = summary.num_reads / query_seconds if query_seconds else None
+  result["query_kmers_per_second"] = num_kmers / query_seconds if query_seconds else None
+  result["query_peak_rss_bytes"] = peak_rss_bytes()
+
+def run_in_subprocess(function, dataset : Dict[str, object], k : int, backend : str, work_directory : str, options : Dict[str, object]) -> Dict[str, object]:
+  """
+  Run one stage function of a case in a freshly spawned process, so its peak RSS is measured in isolation.
+  """
+  context = multiprocessing.get_context("spawn")
+  with context.Pool(processes=1) as pool:
+    return pool.apply(function, (dataset, k, backend, work_directory, options))
+
+def run_case(dataset : Dict[str, object], k : int, backend : str, work_directory : str, options : Dict[str, object]) -> Dict[str, object]:
+  """
+  Time the build, load and query stages of one (k, backend) combination, the build in one fresh
+  process and the load and query (for a backend that persists its database) in another.
+  """
+  result : Dict[str, object] = {"k": k, "backend": backend}
+  result.update(run_in_subprocess(run_build, dataset, k, backend, work_directory, options))
+  if BACKENDS[backend][1] is not None:
+    result.update(run_in_subprocess(run_load_and_query, dataset, k, backend, work_directory, options))
+  return result
+
+def git_commit() -> Optional[str]:
+  """
+  The commit the benchmark was run on, if we are inside a git checkout.
+  """
+  try:
+    return subprocess.run(
+      ["git", "rev-parse", "HEAD"],
+      cwd=os.path.dirname(os.path.abspath(__file__)),
+      capture_output=True, text=True, check=True
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run_benchmark(args) -> Dict[str, object]:
+  """
+  Generate (or reuse) the dataset and run every (k, backend) case.
+  """
+  genome_size = synthetic_data.parse_size(args.genome_size)
+  query_size = synthetic_data.parse_size(args.query_size)
+  data_directory = os.path.join(
+    args.data_dir, f"g{genome_size}-t{args.num_taxa}-q{query_size}-c{args.contamination}-s{args.seed}"
+  )
+
+  # the data only depends on the parameters in the directory name,
+  # so a dataset generated by an earlier run can be reused as is
+  dataset_filename = os.path.join(data_directory, "dataset.json")
+  generate_seconds = None
+  if os.path.exists(dataset_filename):
+    print(f"Reusing synthetic dataset in {data_directory}", file=sys.stderr)
+    with open(dataset_filename, 'r') as fp:
+      dataset = json.load(fp)
+  else:
+    print(f"Generating synthetic dataset in {data_directory}", file=sys.stderr)
+    start_time = time.perf_counter()
+    dataset = synthetic_data.generate_dataset(
+      data_directory, genome_size, args.num_taxa, query_size, args.contamination, args.seed
+    )
+    generate_seconds = time.perf_counter() - start_time
+    with open(dataset_filename, 'w') as fp:
+      json.dump(dataset, fp)
+
+  # backend specific settings
+  options = {
+    "max_memory": kmer_database.parse_memory_size(args.max_memory),
+    "shard_prefix_length": args.shard_prefix_length,
+    "query_threads": args.query_threads,
+    "batch_size": args.batch_size,
+    "queue_depth": args.queue_depth,
+  }
+
+  results : List[Dict[str, object]] = []
+  for k in args.k:
+    for backend in args.backends:
+      print(f"Running k = {k}, backend = {backend}", file=sys.stderr)
+      work_directory = os.path.join(data_directory, f"work-k{k}-{backend}")
+      os.makedirs(work_directory, exist_ok=True)
+      for repeat in range(args.repeats):
+        result = run_case(dataset, k, backend, work_directory, options)
+        result["repeat"] = repeat
+        results.append(result)
+        print(
+          f"\tbuild {result['build_seconds']:.2f}s, query {result['query_seconds']:.2f}s "
+          f"({result['query_reads_per_second']:.0f} reads/s), "
+          f"peak RSS {result['query_peak_rss_bytes'] / 2 ** 20:.1f} MiB",
+          file=sys.stderr
+        )
+
+  return {
+    "format_version": RESULTS_FORMAT_VERSION,
+    "commit": git_commit(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "parameters": {
+      "genome_size": genome_size,
+      "num_taxa": args.num_taxa,
+      "query_size": query_size,
+      "contamination": args.contamination,
+      "seed": args.seed,
+      "repeats": args.repeats,
+      "max_memory": options["max_memory"],
+      "shard_prefix_length": options["shard_prefix_length"],
+      "query_threads": options["query_threads"],
+      "batch_size": options["batch_size"],
+      "queue_depth": options["queue_depth"],
+    },
+    "generate_seconds": generate_seconds,
+    "ground_truth": dataset["ground_truth"],
+    "results": results,
+  }
+
+# The metrics compared by --compare, and whether bigger is better for them
+COMPARED_METRICS = {
+  "build_seconds": False,
+  "load_seconds": False,
+  "query_seconds": False,
+  "query_reads_per_second": True,
+  "query_peak_rss_bytes": False,
+}
+
+def compare_results(old_filename : str, new_filename : str, tolerance : float) -> bool:
+  """
+  Print the relative change of every compared metric between two results files,
+  taking the best of the repeats of each case.
+
+  @return: True if no metric regressed by more than tolerance (a fraction)
+  """
+  def best_by_case(filename):
+    with open(filename, 'r') as fp:
+      results = json.load(fp)["results"]
+    best = {}
+    for result in results:
+      case = (result["k"], result["backend"])
+      for metric, bigger_is_better in COMPARED_METRICS.items():
+        value = result.get(metric)
+        if value is None:
+          continue
+        current = best.setdefault(case, {}).get(metric)
+        if current is None or (value > current if bigger_is_better else value < current):
+          best[case][metric] = value
+    return best
+
+  old = best_by_case(old_filename)
+  new = best_by_case(new_filename)
+  ok = True
+  for case in sorted(set(old) & set(new)):
+    print(f"k = {case[0]}, backend = {case[1]}")
+    for metric, bigger_is_better in COMPARED_METRICS.items():
+      if metric not in old[case] or metric not in new[case] or not old[case][metric]:
+        continue
+      change = (new[case][metric] - old[case][metric]) / old[case][metric]
+      regressed = (change < -tolerance) if bigger_is_better else (change > tolerance)
+      ok = ok and not regressed
+      print(f"\t{metric}: {old[case][metric]:.4g} -> {new[case][metric]:.4g} ({change:+.1%}){' REGRESSION' if regressed else ''}")
+  return ok
+
+def parse_args():
+  parse = argparse.ArgumentParser(
+    description="Benchmark database build, load and query throughput on reproducible synthetic data"
+  )
+  parse.add_argument("--genome-size", default="1M", help="Total bases across all reference genomes, from 1M to 1G (default: 1M)")
+  parse.add_argument("--num-taxa", default=10, type=int, help="Number of reference genomes, from 10 to 1000 (default: 10)")
+  parse.add_argument("--query-size", default="100K", help="Length of the contaminated query assembly (default: 100K)")
+  parse.add_argument("--contamination", default=0.1, type=float, help="Fraction of the query copied from the references (default: 0.1)")
+  parse.add_argument("--seed", default=47, type=int, help="Random seed for the synthetic data (default: 47)")
+  parse.add_argument("--k", default=[31], type=int, nargs="+", help="One or more kmer lengths to benchmark (default: 31)")
+  parse.add_argument("--backends", default=["dict"], nargs="+", choices=sorted(BACKENDS), help="Database backends to benchmark (default: dict)")
+  parse.add_argument("--max-memory", default="256M", help="Memory budget of the external backend's build (default: 256M)")
+  parse.add_argument("--shard-prefix-length", default=3, type=int, help="Number of leading bases the sharded backend shards by (default: 3)")
+  parse.add_argument("--query-threads", default=1, type=int, help="Number of worker threads classifying pseudoreads (default: 1)")
+  parse.add_argument("--batch-size", default=query_pipeline.DEFAULT_BATCH_SIZE, type=int, help=f"Number of pseudoreads the query pipeline hands a worker at a time (default: {query_pipeline.DEFAULT_BATCH_SIZE})")
+  parse.add_argument("--queue-depth", default=query_pipeline.DEFAULT_QUEUE_DEPTH, type=int, help=f"Number of batches the query pipeline queues between its stages (default: {query_pipeline.DEFAULT_QUEUE_DEPTH})")
+  parse.add_argument("--repeats", default=1, type=int, help="Number of times to run every case (default: 1)")
+  parse.add_argument("--data-dir", default="bench-data", help="Directory to generate the synthetic data in (default: bench-data)")
+  parse.add_argument("--output", default="bench.json", help="Filename of the JSON results (default: bench.json)")
+  parse.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results files instead of running the benchmark")
+  parse.add_argument("--tolerance", default=0.1, type=float, help="Relative change counted as a regression by --compare (default: 0.1)")
+  return parse.parse_args()
+
+def main():
+  args = parse_args()
+
+  if args.compare:
+    ok = compare_results(args.compare[0], args.compare[1], args.tolerance)
+    exit(0 if ok else 1)
+
+  results = run_benchmark(args)
+  with open(args.output, 'w') as fp:
+    json.dump(results, fp, indent=2)
+  print(f"Wrote benchmark results to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,174 @@
+import io
+import gzip
+from typing import Dict, List, Optional
+
+"""
+classification_output.py
+
+Streams the per-read classification results out as the reads are classified,
+and keeps the aggregate summary that main.py prints in a few small counters,
+so that neither grows with the number of reads (and identical reads are
+counted as separate reads).
+
+Per-read output format
+----------------------
+
+One tab separated line per read, in Kraken's classification output format
+(https://github.com/DerrickWood/kraken2/wiki/Manual#standard-kraken-output-format)
+with one extra column at the end:
+
+  1. C if the read was classified, U if it was not
+  2. the read id (Read1, Read2, ..., the same ids as the Kraken FASTQ inputs use)
+  3. the taxonomy id the read was classified as (the one with the most k-mer hits), or 0
+  4. the length of the read
+  5. the LCA of every k-mer of the read, in order, run-length compressed as
+     space separated taxid:count pairs, where 0 means the k-mer was not in the database
+     and A means the k-mer contained an ambiguous base and was skipped
+     (e.g. "0:6 2697049:1 0:32 A:31"), or H:count if the read was depleted as the
+     host's and none of its k-mers were looked up (see host_depletion.py)
+  6. the top taxonomy ids by k-mer hits, as space separated taxid:count pairs
+
+Tools that parse Kraken output by its first five columns can read the file as is.
+A filename ending in .gz is written gzip compressed.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Bytes buffered before the per-read output is written to disk
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Number of formatted lines collected before they are handed to the (buffered) file in one write
+LINES_PER_WRITE = 1024
+
+# Number of taxonomy ids listed in the top taxa column
+NUM_TOP_TAXA = 3
+
+def compact_hit_list(kmer_lcas : List[Optional[str]]) -> str:
+  """
+  Run-length compress the per-k-mer LCAs of a read into Kraken's
+  'taxid:count taxid:count ...' form, with 0 for k-mers that were not hit
+  (and A for the skipped ambiguous ones).
+  """
+  runs = []
+  previous = None
+  count = 0
+  for lca_node_taxonomy_id in kmer_lcas:
+    taxonomy_id = lca_node_taxonomy_id or '0'
+    if taxonomy_id == previous:
+      count += 1
+    else:
+      if count:
+        runs.append(f"{previous}:{count}")
+      previous = taxonomy_id
+      count = 1
+  if count:
+    runs.append(f"{previous}:{count}")
+  return " ".join(runs)
+
+def classify(hit_counts : Dict[str, int]) -> Optional[str]:
+  """
+  The taxonomy id a read is classified as: the one with the most k-mer hits
+  (the first one hit, in case of ties), or None if nothing was hit.
+  """
+  if len(hit_counts) == 0:
+    return None
+  return max(hit_counts.keys(), key=lambda x : hit_counts[x])
+
+class ClassificationWriter:
+  """
+  Writes per-read classifications (see the top of this file) to a file,
+  through a large buffer, gzip compressed if the filename ends with .gz.
+  """
+  def __init__(self, filename : str):
+    self.filename = filename
+    if filename.endswith(".gz"):
+      raw = gzip.open(filename, 'wb', compresslevel=6)
+    else:
+      raw = open(filename, 'wb', buffering=0)
+    self.fp = io.BufferedWriter(raw, buffer_size=OUTPUT_BUFFER_SIZE)
+    self.lines : List[str] = []
+
+  def write(self, read_id : str, read_length : int, kmer_lcas : List[Optional[str]], hit_counts : Dict[str, int], call : Optional[str]) -> None:
+    top_taxa = sorted(hit_counts.items(), key=lambda item: item[1], reverse=True)[:NUM_TOP_TAXA]
+    self.lines.append(
+      f"{'C' if call else 'U'}\t{read_id}\t{call or 0}\t{read_length}\t{compact_hit_list(kmer_lcas)}\t"
+      f"{' '.join(f'{taxonomy_id}:{count}' for taxonomy_id, count in top_taxa)}\n"
+    )
+    if len(self.lines) >= LINES_PER_WRITE:
+      self.flush()
+
+  def flush(self) -> None:
+    if self.lines:
+      self.fp.write("".join(self.lines).encode())
+      self.lines = []
+
+  def close(self) -> None:
+    self.flush()
+    self.fp.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+class ClassificationSummary:
+  """
+  Incrementally computed aggregate of the classifications, i.e. what
+  print_pseudoreads_classified and print_kmers_classified in main.py print.
+  """
+  def __init__(self):
+    # taxonomy id -> number of reads classified as it
+    self.read_counts : Dict[str, int] = {}
+    # taxonomy id -> total number of k-mer hits to it, over all reads
+    self.kmer_counts : Dict[str, int] = {}
+    self.num_reads = 0
+    self.num_reads_classified = 0
+    # number of reads depleted as the host's before classification (see host_depletion.py)
+    self.num_reads_depleted = 0
+    # number of k-mer windows skipped for containing an ambiguous base
+    self.num_ambiguous_kmers = 0
+
+  def add(self, hit_counts : Dict[str, int], call : Optional[str]) -> None:
+    self.num_reads += 1
+    if call is not None:
+      self.num_reads_classified += 1
+      self.read_counts[call] = self.read_counts.get(call, 0) + 1
+    for taxonomy_id, count in hit_counts.items():
+      self.kmer_counts[taxonomy_id] = self.kmer_counts.get(taxonomy_id, 0) + count
+
+  def add_depleted(self) -> None:
+    self.num_reads += 1
+    self.num_reads_depleted += 1
+
+  def to_dict(self) -> Dict[str, object]:
+    """
+    The summary as a JSON serializable dictionary (see result_cache.py).
+    """
+    return {
+      "read_counts": self.read_counts,
+      "kmer_counts": self.kmer_counts,
+      "num_reads": self.num_reads,
+      "num_reads_classified": self.num_reads_classified,
+      "num_reads_depleted": self.num_reads_depleted,
+      "num_ambiguous_kmers": self.num_ambiguous_kmers,
+    }
+
+  @classmethod
+  def from_dict(cls, values : Dict[str, object]) -> "ClassificationSummary":
+    summary = cls()
+    summary.read_counts = values["read_counts"]
+    summary.kmer_counts = values["kmer_counts"]
+    summary.num_reads = values["num_reads"]
+    summary.num_reads_classified = values["num_reads_classified"]
+    summary.num_reads_depleted = values.get("num_reads_depleted", 0)
+    summary.num_ambiguous_kmers = values["num_ambiguous_kmers"]
+    return summary
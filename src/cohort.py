@@ -0,0 +1,197 @@
+import os
+import multiprocessing
+from typing import Dict, Iterator, List, Optional
+
+# helper files
+import kmer_database
+import succinct_index
+import query_pipeline
+import classification_output
+import progress
+
+"""
+cohort.py
+
+Classifies a cohort of samples (e.g. hundreds of assemblies being screened) against one
+database, and assembles the results into a sample x taxon abundance matrix.
+
+The database is built (or loaded) once and persisted as an index file, which main.py and every
+worker process memory map (see kmer_database.load_kmer_index), so they all share the one copy of
+it in the page cache: the peak memory is that copy plus the buffers of every worker, however
+many workers there are. A --shard-dir or --succinct database is mapped the same way.
+
+Every worker process takes whole samples, one at a time, and classifies them with the query
+pipeline (see query_pipeline.py), sending back only the sample's summary counters, so samples
+are spread over the workers without anything per read leaving them. With one worker, the
+samples are classified in the main process instead.
+
+Matrix format
+-------------
+
+A tab separated file with a header line and one line per sample, in the order of the cohort:
+
+  1. the sample, its filename without the directory and extensions (or the filename as given,
+     if two samples would have the same name)
+  2. the number of pseudoreads of the sample
+  3. the number of them that were classified
+  4. ... one column per taxonomy id hit in any of the samples, by the number of pseudoreads
+     classified as it over the whole cohort, holding (see MATRIX_VALUES) the percentage of the
+     sample's classified pseudoreads classified as it, the number of them, or the number of
+     k-mer hits to it
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# What the taxon columns of the matrix can hold
+MATRIX_VALUES = ["percent", "reads", "kmers"]
+
+# The database and query pipeline options of this worker process (see init_worker)
+worker_state : Dict[str, object] = {}
+
+def read_cohort(cohort : str) -> List[str]:
+  """
+  The query filenames of a cohort: the files of a directory, in order of their names, or the
+  lines of a file listing them (blank lines and lines starting with # are skipped).
+  """
+  if os.path.isdir(cohort):
+    return [
+      os.path.join(cohort, f) for f in sorted(os.listdir(cohort))
+      if not f.startswith('.') and os.path.isfile(os.path.join(cohort, f))
+    ]
+  with open(cohort, 'r') as fp:
+    return [line.strip() for line in fp if line.strip() and not line.startswith('#')]
+
+def sample_names(filenames : List[str]) -> List[str]:
+  """
+  The names of the samples in the matrix (see the top of this file).
+  """
+  names = []
+  for filename in filenames:
+    name = os.path.basename(filename)
+    if name.endswith(".gz"):
+      name = name[:-len(".gz")]
+    names.append(os.path.splitext(name)[0] or name)
+  if len(set(names)) < len(names):
+    return list(filenames)
+  return names
+
+def open_database(database_filename : str, fingerprint : Optional[str] = None, max_open_shards : int = 64):
+  """
+  Memory map the database persisted in database_filename by main.py: an index file,
+  the succinct copy of one (.ski), or a directory of shards.
+  """
+  if os.path.isdir(database_filename):
+    return kmer_database.ShardedKmerIndex(database_filename, max_open_shards=max_open_shards)
+  if database_filename.endswith(".ski"):
+    return succinct_index.load_succinct_index(database_filename, use_mmap=True, expected_fingerprint=fingerprint)
+  return kmer_database.load_kmer_index(database_filename, use_mmap=True, expected_fingerprint=fingerprint)
+
+def init_worker(
+    database_filename : str,
+    fingerprint : Optional[str],
+    max_open_shards : int,
+    k : int,
+    pipeline_options : Dict[str, object]) -> None:
+  """
+  Runs once in every worker process, before it classifies any samples.
+  """
+  # a forked worker doesn't have the main process's reporter thread (and its locks may have been
+  # held when it was forked), so it gets a reporter of its own, which reports nothing
+  progress.reporter = progress.ProgressReporter()
+  worker_state["kmer_to_lca"] = open_database(database_filename, fingerprint, max_open_shards)
+  worker_state["k"] = k
+  worker_state["pipeline_options"] = pipeline_options
+
+def classify_sample(query_filename : str) -> Dict[str, object]:
+  """
+  Classify every pseudoread of one sample against the database of this process.
+
+  @return: the filename, and either the sample's summary (see ClassificationSummary.to_dict)
+           and query pipeline counters, or the error that stopped it
+  """
+  try:
+    summary = classification_output.ClassificationSummary()
+    pipeline = query_pipeline.QueryPipeline(worker_state["kmer_to_lca"], worker_state["k"], **worker_state["pipeline_options"])
+    counters = pipeline.run(query_filename, summary)
+  except (OSError, ValueError) as e:
+    return {"filename": query_filename, "error": str(e)}
+  return {"filename": query_filename, "summary": summary.to_dict(), "counters": counters}
+
+def classify_cohort(
+    filenames : List[str],
+    kmer_to_lca,
+    database_filename : Optional[str],
+    k : int,
+    num_workers : int,
+    max_open_shards : int = 64,
+    pipeline_options : Optional[Dict[str, object]] = None) -> Iterator[Dict[str, object]]:
+  """
+  Classify every sample of a cohort on num_workers worker processes, each of which memory maps
+  the database persisted in database_filename (see open_database).
+
+  @param kmer_to_lca: the database as main.py loaded it, used when there is only one worker
+  @return: the results of classify_sample for every sample, in the order of filenames
+  """
+  pipeline_options = pipeline_options or {}
+  num_workers = min(num_workers, len(filenames))
+  if num_workers <= 1 or database_filename is None:
+    worker_state.update(kmer_to_lca=kmer_to_lca, k=k, pipeline_options=pipeline_options)
+    yield from map(classify_sample, filenames)
+    return
+  fingerprint = getattr(kmer_to_lca, "fingerprint", None)
+  with multiprocessing.Pool(
+      num_workers,
+      initializer=init_worker,
+      initargs=(database_filename, fingerprint, max_open_shards, k, pipeline_options)) as pool:
+    # one sample at a time, so that a worker that finishes early takes the next one
+    yield from pool.imap(classify_sample, filenames, chunksize=1)
+
+def matrix_taxa(summaries : List[Dict[str, object]]) -> List[str]:
+  """
+  The taxonomy ids of the matrix columns, by the number of pseudoreads classified as them over the whole cohort.
+  """
+  totals : Dict[str, int] = {}
+  for summary in summaries:
+    for taxonomy_id, count in summary["read_counts"].items():
+      totals[taxonomy_id] = totals.get(taxonomy_id, 0) + count
+    for taxonomy_id in summary["kmer_counts"]:
+      totals.setdefault(taxonomy_id, 0)
+  return sorted(totals, key=lambda taxonomy_id: -totals[taxonomy_id])
+
+def matrix_row(summary : Dict[str, object], taxa : List[str], values : str) -> List[str]:
+  """
+  The taxon columns of a sample's row of the matrix.
+  """
+  if values == "kmers":
+    return [str(summary["kmer_counts"].get(taxonomy_id, 0)) for taxonomy_id in taxa]
+  if values == "reads":
+    return [str(summary["read_counts"].get(taxonomy_id, 0)) for taxonomy_id in taxa]
+  num_classified = max(1, summary["num_reads_classified"])
+  return [f"{100 * summary['read_counts'].get(taxonomy_id, 0) / num_classified:.4f}" for taxonomy_id in taxa]
+
+def write_matrix(
+    matrix_filename : str,
+    names : List[str],
+    summaries : List[Dict[str, object]],
+    values : str = "percent") -> List[str]:
+  """
+  Write the sample x taxon abundance matrix of the samples (see the top of this file).
+
+  @return: the taxonomy ids of its columns
+  """
+  taxa = matrix_taxa(summaries)
+  with open(matrix_filename + ".tmp", 'w') as fp:
+    fp.write("\t".join(["sample", "pseudoreads", "classified"] + taxa) + "\n")
+    for name, summary in zip(names, summaries):
+      row = [name, str(summary["num_reads"]), str(summary["num_reads_classified"])]
+      fp.write("\t".join(row + matrix_row(summary, taxa, values)) + "\n")
+  os.replace(matrix_filename + ".tmp", matrix_filename)
+  return taxa
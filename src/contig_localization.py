@@ -0,0 +1,202 @@
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# helper files
+from kmer_windows import AMBIGUOUS_KMER
+
+"""
+contig_localization.py
+
+Localizes the contaminants along the query's contigs, so that a contaminating segment (e.g. the
+phiX174 in covid-contaminated-with-phiX174.txt) can be trimmed, and writes them out as a BED file.
+
+It runs in the same scan of the query as the classification, as the classified pseudoreads come
+out of the query pipeline in read order (see query_pipeline.py):
+
+  1. smoothing: a pseudoread's call is replaced by the call of the majority (more than half) of
+     the pseudoreads around it, within smoothing pseudoreads on either side, if there is one, so
+     that a lone pseudoread classified as something else (or not at all) neither splits a
+     contaminated segment nor makes one of its own
+  2. merging: consecutive pseudoreads with the same smoothed call are merged into one interval,
+     from the first to the last base of the k-mers of that taxon hit in them (or the pseudoreads
+     themselves, if none of their k-mers hit it)
+  3. every interval is split at the contig boundaries (the pseudoreads run across them, the same
+     way they are classified) and written out as soon as it ends
+
+Only the pseudoreads around the current one and the current interval are kept, so this takes
+O(n) time and memory bounded by the smoothing window, however long the query is.
+
+BED output format
+-----------------
+
+One tab separated line per interval (BED6), in order along the query:
+
+  1. the contig, the first word of its FASTA header
+  2. the start of the interval on the contig (0-based)
+  3. the end of the interval on the contig (exclusive)
+  4. the taxonomy id it was localized to
+  5. the per mille of its pseudoreads classified as that taxonomy id before smoothing
+  6. the strand, always .
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Number of pseudoreads on either side of a pseudoread whose calls are used to smooth its call
+DEFAULT_SMOOTHING = 1
+
+# Name of the contig of any bases before the first FASTA header
+UNNAMED_CONTIG = "unnamed"
+
+class ContigLocalizer:
+  """
+  Merges the calls of the pseudoreads of a query, as they are added in read order,
+  into per-contig intervals written to bed_filename (see the top of this file).
+
+  @param contigs: the (name, start) of every contig of the query, as recorded by
+    pseudoreads.iter_fasta_blocks, which may still be growing as long as every contig
+    before the pseudoreads added so far is in it
+  @param read_length, overlap: how the pseudoreads were cut from the query (see pseudoreads.py)
+  """
+  def __init__(
+      self,
+      bed_filename : str,
+      contigs : List[Tuple[str, int]],
+      k : int,
+      smoothing : int = DEFAULT_SMOOTHING,
+      read_length : int = 100,
+      overlap : int = 50):
+    self.bed_filename = bed_filename
+    self.contigs = contigs
+    self.k = k
+    self.smoothing = max(0, smoothing)
+    self.read_length = read_length
+    self.step_size = read_length - overlap
+    # (start, call, {taxonomy id: [first hit, last hit]}) of the pseudoreads still needed for smoothing
+    self.window : Deque[Tuple[int, Optional[str], Dict[str, List[int]]]] = deque()
+    # number of the first pseudoread in window, and of the next one to smooth
+    self.window_start = 0
+    self.next_to_smooth = 0
+    self.num_reads = 0
+    # [taxonomy id, hit start, hit end, read start, read end, pseudoreads, pseudoreads called as it]
+    self.interval : Optional[list] = None
+    self.contig_index = 0
+    self.num_intervals = 0
+    self.file = open(bed_filename, 'w')
+
+  def add(self, kmer_lcas : List[Optional[str]], call : Optional[str]) -> None:
+    """
+    Add the next pseudoread, given the LCA of each of its k-mers and what it was classified as.
+    """
+    start = self.num_reads * self.step_size
+    self.num_reads += 1
+    hits : Dict[str, List[int]] = {}
+    for position, lca_node_taxonomy_id in enumerate(kmer_lcas, start=start):
+      if lca_node_taxonomy_id is None or lca_node_taxonomy_id == AMBIGUOUS_KMER:
+        continue
+      if lca_node_taxonomy_id in hits:
+        hits[lca_node_taxonomy_id][1] = position
+      else:
+        hits[lca_node_taxonomy_id] = [position, position]
+    self.window.append((start, call, hits))
+    # a pseudoread is smoothed once the ones after it that it is smoothed with have been added
+    while self.next_to_smooth + self.smoothing < self.num_reads:
+      self.smooth_next()
+
+  def smooth_next(self) -> None:
+    """
+    Smooth the call of the next pseudoread and add it to the intervals.
+    """
+    first = max(0, self.next_to_smooth - self.smoothing)
+    while self.window_start < first:
+      self.window.popleft()
+      self.window_start += 1
+    last = min(self.num_reads, self.next_to_smooth + self.smoothing + 1)
+    calls = Counter(self.window[i - self.window_start][1] for i in range(first, last))
+    start, call, hits = self.window[self.next_to_smooth - self.window_start]
+    majority, count = calls.most_common(1)[0]
+    smoothed = majority if 2 * count > last - first else call
+    self.extend(start, call, smoothed, hits)
+    self.next_to_smooth += 1
+
+  def extend(self, start : int, call : Optional[str], smoothed : Optional[str], hits : Dict[str, List[int]]) -> None:
+    """
+    Add a smoothed pseudoread to the current interval, or end it and start the next one.
+    """
+    if self.interval is not None and self.interval[0] != smoothed:
+      self.write_interval()
+    if smoothed is None:
+      return
+    if self.interval is None:
+      self.interval = [smoothed, None, None, start, None, 0, 0]
+    interval = self.interval
+    interval[4] = start + self.read_length
+    interval[5] += 1
+    interval[6] += call == smoothed
+    if smoothed in hits:
+      first_hit, last_hit = hits[smoothed]
+      if interval[1] is None:
+        interval[1] = first_hit
+      interval[2] = last_hit + self.k
+
+  def contig_at(self, position : int) -> int:
+    """
+    The index in contigs of the contig the base at position is on, or -1 if it is before the first header.
+    """
+    index = min(self.contig_index, len(self.contigs) - 1)
+    while index >= 0 and self.contigs[index][1] > position:
+      index -= 1
+    while index + 1 < len(self.contigs) and self.contigs[index + 1][1] <= position:
+      index += 1
+    self.contig_index = max(0, index)
+    return index
+
+  def write_interval(self) -> None:
+    """
+    Write out the current interval, split at the contig boundaries.
+    """
+    taxonomy_id, hit_start, hit_end, read_start, read_end, num_reads, num_called = self.interval
+    self.interval = None
+    start, end = (hit_start, hit_end) if hit_start is not None else (read_start, read_end)
+    score = round(1000 * num_called / num_reads)
+    index = self.contig_at(start)
+    while start < end:
+      name, offset = self.contigs[index] if index >= 0 else (UNNAMED_CONTIG, 0)
+      contig_end = self.contigs[index + 1][1] if index + 1 < len(self.contigs) else end
+      piece_end = min(end, contig_end)
+      if piece_end > start:
+        self.file.write(f"{name}\t{start - offset}\t{piece_end - offset}\t{taxonomy_id}\t{score}\t.\n")
+        self.num_intervals += 1
+      start = piece_end
+      index += 1
+
+  def close(self) -> int:
+    """
+    Smooth the last pseudoreads, write out the last interval and close the BED file.
+
+    @return: the number of intervals written
+    """
+    while self.next_to_smooth < self.num_reads:
+      self.smooth_next()
+    if self.interval is not None:
+      self.write_interval()
+    self.file.close()
+    return self.num_intervals
+
+def read_intervals(bed_filename : str) -> List[Tuple[str, int, int, str, int]]:
+  """
+  The (contig, start, end, taxonomy id, score) of every interval of a BED file written by ContigLocalizer.
+  """
+  intervals = []
+  with open(bed_filename, 'r') as fp:
+    for line in fp:
+      fields = line.rstrip("\n").split("\t")
+      intervals.append((fields[0], int(fields[1]), int(fields[2]), fields[3], int(fields[4])))
+  return intervals
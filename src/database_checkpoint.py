@@ -0,0 +1,152 @@
+import os
+import json
+from typing import Dict, List, Optional
+
+"""
+database_checkpoint.py
+
+Checkpoints of a --max-memory database build (see kmer_database.build_database_external), so
+that a build killed partway through (e.g. by the out of memory killer, or a cluster job running
+out of time) continues where it left off when it is started again, rather than from the start.
+
+The checkpoint directory holds the build's buckets, and a checkpoint.json committed (written to
+a temporary file and moved into place, so that it is always either the old or the new one)
+every time a unit of the build is finished:
+
+  - pass 1, after every reference genome: how many of them have been partitioned, and the size
+    of every bucket file at that point (anything appended to a bucket after it, by a reference
+    that didn't finish, is cut off again on restart, and that reference is partitioned again)
+  - pass 2, after every bucket: how many buckets have been reduced, each into a sorted
+    reduced-NNNNNN file of its k-mers and their taxon indices that then replaces the bucket
+
+along with the taxonomy id list (the taxon indices are positions in it), the build's stats so
+far and, for a pruned build, the numbers of k-mers pruned from the buckets reduced so far (the
+low-complexity k-mers are in the buckets, see kmer_database.py, so they are never kept). Once every
+bucket is reduced, the reduced files are appended, in prefix order, to the index, and the
+checkpoint directory is removed.
+
+Every unit is redone from the same state it started from the first time, so the index comes out
+byte for byte the same as that of a build that was never interrupted. A checkpoint is only used
+by the same build: the same database fingerprint, k, reference files, pruning options and bucket
+and buffer sizes (i.e. the same --max-memory). Otherwise the directory is cleared and the build
+starts over.
+
+The files are not fsynced, so a checkpoint survives the build process dying, but not the host
+crashing.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+CHECKPOINT_FILENAME = "checkpoint.json"
+CHECKPOINT_FORMAT = "kmer-database-build-checkpoint"
+CHECKPOINT_VERSION = 2
+
+# The start of the name of every file of a checkpoint (including their temporary files,
+# and the low-complexity k-mer set of a version 1 checkpoint)
+CHECKPOINT_FILES = (CHECKPOINT_FILENAME, "low-complexity-kmers", "bucket-", "reduced-")
+
+class BuildCheckpoint:
+  """
+  The checkpoint directory of one build (see the top of this file).
+
+  @param build: what identifies the build, compared with the build of the checkpoint found in the directory
+  """
+  def __init__(self, directory : str, build : Dict[str, object]):
+    self.directory = directory
+    self.build = build
+    os.makedirs(directory, exist_ok=True)
+
+  def path(self, filename : str) -> str:
+    return os.path.join(self.directory, filename)
+
+  def reduced_filename(self, bucket : int) -> str:
+    return self.path(f"reduced-{bucket:06d}")
+
+  def load(self) -> Optional[Dict[str, object]]:
+    """
+    The state of the last checkpoint of this build, or None if there is none
+    (clearing out the checkpoint of any other build).
+    """
+    try:
+      with open(self.path(CHECKPOINT_FILENAME), 'r') as fp:
+        checkpoint = json.load(fp)
+    except FileNotFoundError:
+      checkpoint = None
+    except (OSError, ValueError) as e:
+      print(f"Not resuming from the checkpoint in {self.directory}: {e}")
+      checkpoint = None
+    else:
+      if checkpoint.get("format") != CHECKPOINT_FORMAT or checkpoint.get("version") != CHECKPOINT_VERSION:
+        print(f"Not resuming from the checkpoint in {self.directory}: it is not a version {CHECKPOINT_VERSION} checkpoint")
+        checkpoint = None
+      elif checkpoint["build"] != self.build:
+        changed = sorted(name for name in self.build if checkpoint["build"].get(name) != self.build[name])
+        print(f"Not resuming from the checkpoint in {self.directory}: it is of a build with other {', '.join(changed)}")
+        checkpoint = None
+    if checkpoint is None:
+      self.clear()
+      return None
+    return checkpoint["state"]
+
+  def save(self, state : Dict[str, object]) -> None:
+    """
+    Commit a checkpoint of the build's state.
+    """
+    checkpoint = {
+      "format": CHECKPOINT_FORMAT,
+      "version": CHECKPOINT_VERSION,
+      "build": self.build,
+      "state": state,
+    }
+    temporary_filename = self.path(CHECKPOINT_FILENAME + ".tmp")
+    with open(temporary_filename, 'w') as fp:
+      json.dump(checkpoint, fp)
+    os.replace(temporary_filename, self.path(CHECKPOINT_FILENAME))
+
+  def bucket_sizes(self, bucket_filenames : List[str]) -> Dict[str, int]:
+    """
+    The sizes of the bucket files that exist, by bucket number (as a string, for JSON).
+    """
+    sizes = {}
+    for bucket, bucket_filename in enumerate(bucket_filenames):
+      if os.path.exists(bucket_filename):
+        sizes[str(bucket)] = os.path.getsize(bucket_filename)
+    return sizes
+
+  def truncate_buckets(self, bucket_filenames : List[str], sizes : Dict[str, int]) -> None:
+    """
+    Cut every bucket file back to its size at the checkpoint, removing the ones that didn't exist yet.
+    """
+    for bucket, bucket_filename in enumerate(bucket_filenames):
+      if not os.path.exists(bucket_filename):
+        continue
+      if str(bucket) in sizes:
+        os.truncate(bucket_filename, sizes[str(bucket)])
+      else:
+        os.remove(bucket_filename)
+
+  def clear(self) -> None:
+    """
+    Remove the files of the checkpoint (and nothing else) from the checkpoint directory.
+    """
+    for f in os.listdir(self.directory):
+      if f.startswith(CHECKPOINT_FILES):
+        os.remove(self.path(f))
+
+  def remove(self) -> None:
+    """
+    Remove the checkpoint, and the checkpoint directory if that leaves it empty, once the build is done.
+    """
+    self.clear()
+    try:
+      os.rmdir(self.directory)
+    except OSError:
+      pass
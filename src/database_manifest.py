@@ -0,0 +1,251 @@
+import os
+import json
+import zlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# helper files
+import kmer_to_lca_mapping
+
+"""
+database_manifest.py
+
+Records what a persisted k-mer database (see kmer_database.py) was built from, so a stale or
+mismatched database can be told apart from a good one, and checks it.
+
+The manifest of a database lists
+
+  - k and the k-mer encoding
+  - every file of the reference directory, with its size, modification time and SHA-256, and the
+    accession id and taxonomy id it was built as, or why it was skipped (i.e. its accession id
+    isn't in the custom taxonomy ids file)
+  - the accession id to taxonomy id mapping, and the size, modification time and SHA-256 of the
+    custom taxonomy ids file it came from
+  - the SHA-256 of the taxonomy parent map
+  - the pruning options it was built with, if any (see database_pruning.py)
+  - a fingerprint, the SHA-256 of all of the above that determines the database's contents
+
+and the index file it is stored in adds the number of k-mers per taxon and the CRC-32 of every
+block of its k-mers and taxa sections. The fingerprint is also written into the header of every
+index file (and shard), so checking that a file belongs to a database only reads its header.
+
+There are two checks:
+
+  - check_manifest compares the manifest with the reference directory and taxonomy ids file by
+    their sizes and modification times only, so a database built from different inputs is
+    rejected without rehashing gigabytes of references
+  - verify_blocks (the deep verify) recomputes the block checksums of an index file, on several
+    threads (zlib computes CRC-32s without holding the GIL), to catch corrupted files
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+MANIFEST_FORMAT = "kmer-database-manifest"
+MANIFEST_VERSION = 1
+
+# Bytes read at a time while hashing files
+HASH_BLOCK_SIZE = 1 << 20
+
+# Bytes of an index section covered by each block checksum
+CHECKSUM_BLOCK_SIZE = 1 << 22
+
+def file_checksum(filename : str) -> str:
+  """
+  The SHA-256 of the file's contents, read in HASH_BLOCK_SIZE blocks.
+  """
+  digest = hashlib.sha256()
+  with open(filename, 'rb') as fp:
+    for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+def parent_map_checksum(taxonomy_id_to_parent_id : Dict[str, str]) -> str:
+  return hashlib.sha256(json.dumps(sorted(taxonomy_id_to_parent_id.items())).encode()).hexdigest()
+
+def manifest_fingerprint(manifest : Dict[str, object]) -> str:
+  """
+  The SHA-256 of everything in the manifest that determines the database's contents
+  (so not the file modification times, or where the files are).
+  """
+  contents = {
+    "k": manifest["k"],
+    "encoding": manifest["encoding"],
+    "source_files": [
+      (f["name"], f["size"], f["sha256"], f["accession_id"], f["taxonomy_id"]) for f in manifest["source_files"]
+    ],
+    "accession_to_taxonomy_id": manifest["accession_to_taxonomy_id"],
+    "parent_map_sha256": manifest["parent_map_sha256"],
+  }
+  # only pruned databases have it, so unpruned ones keep the fingerprints they always had
+  if manifest.get("pruning"):
+    contents["pruning"] = manifest["pruning"]
+  return hashlib.sha256(json.dumps(contents, sort_keys=True).encode()).hexdigest()
+
+def build_manifest(
+    file_directory : str,
+    custom_taxonomy_ids_filename : str,
+    k : int,
+    taxonomy_id_to_parent_id : Dict[str, str],
+    encoding : str,
+    pruning : Optional[Dict[str, object]] = None) -> Dict[str, object]:
+  """
+  The manifest of a database about to be built from the files in file_directory,
+  hashing every one of them once.
+
+  @param pruning: the pruning options it will be built with (see database_pruning.pruning_options)
+  """
+  ncbi_accession_id_to_tax_id = kmer_to_lca_mapping.make_ncbi_accession_id_to_tax_id_mapping(
+    custom_taxonomy_ids_filename
+  )
+  source_files = []
+  skipped_files = []
+  for f in sorted(os.listdir(file_directory)):
+    file_path = os.path.join(file_directory, f)
+    status = os.stat(file_path)
+    with open(file_path, 'r') as fp:
+      tokens = fp.readline().split()
+    accession_id = tokens[0][1:] if tokens else ""
+    entry = {"name": f, "size": status.st_size, "mtime_ns": status.st_mtime_ns}
+    if accession_id in ncbi_accession_id_to_tax_id:
+      entry.update({
+        "sha256": file_checksum(file_path),
+        "accession_id": accession_id,
+        "taxonomy_id": ncbi_accession_id_to_tax_id[accession_id],
+      })
+      source_files.append(entry)
+    else:
+      entry["reason"] = f"accession id {accession_id!r} is not in {custom_taxonomy_ids_filename}"
+      skipped_files.append(entry)
+
+  status = os.stat(custom_taxonomy_ids_filename)
+  manifest = {
+    "format": MANIFEST_FORMAT,
+    "version": MANIFEST_VERSION,
+    "k": k,
+    "encoding": encoding,
+    "source_files": source_files,
+    "skipped_files": skipped_files,
+    "accession_to_taxonomy_id": ncbi_accession_id_to_tax_id,
+    "taxonomy_ids_file": {
+      "size": status.st_size,
+      "mtime_ns": status.st_mtime_ns,
+      "sha256": file_checksum(custom_taxonomy_ids_filename),
+    },
+    "parent_map_sha256": parent_map_checksum(taxonomy_id_to_parent_id),
+    "pruning": pruning,
+  }
+  manifest["fingerprint"] = manifest_fingerprint(manifest)
+  return manifest
+
+def check_manifest(
+    manifest : Optional[Dict[str, object]],
+    file_directory : str,
+    custom_taxonomy_ids_filename : str,
+    k : int,
+    taxonomy_id_to_parent_id : Dict[str, str],
+    pruning : Optional[Dict[str, object]] = None) -> List[str]:
+  """
+  Check that the database described by manifest was built from the files in file_directory
+  as they are now, by their names, sizes and modification times (nothing is read),
+  and with the same pruning options.
+
+  @return: why the database doesn't match, or an empty list if it does
+  """
+  if manifest is None or manifest.get("format") != MANIFEST_FORMAT:
+    return ["it has no manifest"]
+  if manifest.get("version") != MANIFEST_VERSION:
+    return [f"it has a version {manifest.get('version')} manifest, expected version {MANIFEST_VERSION}"]
+
+  problems = []
+  if manifest["k"] != k:
+    problems.append(f"it was built with k = {manifest['k']}, not k = {k}")
+  if manifest["parent_map_sha256"] != parent_map_checksum(taxonomy_id_to_parent_id):
+    problems.append("it was built with a different taxonomy")
+  if manifest.get("pruning") != pruning:
+    problems.append(f"it was built with pruning {manifest.get('pruning')}, not {pruning}")
+
+  status = os.stat(custom_taxonomy_ids_filename)
+  recorded = manifest["taxonomy_ids_file"]
+  if (status.st_size, status.st_mtime_ns) != (recorded["size"], recorded["mtime_ns"]):
+    problems.append(f"{custom_taxonomy_ids_filename} changed since it was built")
+
+  recorded_files = {f["name"]: f for f in manifest["source_files"] + manifest["skipped_files"]}
+  current_files = set(os.listdir(file_directory))
+  for name in sorted(current_files - set(recorded_files)):
+    problems.append(f"{name} was added to {file_directory} since it was built")
+  for name in sorted(set(recorded_files) - current_files):
+    problems.append(f"{name} was removed from {file_directory} since it was built")
+  for name in sorted(current_files & set(recorded_files)):
+    status = os.stat(os.path.join(file_directory, name))
+    if (status.st_size, status.st_mtime_ns) != (recorded_files[name]["size"], recorded_files[name]["mtime_ns"]):
+      problems.append(f"{name} changed since it was built")
+  return problems
+
+class BlockChecksums:
+  """
+  The CRC-32 of every CHECKSUM_BLOCK_SIZE block of a stream of bytes, computed as it is written.
+  """
+  def __init__(self, block_size : int = CHECKSUM_BLOCK_SIZE):
+    self.block_size = block_size
+    self.checksums : List[int] = []
+    self.crc = 0
+    self.filled = 0
+
+  def update(self, data) -> None:
+    data = memoryview(data).cast('B')
+    while len(data):
+      take = min(len(data), self.block_size - self.filled)
+      self.crc = zlib.crc32(data[:take], self.crc)
+      self.filled += take
+      data = data[take:]
+      if self.filled == self.block_size:
+        self.checksums.append(self.crc)
+        self.crc = 0
+        self.filled = 0
+
+  def finish(self) -> List[int]:
+    if self.filled:
+      self.checksums.append(self.crc)
+      self.crc = 0
+      self.filled = 0
+    return self.checksums
+
+def block_checksum(filename : str, offset : int, length : int) -> int:
+  with open(filename, 'rb') as fp:
+    return zlib.crc32(os.pread(fp.fileno(), length, offset))
+
+def verify_blocks(sections : List[Tuple[str, str, int, int, int, List[int]]], max_workers : Optional[int] = None) -> List[str]:
+  """
+  Recompute the block checksums of file sections in parallel.
+
+  @param sections: (filename, section name, offset, length, block size, expected block checksums) of every section
+  @return: the blocks that don't match, or an empty list if all of them do
+  """
+  problems = []
+  tasks = []
+  for filename, name, offset, length, block_size, checksums in sections:
+    num_blocks = (length + block_size - 1) // block_size
+    if num_blocks != len(checksums):
+      problems.append(f"{filename}: the {name} section has {num_blocks} blocks, but {len(checksums)} checksums")
+      continue
+    for block, checksum in enumerate(checksums):
+      start = block * block_size
+      tasks.append((filename, name, block, checksum, offset + start, min(block_size, length - start)))
+
+  with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+    computed = list(executor.map(lambda task: block_checksum(task[0], task[4], task[5]), tasks))
+  problems.extend(
+    f"{filename}: block {block} of the {name} section is corrupt"
+    for (filename, name, block, checksum, _, _), actual in zip(tasks, computed)
+    if actual != checksum
+  )
+  return problems
@@ -0,0 +1,150 @@
+from typing import Dict, List, Optional
+
+"""
+database_pruning.py
+
+Build-time pruning of k-mers that take up room in the k-mer to LCA database
+(and lookups in the query) but add little to a read's classification:
+
+  - rank pruning: k-mers whose LCA is at or above a chosen rank (e.g. genus), such as the k-mers
+    shared between the E. coli, Shigella and Salmonella genomes that end up at Enterobacteriaceae,
+    or anything merged all the way up to the root '1', which can't tell the taxa apart at that rank
+  - low-complexity pruning: k-mers made of short repeats (homopolymers, di- and trinucleotide
+    repeats, ...), which turn up in many unrelated genomes. A k-mer is low-complexity if its DUST
+    score, the number of pairs of equal triplets among its k - 2 triplets divided by k - 3, is above
+    a threshold (a random k-mer scores about 0.2, a homopolymer (k - 2) / 2)
+
+Low-complexity k-mers are dropped as the references are scanned (the DUST scores of all of the
+k-mers of a run of bases are computed in one pass, updating the triplet counts as the window
+slides), and rank pruning is applied once every k-mer has its final LCA. The number of distinct
+k-mers each filter removed from the database is added to the build stats.
+
+Ranks come from taxonomy_tree.build_rank_map. A taxon without a rank of its own (a strain
+without one, a clade, ...) counts as just below its closest ranked ancestor.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# NCBI ranks from the highest to the lowest
+RANK_ORDER = [
+  "superkingdom", "realm", "kingdom", "subkingdom",
+  "phylum", "subphylum", "class", "subclass",
+  "order", "suborder", "family", "subfamily",
+  "genus", "subgenus", "species group", "species",
+  "subspecies", "serotype", "strain",
+]
+
+def pruning_options(prune_rank : Optional[str], dust_threshold : Optional[float]) -> Optional[Dict[str, object]]:
+  """
+  The pruning options as recorded in the database manifest and the result cache key,
+  or None when nothing is pruned (so unpruned databases keep their fingerprints).
+  """
+  if prune_rank is None and dust_threshold is None:
+    return None
+  return {"prune_rank": prune_rank, "dust_threshold": dust_threshold}
+
+def low_complexity_flags(run : str, k : int, threshold : float) -> List[bool]:
+  """
+  Whether each k-mer of run (a string of at least k bases) is low-complexity,
+  i.e. has a DUST score above threshold.
+  """
+  num_triplets = k - 2
+  if num_triplets < 2:
+    return [False] * (len(run) - k + 1)
+  # compared with the number of pairs of equal triplets, rather than dividing every score
+  limit = threshold * (num_triplets - 1)
+  triplets = [run[i:i + 3] for i in range(len(run) - 2)]
+  counts : Dict[str, int] = {}
+  pairs = 0
+  flags = []
+  for i, triplet in enumerate(triplets):
+    count = counts.get(triplet, 0)
+    pairs += count
+    counts[triplet] = count + 1
+    if i >= num_triplets:
+      # the triplet that just left the window
+      old_triplet = triplets[i - num_triplets]
+      count = counts[old_triplet] - 1
+      counts[old_triplet] = count
+      pairs -= count
+    if i >= num_triplets - 1:
+      flags.append(pairs > limit)
+  return flags
+
+class DatabasePruning:
+  """
+  The pruning applied while building a database.
+
+  @param prune_rank: drop k-mers whose LCA is at or above this rank (one of RANK_ORDER), or None
+  @param dust_threshold: drop k-mers with a DUST score above this, or None
+  """
+  def __init__(
+      self,
+      taxonomy_id_to_parent_id : Dict[str, str],
+      taxonomy_id_to_rank : Dict[str, str],
+      prune_rank : Optional[str] = None,
+      dust_threshold : Optional[float] = None):
+    if prune_rank is not None and prune_rank not in RANK_ORDER:
+      raise ValueError(f"Unknown rank {prune_rank!r}, expected one of {', '.join(RANK_ORDER)}")
+    self.taxonomy_id_to_parent_id = taxonomy_id_to_parent_id
+    self.taxonomy_id_to_rank = taxonomy_id_to_rank
+    self.prune_rank = prune_rank
+    self.dust_threshold = dust_threshold
+    self.levels : Dict[str, float] = {}
+
+  def options(self) -> Optional[Dict[str, object]]:
+    return pruning_options(self.prune_rank, self.dust_threshold)
+
+  def level(self, taxonomy_id : str) -> float:
+    """
+    The position of the taxon's rank in RANK_ORDER, plus a half if it has no rank of its own
+    (-1 for the root and anything else above every ranked taxon).
+    """
+    if taxonomy_id not in self.levels:
+      current = taxonomy_id
+      offset = 0.0
+      level = -1.0
+      while current is not None and current != '1':
+        rank = self.taxonomy_id_to_rank.get(current)
+        if rank in RANK_ORDER:
+          level = RANK_ORDER.index(rank) + offset
+          break
+        offset = 0.5
+        current = self.taxonomy_id_to_parent_id.get(current)
+      self.levels[taxonomy_id] = level
+    return self.levels[taxonomy_id]
+
+  def is_uninformative(self, taxonomy_id : str) -> bool:
+    """
+    Whether k-mers with this LCA are pruned, i.e. it is at or above the prune rank.
+    """
+    return self.prune_rank is not None and self.level(taxonomy_id) <= RANK_ORDER.index(self.prune_rank)
+
+  def low_complexity_flags(self, run : str, k : int) -> Optional[List[bool]]:
+    """
+    Whether each k-mer of run is low-complexity, or None if low-complexity k-mers aren't pruned.
+    """
+    if self.dust_threshold is None:
+      return None
+    return low_complexity_flags(run, k, self.dust_threshold)
+
+  def prune_table(self, kmer_to_lca : Dict[str, str]) -> int:
+    """
+    Delete the k-mers whose LCA is at or above the prune rank from a kmer_to_lca dictionary.
+
+    @return: the number of k-mers deleted
+    """
+    if self.prune_rank is None:
+      return 0
+    uninformative = [kmer for kmer, taxonomy_id in kmer_to_lca.items() if self.is_uninformative(taxonomy_id)]
+    for kmer in uninformative:
+      del kmer_to_lca[kmer]
+    return len(uninformative)
@@ -1,40 +1,81 @@
-def get_kmer_hit_counts_with_database_from_psuedoreads(pseudoreads, kmer_to_lca, kmer_length):
+from kmer_windows import AMBIGUOUS_KMER, count_kmer_windows, split_into_unambiguous_kmers
+
+def get_kmer_lcas_from_psuedoread(pseudoread, kmer_to_lca, kmer_length):
   """
-  Scan through all kmers in the pseudoreads and find which kmers
-  in the reads hit (match exactly with) a kmer in the contaminant database,
-  and count how many times these matches occur.
+  Look up every kmer of the pseudoread in the contaminant database, in order.
 
-  :param pseudoreads: A string representing the pseudoreads.
+  Windows containing a base other than A, C, G or T can never match the database,
+  so they are skipped without a lookup (see kmer_windows.py).
+
+  :param pseudoread: A string representing the pseudoread.
   :param kmer_to_lca: Dictionary mapping k-mers to their LCA taxonomy IDs.
   :param kmer_length: The length of each k-mer.
-  :return: Dictionary of hit counts, mapping taxonomy IDs to counts.
+  :return: List with, for each k-mer position in the pseudoread, the LCA taxonomy ID
+           of that k-mer, None if the k-mer is not in the database, or
+           AMBIGUOUS_KMER if the window was skipped.
   """
-  # Function to split the pseudoreads into k-mers
-  def split_into_kmers(sequence, k):
-      return [sequence[i:i+k] for i in range(len(sequence) - k + 1)]
+  # Split the pseudoreads into k-mers, jumping over the ambiguous windows
+  positions, kmers = split_into_unambiguous_kmers(pseudoread, kmer_length)
 
-  # Split the pseudoreads into k-mers
-  kmers = split_into_kmers(pseudoreads, kmer_length)
-
-  # Initialize a dictionary to count hits for each taxonomy ID
-  hit_counts = {}
-
-  # Iterate over each k-mer in the pseudoreads
-  for kmer in kmers:
-      # Check if the k-mer is in the contaminant database
-      if kmer in kmer_to_lca:          
+  # Databases persisted on disk (see kmer_database.py) can look up all of
+  # the k-mers of the read at once, which is much cheaper than one by one
+  if hasattr(kmer_to_lca, "lookup_many"):
+      lookups = kmer_to_lca.lookup_many(kmers)
+  else:
+      # Iterate over each k-mer in the pseudoreads
+      lookups = []
+      for kmer in kmers:
+          # Check if the k-mer is in the contaminant database
+          lca_node_taxonomy_id = kmer_to_lca.get(kmer)
           # TODO: Maybe fix the 0th index here in case of ties
           # Get the LCA taxonomy ID for this k-mer
           #   lca_node_taxonomy_id = kmer_to_lca[kmer][0]
-          if type(kmer_to_lca[kmer]) != str:
-              continue
-          lca_node_taxonomy_id = kmer_to_lca[kmer]
+          if type(lca_node_taxonomy_id) != str:
+              lca_node_taxonomy_id = None
+          lookups.append(lca_node_taxonomy_id)
 
-          # Increment the hit count for this taxonomy ID
-          if lca_node_taxonomy_id in hit_counts:
-              hit_counts[lca_node_taxonomy_id] += 1
-          else:
-              hit_counts[lca_node_taxonomy_id] = 1
+  num_windows = count_kmer_windows(pseudoread, kmer_length)
+  if len(kmers) == num_windows:
+      # no ambiguous bases, which is the common case
+      return lookups
+
+  # Put the lookups back at their positions among the skipped windows
+  kmer_lcas = [AMBIGUOUS_KMER] * num_windows
+  for position, lca_node_taxonomy_id in zip(positions, lookups):
+      kmer_lcas[position] = lca_node_taxonomy_id
+  return kmer_lcas
+
+def count_kmer_hits(kmer_lcas):
+  """
+  Count how many times each taxonomy ID was hit in a list of k-mer LCAs
+  (as returned by get_kmer_lcas_from_psuedoread).
+
+  :param kmer_lcas: List of LCA taxonomy IDs (or None for misses, AMBIGUOUS_KMER for skipped windows).
+  :return: Dictionary of hit counts, mapping taxonomy IDs to counts, in order of first hit.
+  """
+  # Initialize a dictionary to count hits for each taxonomy ID
+  hit_counts = {}
+
+  for lca_node_taxonomy_id in kmer_lcas:
+      if lca_node_taxonomy_id is None or lca_node_taxonomy_id == AMBIGUOUS_KMER:
+          continue
+      # Increment the hit count for this taxonomy ID
+      if lca_node_taxonomy_id in hit_counts:
+          hit_counts[lca_node_taxonomy_id] += 1
+      else:
+          hit_counts[lca_node_taxonomy_id] = 1
 
   return hit_counts
 
+def get_kmer_hit_counts_with_database_from_psuedoreads(pseudoreads, kmer_to_lca, kmer_length):
+  """
+  Scan through all kmers in the pseudoreads and find which kmers
+  in the reads hit (match exactly with) a kmer in the contaminant database,
+  and count how many times these matches occur.
+
+  :param pseudoreads: A string representing the pseudoreads.
+  :param kmer_to_lca: Dictionary mapping k-mers to their LCA taxonomy IDs.
+  :param kmer_length: The length of each k-mer.
+  :return: Dictionary of hit counts, mapping taxonomy IDs to counts.
+  """
+  return count_kmer_hits(get_kmer_lcas_from_psuedoread(pseudoreads, kmer_to_lca, kmer_length))
@@ -0,0 +1,96 @@
+from typing import Set
+
+# helper files
+import pseudoreads
+from kmer_windows import iter_unambiguous_runs
+
+"""
+host_depletion.py
+
+Host (expected genome) depletion before the contaminant classification.
+
+Most of every query is the organism that was sequenced (e.g. SARS-CoV-2 in covid-assemblies/),
+and every one of its pseudoreads would otherwise have all of its k-mers looked up in the
+contaminant database and its hits counted, only to be classified as that organism. With a
+host genome (e.g. the SARS-CoV-2 reference genome), a small index of its own k-mers is built,
+and every pseudoread is first checked against it:
+
+  - only every stride-th k-mer of the pseudoread is looked up (in a set, with no LCAs or hit counts)
+  - if at least the threshold fraction of them are host k-mers, the pseudoread clearly is the
+    host: it is depleted, and never reaches the contaminant database
+  - otherwise (a contaminant, a host read with too many variants, or a pseudoread that runs
+    across the boundary of a contaminating segment) it is classified as usual
+
+The check stops as soon as the outcome is certain, so a host pseudoread of 100 bases costs
+about (100 - k + 1) / stride * threshold set lookups, and a contaminant one only a few.
+
+Depleted pseudoreads are counted, and written to the per-read output as unclassified, with
+H (for host) in place of their k-mer LCAs (see classification_output.py).
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# What the k-mers of a depleted pseudoread are recorded as in its list of k-mer LCAs
+HOST_KMER = "H"
+
+# Fraction of the k-mers checked that have to be host k-mers for a pseudoread to be depleted
+DEFAULT_THRESHOLD = 0.5
+
+# Every how many k-mers of a pseudoread one is checked
+DEFAULT_STRIDE = 4
+
+class HostFilter:
+  """
+  Recognizes the pseudoreads of the host genome, by the fraction of their k-mers in it
+  (see the top of this file).
+  """
+  def __init__(self, host_kmers : Set[str], k : int, threshold : float = DEFAULT_THRESHOLD, stride : int = DEFAULT_STRIDE):
+    self.host_kmers = host_kmers
+    self.k = k
+    self.threshold = threshold
+    self.stride = max(1, stride)
+
+  def is_host(self, pseudoread : str) -> bool:
+    """
+    Whether the pseudoread is depleted as the host's.
+    """
+    positions = range(0, len(pseudoread) - self.k + 1, self.stride)
+    num_needed = self.threshold * len(positions)
+    if not positions:
+      return False
+    num_hits = 0
+    for num_checked, position in enumerate(positions):
+      if num_hits >= num_needed:
+        return True
+      # even if every k-mer left is a host k-mer
+      if num_hits + len(positions) - num_checked < num_needed:
+        return False
+      if pseudoread[position:position + self.k] in self.host_kmers:
+        num_hits += 1
+    return num_hits >= num_needed
+
+  def __len__(self) -> int:
+    return len(self.host_kmers)
+
+def build_host_filter(
+    host_filename : str,
+    k : int,
+    threshold : float = DEFAULT_THRESHOLD,
+    stride : int = DEFAULT_STRIDE) -> HostFilter:
+  """
+  Index the k-mers of every sequence of the host genome FASTA file (gzip compressed if it ends in .gz),
+  leaving out the ones with ambiguous bases, which no pseudoread k-mer can match either.
+  """
+  host_kmers : Set[str] = set()
+  sequence = "".join(pseudoreads.iter_fasta_blocks(host_filename))
+  for start, end in iter_unambiguous_runs(sequence, k):
+    host_kmers.update(sequence[i:i + k] for i in range(start, end - k + 1))
+  return HostFilter(host_kmers, k, threshold, stride)
@@ -0,0 +1,975 @@
+import os
+import sys
+import json
+import mmap
+import shutil
+import struct
+import tempfile
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# helper files
+import kmer_to_lca_mapping
+import database_manifest
+import database_checkpoint
+import progress
+from kmer_windows import count_kmer_windows, iter_unambiguous_runs
+
+"""
+kmer_database.py
+
+A persisted, read-only k-mer to LCA database (the "index"), and a memory-budgeted
+external-memory build for it.
+
+The in-memory build in kmer_to_lca_mapping.py keeps the whole kmer_to_lca dictionary
+in RAM while it is being built, which caps the reference set at whatever fits in memory
+(see the MemoryError notes in the README). build_database_external instead
+
+  1.) streams every reference genome once, in blocks sized to a fraction of the budget,
+      encodes each k-mer as a 2-bit-per-base integer, and appends it to an on-disk bucket
+      chosen by the k-mer's prefix (its first few bases), flushing the in-memory bucket
+      buffers whenever they reach another fraction of the budget
+  2.) loads one bucket at a time, LCA-reduces the k-mers that occur more than once in it,
+      and sorts it
+  3.) appends the sorted buckets, in prefix order, to the final index file, which is
+      therefore sorted as a whole
+
+so that the peak memory is bounded by the size of the largest bucket rather than by
+the size of the whole table. The number of buckets is picked from the total size of
+the reference genomes and the memory budget. Given a checkpoint directory, the build commits
+a checkpoint after every reference of pass 1 and every bucket of pass 2, and a killed build
+started again resumes from the last one (see database_checkpoint.py).
+
+K-mers containing a base other than A, C, G or T can't be 2-bit encoded and are left out,
+just like in the in-memory build (see kmer_windows.py). Both builds can also prune
+low-complexity k-mers and k-mers whose LCA is too high up the taxonomy (see database_pruning.py).
+The external build still writes the low-complexity k-mers to their buckets, in runs of their
+own, and counts the distinct ones as it reduces each bucket, rather than keeping them all in memory.
+
+Index file layout (all integers little endian):
+
+  header      magic, version, k, number of k-mers, the offsets of the sections below
+              and the fingerprint of the database (see database_manifest.py)
+  kmers       the encoded k-mers, sorted, as uint64
+  taxa        for each k-mer, the index of its LCA in the taxonomy id list, as uint32
+  metadata    JSON, including the taxonomy id list, the number of k-mers per taxon,
+              the CRC-32 of every block of the kmers and taxa sections and the database manifest
+
+An index can also be split into shards by k-mer prefix (shard_kmer_index), where every
+shard is itself a complete index file holding the k-mers with one prefix, listed in a small
+manifest.json next to them. ShardedKmerIndex then only maps the shards that a query's k-mers
+actually fall in, keeping a bounded number of them open (least recently used first out),
+so a small query against a large database only touches a small part of it. Since every shard
+is self-contained, different shards could also be served by different processes.
+
+How to run
+----------
+
+$ python3 src/main.py --input-query covid-assemblies/covid-assembly-1.txt --max-memory 500M
+
+Otherwise, this script is designed to be part of the larger program in main.py.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+INDEX_MAGIC = b"KMERLCA\0"
+INDEX_VERSION = 2
+# magic, version, k, number of kmers, kmers offset, taxa offset, metadata offset, metadata length, fingerprint
+INDEX_HEADER = struct.Struct("<8sIIQQQQQ32s")
+# sections are aligned to this many bytes so they can later be used in place
+INDEX_ALIGNMENT = 64
+# the kmers section starts after the header, at the next alignment boundary
+INDEX_KMERS_OFFSET = -(-INDEX_HEADER.size // INDEX_ALIGNMENT) * INDEX_ALIGNMENT
+
+# 2-bit encoding of the bases, so a k-mer with k <= 32 fits in a uint64
+KMER_ENCODING = "2bit-ACGT"
+MAX_K = 32
+BASES_TO_DIGITS = str.maketrans("ACGT", "0123")
+DIGITS_TO_BASES = str.maketrans("0123", "ACGT")
+
+# Number of bases read from a reference genome at once while streaming it
+# (at most, the external build reads smaller blocks under a smaller memory budget)
+STREAM_BLOCK_SIZE = 1 << 20
+
+# Rough number of bytes of memory used per k-mer when a bucket is LCA-reduced
+# in a dictionary (the dict slot, the int key, and the key in the set of the current run)
+BYTES_PER_REDUCED_KMER = 160
+# Number of bytes of memory per k-mer in the in-memory bucket buffers (uint64 arrays)
+BYTES_PER_BUFFERED_KMER = 8
+# Rough number of bytes of memory used per base of a block of a reference while its k-mers are
+# encoded, sorted and split into the bucket buffers (the block and its translated runs, the int
+# objects of its k-mers and the list of them, and the sort's and the buckets' slices), and with
+# low-complexity pruning (which also keeps every triplet of a run and a flag per k-mer)
+BYTES_PER_BLOCK_BASE = 64
+BYTES_PER_PRUNED_BLOCK_BASE = 128
+# Most buckets we will ever partition into (4 ** 8, i.e. prefixes of 8 bases)
+MAX_BUCKETS = 4 ** 8
+
+# Each run in a bucket file is a (taxon index, number of kmers) header then the kmers
+BUCKET_RUN_HEADER = struct.Struct("<IQ")
+# The taxon index of the runs of low-complexity kmers left out of a pruned build, which go
+# to their buckets too, so that the distinct ones can be counted one bucket at a time
+LOW_COMPLEXITY_TAXON_INDEX = 2 ** 32 - 1
+
+# Name of the manifest file listing the shards of a sharded index
+SHARD_MANIFEST_FILENAME = "manifest.json"
+SHARD_MANIFEST_FORMAT = "sharded-kmer-index"
+
+def parse_memory_size(size : str) -> int:
+  """
+  Parse a memory size such as '512M', '4G' or '1000000' into bytes (using powers of 1024).
+  """
+  multipliers = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+  size = size.strip().upper().rstrip('B').rstrip('I')
+  if size and size[-1] in multipliers:
+    return int(float(size[:-1]) * multipliers[size[-1]])
+  return int(size)
+
+def encode_kmer(kmer : str) -> Optional[int]:
+  """
+  Encode a k-mer as an integer with 2 bits per base (A=0, C=1, G=2, T=3),
+  or return None if it contains anything other than A, C, G or T.
+  """
+  try:
+    return int(kmer.translate(BASES_TO_DIGITS), 4)
+  except ValueError:
+    return None
+
+def decode_kmer(code : int, k : int) -> str:
+  """
+  Inverse of encode_kmer.
+  """
+  digits = []
+  for _ in range(k):
+    digits.append(str(code & 3))
+    code >>= 2
+  return "".join(reversed(digits)).translate(DIGITS_TO_BASES)
+
+def iter_reference_blocks(reference_genome_assembly, k : int, block_size : int = STREAM_BLOCK_SIZE) -> Iterator[Tuple[str, int]]:
+  """
+  Stream the sequence lines of an open FASTA file (whose header line has already been read)
+  in blocks of about block_size bases, where consecutive blocks overlap by k - 1 bases so that
+  every k-mer of the sequence is in exactly one block.
+
+  Yields each block with the number of bytes of the file read for it (newlines and any
+  further header lines included), so the blocks' sizes add up to the rest of the file.
+  """
+  carry = ""
+  lines : List[str] = []
+  num_bases = 0
+  num_bytes = 0
+  for line in reference_genome_assembly:
+    num_bytes += len(line)
+    if line.startswith(">"):
+      # Skip header lines in FASTA format
+      continue
+    line = line.strip()
+    lines.append(line)
+    num_bases += len(line)
+    if num_bases >= block_size:
+      block = carry + "".join(lines)
+      yield block, num_bytes
+      carry = block[len(block) - k + 1:] if k > 1 else ""
+      lines = []
+      num_bases = 0
+      num_bytes = 0
+  if lines or num_bytes:
+    yield carry + "".join(lines), num_bytes
+
+def iter_encoded_kmers(block : str, k : int, pruning = None, low_complexity_kmers : Optional[List[int]] = None) -> Iterator[List[int]]:
+  """
+  Yield, for every run of at least k unambiguous bases (A, C, G, T) in block,
+  the list of encoded k-mers of that run.
+
+  With a database_pruning.DatabasePruning, the low-complexity k-mers are left out
+  of the lists and appended to the low_complexity_kmers list instead.
+  """
+  for start, end in iter_unambiguous_runs(block, k):
+    run = block[start:end].translate(BASES_TO_DIGITS)
+    kmers = [int(run[i:i + k], 4) for i in range(len(run) - k + 1)]
+    low_complexity = pruning.low_complexity_flags(block[start:end], k) if pruning else None
+    if low_complexity and any(low_complexity):
+      low_complexity_kmers.extend(kmer for kmer, flag in zip(kmers, low_complexity) if flag)
+      kmers = [kmer for kmer, flag in zip(kmers, low_complexity) if not flag]
+    yield kmers
+
+def choose_prefix_length(total_reference_bytes : int, k : int, max_memory : int) -> int:
+  """
+  Pick the number of prefix bases to partition by, so that one bucket of the
+  (at most total_reference_bytes) kmers can be reduced within half the memory budget.
+  """
+  bucket_budget = max(1, max_memory // 2)
+  prefix_length = 0
+  while (total_reference_bytes * BYTES_PER_REDUCED_KMER) // (4 ** prefix_length) > bucket_budget and \
+        4 ** (prefix_length + 1) <= MAX_BUCKETS and prefix_length + 1 <= k:
+    prefix_length += 1
+  return prefix_length
+
+class KmerIndexWriter:
+  """
+  Writes an index file from sorted (kmer, taxon index) batches, appended in increasing kmer order.
+
+  The kmers section is written directly into the index file, and the taxa section
+  into a temporary file that is appended at close, so nothing has to be kept in memory.
+  The block checksums and the number of kmers per taxon are computed along the way.
+
+  @param fingerprint: the fingerprint of the database (a SHA-256 hex digest) to write in the header
+  """
+  def __init__(self, index_filename : str, k : int, fingerprint : Optional[str] = None):
+    self.index_filename = index_filename
+    self.k = k
+    self.fingerprint = bytes.fromhex(fingerprint) if fingerprint else bytes(32)
+    self.num_kmers = 0
+    self.taxon_counts : Counter = Counter()
+    self.kmers_checksums = database_manifest.BlockChecksums()
+    self.taxa_checksums = database_manifest.BlockChecksums()
+    self.fp = open(index_filename + ".tmp", 'wb')
+    self.fp.write(b"\0" * INDEX_KMERS_OFFSET)
+    self.taxa_fp = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(index_filename)))
+
+  def add(self, kmers : array, taxon_indices : array) -> None:
+    kmers.tofile(self.fp)
+    taxon_indices.tofile(self.taxa_fp)
+    self.kmers_checksums.update(kmers)
+    self.taxon_counts.update(taxon_indices)
+    self.num_kmers += len(kmers)
+
+  def pad(self) -> None:
+    self.fp.write(b"\0" * (-self.fp.tell() % INDEX_ALIGNMENT))
+
+  def close(self, metadata : Dict[str, object]) -> None:
+    """
+    Append the taxa and metadata sections, write the header,
+    and move the finished file into place.
+
+    @param metadata: must include the taxonomy id list, the kmers per taxon and block checksums are added to it
+    """
+    self.pad()
+    taxa_offset = self.fp.tell()
+    self.taxa_fp.seek(0)
+    for block in iter(lambda: self.taxa_fp.read(STREAM_BLOCK_SIZE), b""):
+      self.fp.write(block)
+      self.taxa_checksums.update(block)
+    self.taxa_fp.close()
+    self.pad()
+    metadata_offset = self.fp.tell()
+    if sys.byteorder != "little":
+      # the taxon indices were byteswapped before they were added
+      self.taxon_counts = Counter({
+        int.from_bytes(taxon_index.to_bytes(4, "little"), "big"): count for taxon_index, count in self.taxon_counts.items()
+      })
+    metadata = dict(metadata)
+    metadata["kmers_per_taxon"] = {
+      metadata["taxonomy_ids"][taxon_index]: count for taxon_index, count in sorted(self.taxon_counts.items())
+    }
+    metadata["block_checksums"] = {
+      "block_size": database_manifest.CHECKSUM_BLOCK_SIZE,
+      "kmers": self.kmers_checksums.finish(),
+      "taxa": self.taxa_checksums.finish(),
+    }
+    encoded_metadata = json.dumps(metadata, sort_keys=True).encode()
+    self.fp.write(encoded_metadata)
+    self.fp.seek(0)
+    self.fp.write(INDEX_HEADER.pack(
+      INDEX_MAGIC, INDEX_VERSION, self.k, self.num_kmers,
+      INDEX_KMERS_OFFSET, taxa_offset, metadata_offset, len(encoded_metadata), self.fingerprint
+    ))
+    self.fp.close()
+    # only a complete index ever appears under the final name
+    os.replace(self.index_filename + ".tmp", self.index_filename)
+
+class KmerIndex:
+  """
+  A read-only k-mer to LCA database loaded from an index file.
+
+  Supports the same lookups as the kmer_to_lca dictionary built by
+  kmer_to_lca_mapping.build_database, i.e. `kmer in index` and `index[kmer]`
+  (which returns the LCA taxonomy id as a string), so it can be passed anywhere
+  that dictionary is used.
+  """
+  def __init__(self, k : int, kmers, taxon_indices, taxonomy_ids : List[str], metadata : Dict[str, object], fingerprint : Optional[str] = None):
+    self.k = k
+    # the fingerprint of the database in the header, if it has one
+    self.fingerprint = fingerprint
+    # arrays, or memoryviews of a memory mapped index file
+    self.kmers = kmers
+    self.taxon_indices = taxon_indices
+    self.taxonomy_ids = taxonomy_ids
+    self.metadata = metadata
+
+  def find_code(self, code : int) -> int:
+    """
+    Position of the encoded kmer in the sorted kmers, or -1 if it is not in the index.
+    """
+    position = bisect_left(self.kmers, code)
+    if position < len(self.kmers) and self.kmers[position] == code:
+      return position
+    return -1
+
+  def find(self, kmer : str) -> int:
+    """
+    Position of kmer in the sorted kmers, or -1 if it is not in the index.
+    """
+    code = encode_kmer(kmer) if len(kmer) == self.k else None
+    if code is None:
+      return -1
+    return self.find_code(code)
+
+  def get(self, kmer : str, default : Optional[str] = None) -> Optional[str]:
+    position = self.find(kmer)
+    return self.taxonomy_ids[self.taxon_indices[position]] if position >= 0 else default
+
+  def __contains__(self, kmer : str) -> bool:
+    return self.find(kmer) >= 0
+
+  def __getitem__(self, kmer : str) -> str:
+    position = self.find(kmer)
+    if position < 0:
+      raise KeyError(kmer)
+    return self.taxonomy_ids[self.taxon_indices[position]]
+
+  def __len__(self) -> int:
+    return len(self.kmers)
+
+  def lookup_many(self, kmers : List[str]) -> List[Optional[str]]:
+    """
+    The LCA taxonomy id of each of the kmers, or None for those not in the index.
+    """
+    return [self.get(kmer) for kmer in kmers]
+
+def read_index_header(fp) -> Tuple[int, int, int, int, int, int, Optional[str]]:
+  """
+  Read and check the header of an open index file.
+
+  @return: k, number of kmers, kmers offset, taxa offset, metadata offset, metadata length
+    and the database fingerprint (or None if it has none)
+  """
+  header = fp.read(INDEX_HEADER.size)
+  if len(header) != INDEX_HEADER.size:
+    raise ValueError(f"{fp.name} is too short to be a k-mer index")
+  magic, version, k, num_kmers, kmers_offset, taxa_offset, metadata_offset, metadata_length, fingerprint = \
+    INDEX_HEADER.unpack(header)
+  if magic != INDEX_MAGIC:
+    raise ValueError(f"{fp.name} is not a k-mer index")
+  if version != INDEX_VERSION:
+    raise ValueError(f"{fp.name} is a version {version} k-mer index, expected version {INDEX_VERSION}")
+  fingerprint = fingerprint.hex() if any(fingerprint) else None
+  return k, num_kmers, kmers_offset, taxa_offset, metadata_offset, metadata_length, fingerprint
+
+def read_index_metadata(index_filename : str) -> Dict[str, object]:
+  """
+  Read only the header and metadata of an index file (not its kmers or taxa),
+  e.g. to check its manifest.
+  """
+  with open(index_filename, 'rb') as fp:
+    _, _, _, _, metadata_offset, metadata_length, _ = read_index_header(fp)
+    fp.seek(metadata_offset)
+    return json.loads(fp.read(metadata_length))
+
+def load_kmer_index(index_filename : str, use_mmap : bool = False, expected_fingerprint : Optional[str] = None) -> KmerIndex:
+  """
+  Load an index file written by build_database_external into memory.
+
+  With use_mmap, the file is memory mapped instead of read, so loading is
+  immediate and only the pages that lookups touch are ever read from disk
+  (and they are shared between processes mapping the same file).
+
+  With expected_fingerprint, an index whose header has a different database
+  fingerprint is rejected before anything else is read.
+  """
+  with open(index_filename, 'rb') as fp:
+    k, num_kmers, kmers_offset, taxa_offset, metadata_offset, metadata_length, fingerprint = read_index_header(fp)
+    if expected_fingerprint is not None and fingerprint != expected_fingerprint:
+      raise ValueError(f"{index_filename} belongs to a different database (fingerprint {fingerprint}, expected {expected_fingerprint})")
+    fp.seek(metadata_offset)
+    metadata = json.loads(fp.read(metadata_length))
+    if use_mmap and sys.byteorder == "little":
+      if num_kmers == 0:
+        return KmerIndex(k, array('Q'), array('I'), metadata["taxonomy_ids"], metadata, fingerprint)
+      mapped = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+      kmers = mapped[kmers_offset:kmers_offset + 8 * num_kmers].cast('Q')
+      taxon_indices = mapped[taxa_offset:taxa_offset + 4 * num_kmers].cast('I')
+      return KmerIndex(k, kmers, taxon_indices, metadata["taxonomy_ids"], metadata, fingerprint)
+    kmers = array('Q')
+    fp.seek(kmers_offset)
+    kmers.fromfile(fp, num_kmers)
+    taxon_indices = array('I')
+    fp.seek(taxa_offset)
+    taxon_indices.fromfile(fp, num_kmers)
+  if sys.byteorder != "little":
+    kmers.byteswap()
+    taxon_indices.byteswap()
+  return KmerIndex(k, kmers, taxon_indices, metadata["taxonomy_ids"], metadata, fingerprint)
+
+def index_checksum_sections(index_filename : str) -> List[Tuple[str, str, int, int, int, List[int]]]:
+  """
+  The sections of an index file and their block checksums, as database_manifest.verify_blocks takes them.
+  """
+  with open(index_filename, 'rb') as fp:
+    _, num_kmers, kmers_offset, taxa_offset, metadata_offset, metadata_length, _ = read_index_header(fp)
+    fp.seek(metadata_offset)
+    metadata = json.loads(fp.read(metadata_length))
+  checksums = metadata.get("block_checksums")
+  if checksums is None:
+    raise ValueError(f"{index_filename} has no block checksums")
+  return [
+    (index_filename, "kmers", kmers_offset, 8 * num_kmers, checksums["block_size"], checksums["kmers"]),
+    (index_filename, "taxa", taxa_offset, 4 * num_kmers, checksums["block_size"], checksums["taxa"]),
+  ]
+
+def verify_kmer_index(index_filename : str, max_workers : Optional[int] = None) -> List[str]:
+  """
+  Deep verify an index file: recompute the checksum of every block of its kmers and taxa
+  sections, in parallel (see database_manifest.py).
+
+  @return: the problems found, or an empty list if there are none
+  """
+  return database_manifest.verify_blocks(index_checksum_sections(index_filename), max_workers)
+
+class TaxonTable:
+  """
+  Maps taxonomy ids to small integer indices (and back), and computes LCAs
+  of taxon indices with a cache, since the same pairs come up over and over.
+  """
+  def __init__(self, taxonomy_id_to_parent_id : Dict[str, str]):
+    self.taxonomy_id_to_parent_id = taxonomy_id_to_parent_id
+    self.taxonomy_ids : List[str] = []
+    self.taxonomy_id_to_index : Dict[str, int] = {}
+    self.lca_cache : Dict[Tuple[int, int], int] = {}
+    self.lca_calls = 0
+
+  def index(self, taxonomy_id : str) -> int:
+    if taxonomy_id not in self.taxonomy_id_to_index:
+      self.taxonomy_id_to_index[taxonomy_id] = len(self.taxonomy_ids)
+      self.taxonomy_ids.append(taxonomy_id)
+    return self.taxonomy_id_to_index[taxonomy_id]
+
+  def lca(self, first_index : int, second_index : int) -> int:
+    self.lca_calls += 1
+    key = (first_index, second_index) if first_index < second_index else (second_index, first_index)
+    if key not in self.lca_cache:
+      self.lca_cache[key] = self.index(kmer_to_lca_mapping.lca(
+        self.taxonomy_id_to_parent_id, self.taxonomy_ids[first_index], self.taxonomy_ids[second_index]
+      ))
+    return self.lca_cache[key]
+
+def list_reference_files(file_directory : str, ncbi_accession_id_to_tax_id : Dict[str, str]) -> List[Tuple[str, str, str]]:
+  """
+  The reference genome FASTA files in file_directory whose accession id is in the
+  accession id to taxonomy id mapping, in sorted filename order.
+
+  @return: a list of (file path, accession id, taxonomy id)
+  """
+  reference_files = []
+  for f in sorted(os.listdir(file_directory)):
+    file_path = os.path.join(file_directory, f)
+    with open(file_path, 'r') as fp:
+      accession_id = fp.readline().split()[0][1:]
+    if accession_id in ncbi_accession_id_to_tax_id:
+      reference_files.append((file_path, accession_id, ncbi_accession_id_to_tax_id[accession_id]))
+  return reference_files
+
+def reduce_bucket(bucket_filename : str, taxa : TaxonTable) -> Tuple[Dict[int, int], int]:
+  """
+  Read the runs of one bucket file and LCA-reduce them into a kmer -> taxon index dictionary.
+
+  @return: the dictionary, and the number of distinct low-complexity kmers left out of the bucket
+  """
+  table : Dict[int, int] = {}
+  low_complexity_kmers : set = set()
+  with open(bucket_filename, 'rb') as fp:
+    while True:
+      run_header = fp.read(BUCKET_RUN_HEADER.size)
+      if not run_header:
+        break
+      taxon_index, num_kmers = BUCKET_RUN_HEADER.unpack(run_header)
+      kmers = array('Q')
+      kmers.fromfile(fp, num_kmers)
+      if taxon_index == LOW_COMPLEXITY_TAXON_INDEX:
+        # a low-complexity kmer is low-complexity wherever it occurs, so never in the table
+        low_complexity_kmers.update(kmers)
+        continue
+      run = set(kmers)
+      del kmers
+      # kmers already seen in an earlier run need their LCA updated,
+      # all the others can be inserted in one go
+      seen_before = run.intersection(table)
+      for kmer in seen_before:
+        if table[kmer] != taxon_index:
+          table[kmer] = taxa.lca(table[kmer], taxon_index)
+      run.difference_update(seen_before)
+      table.update(dict.fromkeys(run, taxon_index))
+  return table, len(low_complexity_kmers)
+
+def reduce_sorted_bucket(bucket_filename : str, taxa : TaxonTable, pruning = None) -> Tuple[array, array, int, int]:
+  """
+  LCA-reduce one bucket file (see reduce_bucket), leave out the kmers whose LCA is at or above
+  the prune rank, if any, and sort it.
+
+  @return: the sorted kmers, their taxon indices, the number of kmers pruned by rank
+           and the number of distinct low-complexity kmers left out
+  """
+  table, num_low_complexity = reduce_bucket(bucket_filename, taxa)
+  num_pruned = 0
+  if pruning is not None and pruning.prune_rank is not None:
+    # every kmer has its final LCA once its bucket is reduced
+    uninformative = [kmer for kmer, taxon_index in table.items() if pruning.is_uninformative(taxa.taxonomy_ids[taxon_index])]
+    for kmer in uninformative:
+      del table[kmer]
+    num_pruned = len(uninformative)
+  kmers = array('Q', sorted(table))
+  taxon_indices = array('I', map(table.__getitem__, kmers))
+  return kmers, taxon_indices, num_pruned, num_low_complexity
+
+def build_database_external(
+    file_directory : str,
+    custom_taxonomy_ids_filename : str,
+    k : int,
+    taxonomy_id_to_parent_id : Dict[str, str],
+    index_filename : str,
+    max_memory : int,
+    temporary_directory : Optional[str] = None,
+    stats : Dict[str, int] = None,
+    manifest : Optional[Dict[str, object]] = None,
+    pruning = None,
+    checkpoint_directory : Optional[str] = None) -> None:
+  """
+  Build the same k-mer to LCA database as kmer_to_lca_mapping.build_database
+  (minus the k-mers containing non-ACGT bases), but in bounded memory,
+  partitioning the k-mers by prefix into on-disk buckets (see the top of this file),
+  and write it to index_filename.
+
+  @param max_memory: the approximate memory budget of the build, in bytes
+  @param temporary_directory: where to put the buckets (default: next to index_filename)
+  @param stats: if given, counts of references, bases, kmers and LCA calls are added to it
+  @param manifest: if given, the database manifest (see database_manifest.py) to store in the index
+  @param pruning: if given, the database_pruning.DatabasePruning to apply, low-complexity kmers
+    while partitioning and the prune rank while reducing the buckets
+  @param checkpoint_directory: if given, where to keep the buckets and checkpoints of the build, so that
+    the same build started again after being killed resumes from its last checkpoint (see database_checkpoint.py)
+  """
+  if k > MAX_K:
+    raise ValueError(f"k = {k} is too long for the 2-bit encoded index, the maximum is {MAX_K}")
+  if stats is None:
+    stats = {}
+
+  ncbi_accession_id_to_tax_id = kmer_to_lca_mapping.make_ncbi_accession_id_to_tax_id_mapping(
+    custom_taxonomy_ids_filename
+  )
+  reference_files = list_reference_files(file_directory, ncbi_accession_id_to_tax_id)
+  stats["references_skipped"] = stats.get("references_skipped", 0) + len(os.listdir(file_directory)) - len(reference_files)
+  used_filenames = {os.path.basename(file_path) for file_path, _, _ in reference_files}
+  for f in sorted(set(os.listdir(file_directory)) - used_filenames):
+    print(f"Warning: skipped {f}, its accession id is not in {custom_taxonomy_ids_filename}", file=sys.stderr)
+
+  total_reference_bytes = sum(os.path.getsize(file_path) for file_path, _, _ in reference_files)
+  prefix_length = choose_prefix_length(total_reference_bytes, k, max_memory)
+  num_buckets = 4 ** prefix_length
+  shift = 2 * (k - prefix_length)
+  # the rest of the budget goes to the buffers of kmers waiting to be written to their bucket,
+  # and, while there is no bucket being reduced, to the block of a reference being partitioned
+  buffer_capacity = max(1, (max_memory // 2) // BYTES_PER_BUFFERED_KMER)
+  bytes_per_block_base = BYTES_PER_PRUNED_BLOCK_BASE if pruning is not None and pruning.dust_threshold is not None else BYTES_PER_BLOCK_BASE
+  block_size = max(k, min(STREAM_BLOCK_SIZE, (max_memory // 2) // bytes_per_block_base))
+  print(f"Building K-mer to LCA index {index_filename} in {num_buckets} buckets "
+        f"(prefixes of {prefix_length} bases) within {max_memory} bytes of memory")
+
+  checkpoint = None
+  state = None
+  if checkpoint_directory:
+    # everything that decides what the buckets (and the taxon indices) hold
+    checkpoint = database_checkpoint.BuildCheckpoint(checkpoint_directory, {
+      "fingerprint": manifest["fingerprint"] if manifest else None,
+      "k": k,
+      "reference_files": [
+        [os.path.basename(file_path), os.path.getsize(file_path), os.stat(file_path).st_mtime_ns, tax_id]
+        for file_path, _, tax_id in reference_files
+      ],
+      "pruning": pruning.options() if pruning else None,
+      "prefix_length": prefix_length,
+      "buffer_capacity": buffer_capacity,
+      "block_size": block_size,
+    })
+    bucket_directory = checkpoint_directory
+    state = checkpoint.load()
+  else:
+    bucket_directory = tempfile.mkdtemp(
+      prefix="kmer-buckets-", dir=temporary_directory or os.path.dirname(os.path.abspath(index_filename))
+    )
+  bucket_filenames = [os.path.join(bucket_directory, f"bucket-{b:06d}") for b in range(num_buckets)]
+  taxa = TaxonTable(taxonomy_id_to_parent_id)
+  # how far a checkpointed build got: the references partitioned and the buckets reduced
+  num_references_done = 0
+  num_buckets_done = 0
+  num_rank_pruned = 0
+  num_low_complexity_pruned = 0
+  if state is not None:
+    num_references_done = state["references_done"]
+    num_buckets_done = state["buckets_reduced"]
+    num_rank_pruned = state["rank_kmers_pruned"]
+    num_low_complexity_pruned = state["low_complexity_kmers_pruned"]
+    for taxonomy_id in state["taxonomy_ids"]:
+      taxa.index(taxonomy_id)
+    taxa.lca_calls = state["lca_calls"]
+    stats.update(state["stats"])
+    if num_buckets_done == 0:
+      # whatever the reference after the last checkpoint appended is partitioned again
+      checkpoint.truncate_buckets(bucket_filenames, state["bucket_sizes"])
+    for bucket_filename in bucket_filenames[:num_buckets_done]:
+      if os.path.exists(bucket_filename):
+        os.remove(bucket_filename)
+    print(f"Resuming from the checkpoint in {checkpoint_directory}: {num_references_done} of {len(reference_files)} "
+          f"references partitioned, {num_buckets_done} of {num_buckets} buckets reduced")
+
+  def save_checkpoint():
+    checkpoint.save({
+      "references_done": num_references_done,
+      "buckets_reduced": num_buckets_done,
+      "bucket_sizes": checkpoint.bucket_sizes(bucket_filenames) if num_buckets_done == 0 else {},
+      "taxonomy_ids": taxa.taxonomy_ids,
+      "lca_calls": taxa.lca_calls,
+      "rank_kmers_pruned": num_rank_pruned,
+      "low_complexity_kmers_pruned": num_low_complexity_pruned,
+      "stats": stats,
+    })
+
+  try:
+    # Pass 1. Stream every reference once, partitioning its kmers into the buckets
+    remaining_reference_bytes = sum(os.path.getsize(file_path) for file_path, _, _ in reference_files[num_references_done:])
+    # progress is counted in bytes of the reference files, the only size known up front
+    with progress.task("database", unit="bytes", total=remaining_reference_bytes) as database_progress:
+      for file_count, (file_path, accession_id, tax_id) in enumerate(reference_files, start=1):
+        if file_count <= num_references_done:
+          continue
+        print(f"Partitioning K-mers of file {file_count} with accession_id {accession_id} into buckets")
+        taxon_index = taxa.index(tax_id)
+        buffers = [array('Q') for _ in range(num_buckets)]
+        low_complexity_buffers = [array('Q') for _ in range(num_buckets)] if pruning is not None else []
+        num_buffered = 0
+
+        def flush():
+          for run_taxon_index, run_buffers in ((taxon_index, buffers), (LOW_COMPLEXITY_TAXON_INDEX, low_complexity_buffers)):
+            for bucket, buffer in enumerate(run_buffers):
+              if buffer:
+                with open(bucket_filenames[bucket], 'ab') as fp:
+                  fp.write(BUCKET_RUN_HEADER.pack(run_taxon_index, len(buffer)))
+                  buffer.tofile(fp)
+                del buffer[:]
+
+        def partition(kmers, run_buffers):
+          # sorting the block's kmers puts each bucket's kmers next to each other,
+          # so they can be split into the buckets with a binary search per bucket
+          # instead of a Python level loop over every kmer
+          kmers.sort()
+          start = 0
+          for bucket in range(num_buckets):
+            end = bisect_left(kmers, (bucket + 1) << shift, start) if bucket + 1 < num_buckets else len(kmers)
+            if end > start:
+              run_buffers[bucket].extend(kmers[start:end])
+            start = end
+
+        with open(file_path, 'r') as reference_genome_assembly:
+          database_progress.advance(len(reference_genome_assembly.readline()))
+          # every block after the first starts with the k - 1 bases carried over from the one before
+          num_carried_bases = 0
+          for block, num_bytes in iter_reference_blocks(reference_genome_assembly, k, block_size):
+            stats["bases_read"] = stats.get("bases_read", 0) + len(block) - num_carried_bases
+            num_carried_bases = min(len(block), k - 1)
+            kmers = []
+            low_complexity_kmers = []
+            for run in iter_encoded_kmers(block, k, pruning, low_complexity_kmers):
+              kmers.extend(run)
+            # the unambiguous windows, including any low-complexity ones left out of kmers
+            num_windows = len(kmers) + len(low_complexity_kmers)
+            partition(kmers, buffers)
+            if low_complexity_kmers:
+              partition(low_complexity_kmers, low_complexity_buffers)
+              num_buffered += len(low_complexity_kmers)
+            num_buffered += len(kmers)
+            stats["kmers_inserted"] = stats.get("kmers_inserted", 0) + len(kmers)
+            stats["ambiguous_kmers_skipped"] = stats.get("ambiguous_kmers_skipped", 0) + count_kmer_windows(block, k) - num_windows
+            database_progress.advance(num_bytes, kmers=len(kmers))
+            del kmers, low_complexity_kmers
+            if num_buffered >= buffer_capacity:
+              flush()
+              num_buffered = 0
+        flush()
+        stats["references_used"] = stats.get("references_used", 0) + 1
+        num_references_done = file_count
+        if checkpoint is not None:
+          save_checkpoint()
+
+    # Pass 2. Reduce and sort each bucket, and merge them (in prefix order) into the index.
+    # A checkpointed build first keeps every reduced bucket in a file of its own, and then appends them all
+    writer = KmerIndexWriter(index_filename, k, manifest["fingerprint"] if manifest else None)
+    with progress.task("database_merge", unit="buckets", total=num_buckets - num_buckets_done) as merge_progress:
+      for bucket, bucket_filename in enumerate(bucket_filenames):
+        if bucket < num_buckets_done:
+          continue
+        if not os.path.exists(bucket_filename):
+          merge_progress.advance(1)
+          num_buckets_done = bucket + 1
+          continue
+        kmers, taxon_indices, num_pruned, num_low_complexity = reduce_sorted_bucket(bucket_filename, taxa, pruning)
+        merge_progress.advance(1, kmers=len(kmers))
+        num_rank_pruned += num_pruned
+        num_low_complexity_pruned += num_low_complexity
+        if sys.byteorder != "little":
+          kmers.byteswap()
+          taxon_indices.byteswap()
+        num_buckets_done = bucket + 1
+        if checkpoint is not None:
+          reduced_filename = checkpoint.reduced_filename(bucket)
+          with open(reduced_filename + ".tmp", 'wb') as fp:
+            kmers.tofile(fp)
+            taxon_indices.tofile(fp)
+          os.replace(reduced_filename + ".tmp", reduced_filename)
+          save_checkpoint()
+        else:
+          writer.add(kmers, taxon_indices)
+        # only once the checkpoint no longer needs it
+        os.remove(bucket_filename)
+    if checkpoint is not None:
+      for bucket in range(num_buckets):
+        reduced_filename = checkpoint.reduced_filename(bucket)
+        if os.path.exists(reduced_filename):
+          num_kmers = os.path.getsize(reduced_filename) // (8 + 4)
+          kmers = array('Q')
+          taxon_indices = array('I')
+          with open(reduced_filename, 'rb') as fp:
+            kmers.fromfile(fp, num_kmers)
+            taxon_indices.fromfile(fp, num_kmers)
+          writer.add(kmers, taxon_indices)
+    stats["new_kmers"] = stats.get("new_kmers", 0) + writer.num_kmers + num_rank_pruned
+    if pruning is not None:
+      stats["low_complexity_kmers_pruned"] = stats.get("low_complexity_kmers_pruned", 0) + num_low_complexity_pruned
+      stats["rank_kmers_pruned"] = stats.get("rank_kmers_pruned", 0) + num_rank_pruned
+    stats["lca_calls"] = stats.get("lca_calls", 0) + taxa.lca_calls
+    writer.close({
+      "k": k,
+      "encoding": KMER_ENCODING,
+      "taxonomy_ids": taxa.taxonomy_ids,
+      "manifest": manifest,
+    })
+  finally:
+    if checkpoint is None:
+      shutil.rmtree(bucket_directory, ignore_errors=True)
+  if checkpoint is not None:
+    # a finished build has nothing left to resume
+    checkpoint.remove()
+
+def write_kmer_index(index_filename : str, kmer_to_lca : Dict[str, str], k : int, manifest : Optional[Dict[str, object]] = None) -> None:
+  """
+  Write a kmer_to_lca dictionary built in memory by kmer_to_lca_mapping.build_database
+  as an index file (leaving out the kmers with non-ACGT bases, which can't be encoded),
+  with the database manifest (see database_manifest.py) if one is given.
+  """
+  if k > MAX_K:
+    raise ValueError(f"k = {k} is too long for the 2-bit encoded index, the maximum is {MAX_K}")
+  taxonomy_ids : List[str] = []
+  taxonomy_id_to_index : Dict[str, int] = {}
+  table : Dict[int, int] = {}
+  for kmer, taxonomy_id in kmer_to_lca.items():
+    code = encode_kmer(kmer)
+    if code is None:
+      continue
+    if taxonomy_id not in taxonomy_id_to_index:
+      taxonomy_id_to_index[taxonomy_id] = len(taxonomy_ids)
+      taxonomy_ids.append(taxonomy_id)
+    table[code] = taxonomy_id_to_index[taxonomy_id]
+  kmers = array('Q', sorted(table))
+  taxon_indices = array('I', map(table.__getitem__, kmers))
+  del table
+  if sys.byteorder != "little":
+    kmers.byteswap()
+    taxon_indices.byteswap()
+  writer = KmerIndexWriter(index_filename, k, manifest["fingerprint"] if manifest else None)
+  writer.add(kmers, taxon_indices)
+  writer.close({
+    "k": k,
+    "encoding": KMER_ENCODING,
+    "taxonomy_ids": taxonomy_ids,
+    "manifest": manifest,
+  })
+
+def shard_filename(prefix : int, prefix_length : int) -> str:
+  return f"shard-{decode_kmer(prefix, prefix_length) if prefix_length else 'all'}.kdb"
+
+def shard_kmer_index(index_filename : str, shard_directory : str, prefix_length : int) -> None:
+  """
+  Split an index file into 4 ** prefix_length shards by the first prefix_length bases of the kmers,
+  each a complete index file of its own, and write a manifest listing them to shard_directory.
+  Empty shards are not written, and the shards of an earlier sharding are removed.
+
+  Every shard's header carries the fingerprint of the index's database, and the manifest
+  carries the index's database manifest.
+  """
+  index = load_kmer_index(index_filename, use_mmap=True)
+  if prefix_length > index.k:
+    raise ValueError(f"The shard prefix length {prefix_length} is longer than k = {index.k}")
+  os.makedirs(shard_directory, exist_ok=True)
+  for f in os.listdir(shard_directory):
+    if f.startswith("shard-") and f.endswith(".kdb"):
+      os.remove(os.path.join(shard_directory, f))
+  shift = 2 * (index.k - prefix_length)
+  shards = []
+  start = 0
+  for prefix in range(4 ** prefix_length):
+    end = bisect_left(index.kmers, (prefix + 1) << shift, start) if prefix + 1 < 4 ** prefix_length else len(index)
+    if end > start:
+      # each shard only lists the taxonomy ids its own kmers use
+      used_taxon_indices = sorted(set(index.taxon_indices[start:end]))
+      reindex = {taxon_index: i for i, taxon_index in enumerate(used_taxon_indices)}
+      filename = shard_filename(prefix, prefix_length)
+      writer = KmerIndexWriter(os.path.join(shard_directory, filename), index.k, index.fingerprint)
+      kmers = array('Q')
+      kmers.frombytes(index.kmers[start:end].tobytes())
+      writer.add(kmers, array('I', map(reindex.__getitem__, index.taxon_indices[start:end])))
+      writer.close({
+        "k": index.k,
+        "encoding": KMER_ENCODING,
+        "taxonomy_ids": [index.taxonomy_ids[taxon_index] for taxon_index in used_taxon_indices],
+        "shard_prefix": prefix,
+        "shard_prefix_length": prefix_length,
+      })
+      shards.append({"prefix": prefix, "filename": filename, "num_kmers": end - start})
+    start = end
+
+  manifest = {
+    "format": SHARD_MANIFEST_FORMAT,
+    "k": index.k,
+    "encoding": KMER_ENCODING,
+    "prefix_length": prefix_length,
+    "num_kmers": len(index),
+    "shards": shards,
+    "fingerprint": index.fingerprint,
+    "kmers_per_taxon": index.metadata.get("kmers_per_taxon"),
+    "database": index.metadata.get("manifest"),
+  }
+  manifest_filename = os.path.join(shard_directory, SHARD_MANIFEST_FILENAME)
+  with open(manifest_filename + ".tmp", 'w') as fp:
+    json.dump(manifest, fp, indent=2, sort_keys=True)
+  os.replace(manifest_filename + ".tmp", manifest_filename)
+
+class ShardedKmerIndex:
+  """
+  A read-only k-mer to LCA database split into shards by k-mer prefix (see shard_kmer_index),
+  where shards are memory mapped lazily, the first time a kmer falls in them, and at most
+  max_open_shards are kept open at once (the least recently used one is closed first).
+
+  Supports the same lookups as the kmer_to_lca dictionary, plus lookup_many,
+  which groups the kmers by shard so each shard is looked up in one go.
+  """
+  def __init__(self, shard_directory : str, max_open_shards : int = 64):
+    self.shard_directory = shard_directory
+    with open(os.path.join(shard_directory, SHARD_MANIFEST_FILENAME), 'r') as fp:
+      self.manifest = json.load(fp)
+    if self.manifest.get("format") != SHARD_MANIFEST_FORMAT:
+      raise ValueError(f"{shard_directory} does not contain a sharded k-mer index")
+    self.k = self.manifest["k"]
+    self.fingerprint = self.manifest.get("fingerprint")
+    self.prefix_length = self.manifest["prefix_length"]
+    self.shift = 2 * (self.k - self.prefix_length)
+    self.shard_filenames = {shard["prefix"]: shard["filename"] for shard in self.manifest["shards"]}
+    self.max_open_shards = max(1, max_open_shards)
+    self.open_shards : "OrderedDict[int, KmerIndex]" = OrderedDict()
+    # number of times a shard had to be (re)opened, for the metrics
+    self.shard_loads = 0
+    # the query pipeline's worker threads share the open shards
+    self.shards_lock = threading.Lock()
+
+  def shard(self, prefix : int) -> Optional[KmerIndex]:
+    """
+    The (opened) shard of the kmers with this prefix, or None if there are no such kmers.
+    """
+    with self.shards_lock:
+      if prefix in self.open_shards:
+        self.open_shards.move_to_end(prefix)
+        return self.open_shards[prefix]
+      if prefix not in self.shard_filenames:
+        return None
+      if len(self.open_shards) >= self.max_open_shards:
+        # dropping the last reference to the shard unmaps it
+        self.open_shards.popitem(last=False)
+      # a shard left over from another build of the database is rejected by its header alone
+      shard = load_kmer_index(
+        os.path.join(self.shard_directory, self.shard_filenames[prefix]), use_mmap=True, expected_fingerprint=self.fingerprint
+      )
+      self.open_shards[prefix] = shard
+      self.shard_loads += 1
+      return shard
+
+  def get(self, kmer : str, default : Optional[str] = None) -> Optional[str]:
+    code = encode_kmer(kmer) if len(kmer) == self.k else None
+    if code is None:
+      return default
+    shard = self.shard(code >> self.shift)
+    if shard is None:
+      return default
+    position = shard.find_code(code)
+    return shard.taxonomy_ids[shard.taxon_indices[position]] if position >= 0 else default
+
+  def __contains__(self, kmer : str) -> bool:
+    return self.get(kmer) is not None
+
+  def __getitem__(self, kmer : str) -> str:
+    taxonomy_id = self.get(kmer)
+    if taxonomy_id is None:
+      raise KeyError(kmer)
+    return taxonomy_id
+
+  def __len__(self) -> int:
+    return self.manifest["num_kmers"]
+
+  def lookup_many(self, kmers : List[str]) -> List[Optional[str]]:
+    """
+    The LCA taxonomy id of each of the kmers, or None for those not in the index,
+    opening each shard the kmers fall in only once.
+    """
+    results : List[Optional[str]] = [None] * len(kmers)
+    positions_by_prefix : Dict[int, List[Tuple[int, int]]] = {}
+    for position, kmer in enumerate(kmers):
+      code = encode_kmer(kmer) if len(kmer) == self.k else None
+      if code is not None:
+        positions_by_prefix.setdefault(code >> self.shift, []).append((position, code))
+    # the shards that are already open go first, so they aren't closed to make room for the others
+    prefixes = sorted(positions_by_prefix, key=lambda prefix: prefix not in self.open_shards)
+    for prefix in prefixes:
+      positions_and_codes = positions_by_prefix[prefix]
+      shard = self.shard(prefix)
+      if shard is None:
+        continue
+      for position, code in positions_and_codes:
+        shard_position = shard.find_code(code)
+        if shard_position >= 0:
+          results[position] = shard.taxonomy_ids[shard.taxon_indices[shard_position]]
+    return results
+
+  def verify(self, max_workers : Optional[int] = None) -> List[str]:
+    """
+    Deep verify every shard (see verify_kmer_index), with the blocks of all of the shards
+    checked in parallel, and check that every shard belongs to this database.
+
+    @return: the problems found, or an empty list if there are none
+    """
+    problems = []
+    sections = []
+    for filename in self.shard_filenames.values():
+      shard_path = os.path.join(self.shard_directory, filename)
+      with open(shard_path, 'rb') as fp:
+        fingerprint = read_index_header(fp)[6]
+      if fingerprint != self.fingerprint:
+        problems.append(f"{shard_path} belongs to a different database")
+      sections.extend(index_checksum_sections(shard_path))
+    return problems + database_manifest.verify_blocks(sections, max_workers)
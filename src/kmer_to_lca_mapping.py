@@ -1,6 +1,9 @@
 import os
+import sys
 import taxonomy_tree
+import progress
 from taxonomy_tree import TaxaTree
+from kmer_windows import count_kmer_windows, iter_unambiguous_runs
 from typing import Dict, List, Set
 from collections import defaultdict
 
@@ -48,13 +51,18 @@ Jaeyoon Wang
 
 """
 
+# Number of k-mer windows inserted between two updates of the build's progress (see progress.py)
+PROGRESS_BATCH_SIZE = 1 << 16
+
 # Step 2. After the parent map (i.e. taxonomy tree) is built in taxonomy_tree.py,
 # We will build the database with actual cross-references to kmers and lcas
 def build_database(
     file_directory: str,
     custom_taxonomy_ids_filename : str,
     k: int,
-    taxonomy_id_to_parent_id : Dict[str, str]) -> Dict[str, str]:
+    taxonomy_id_to_parent_id : Dict[str, str],
+    stats : Dict[str, int] = None,
+    pruning = None) -> Dict[str, str]:
   """
   Given a directory of ~20 FASTA files with genomes of common contaminants,
   we want to traverse all kmers in the FASTA files.
@@ -68,12 +76,25 @@ def build_database(
 
   This is like accumulating the LCA iteratively as we go across all the kmers.
 
+  Kmers containing a base other than A, C, G or T are never inserted,
+  since no query kmer looked up in the database can contain one (see kmer_windows.py).
+
+  If a stats dictionary is given, the number of references used and skipped,
+  bases read, kmers inserted, ambiguous kmers skipped, new kmers and LCA calls are added to it.
+
+  If a database_pruning.DatabasePruning is given, low-complexity kmers are never inserted and
+  kmers whose LCA ends up at or above the prune rank are deleted at the end, and the number of
+  distinct kmers each of them removed is added to the stats.
+
   @return: the kmer_to_lca_mapping dictionary
   """
 
   # Dictionary mapping k-mers to their LCA taxonomy IDs
   kmers_to_lca = {}
 
+  # Distinct low-complexity k-mers left out, if they are pruned
+  low_complexity_kmers = set()
+
   # Get the NCBI accession id to tax id mapping
   ncbi_accession_id_to_tax_id_mapping = \
     make_ncbi_accession_id_to_tax_id_mapping(
@@ -83,54 +104,104 @@ def build_database(
   # File that we are searching through
   file_count = 1
 
-  # For each FASTA file
-  for f in os.listdir(f"./{file_directory}"):
+  # Progress is reported to stderr (see progress.py) every PROGRESS_BATCH_SIZE windows,
+  # out of about as many bases as the reference files have bytes
+  total_bases = sum(os.path.getsize(os.path.join(file_directory, f)) for f in os.listdir(file_directory))
 
-    # opening the file
-    file_path = os.path.join(file_directory, f)
+  with progress.task("database", unit="bases", total=total_bases) as database_progress:
+    # For each FASTA file
+    for f in os.listdir(file_directory):
 
-    with open(file_path, "r") as reference_genome_assembly:
-      # reading in the first line of the file
-      first_line = reference_genome_assembly.readline()
+      # opening the file
+      file_path = os.path.join(file_directory, f)
+
+      with open(file_path, "r") as reference_genome_assembly:
+        # reading in the first line of the file
+        first_line = reference_genome_assembly.readline()
         
-      # get the accession id for this FASTA file
-      accession_id = first_line.split()[0][1:]
-
-      # check if the accession id is in the accesion id to tax id mapping
-      if (accession_id in ncbi_accession_id_to_tax_id_mapping.keys()):
-        # We are searching this file
-        print(f"Building K-mer to LCA dictionary using file {str(file_count)} with accession_id {str(accession_id)} as a reference genome assembly")
-        # Increment the file count
-        file_count += 1
-
-        # if it is, then get the tax id
-        tax_id = ncbi_accession_id_to_tax_id_mapping[accession_id]
+        # get the accession id for this FASTA file
+        accession_id = first_line.split()[0][1:]
+
+        # check if the accession id is in the accesion id to tax id mapping
+        if (accession_id in ncbi_accession_id_to_tax_id_mapping.keys()):
+          # We are searching this file
+          print(f"Building K-mer to LCA dictionary using file {str(file_count)} with accession_id {str(accession_id)} as a reference genome assembly")
+          # Increment the file count
+          file_count += 1
+
+          # if it is, then get the tax id
+          tax_id = ncbi_accession_id_to_tax_id_mapping[accession_id]
         
-        # Split the genome assembly into kmers
-        reference_genome_assembly_sequence = ""
-        for line in reference_genome_assembly:
-            if line.startswith(">"):
-                # Skip header lines in FASTA format
-                continue
-            # Add this line to the genome assembly sequence
-            reference_genome_assembly_sequence += line.strip()
-
-        for i in range(len(reference_genome_assembly_sequence) - k + 1):
-            kmer = reference_genome_assembly_sequence[i:i + k]
-
-            # If it is a kmer we haven't seen before, then set it to the tax_id corresponding
-            # to the accession id of this FASTA file
-            if (kmer not in kmers_to_lca.keys()):
-              # kmers_to_lca[kmer] = [tax_id]
-              kmers_to_lca[kmer] = tax_id
-            else:
-              # If it is a kmer we have seen before, then update the LCA of this kmer
-              kmers_to_lca[kmer] = lca(taxonomy_id_to_parent_id, kmers_to_lca[kmer], tax_id)
-      else:
-        continue
+          # Split the genome assembly into kmers
+          reference_genome_assembly_sequence = ""
+          for line in reference_genome_assembly:
+              if line.startswith(">"):
+                  # Skip header lines in FASTA format
+                  continue
+              # Add this line to the genome assembly sequence
+              reference_genome_assembly_sequence += line.strip()
+
+          num_kmers_before = len(kmers_to_lca)
+          num_kmers = 0
+          # low-complexity windows left out, which aren't ambiguous ones
+          num_low_complexity = 0
+          # Only the windows inside runs of unambiguous bases are inserted
+          for start, end in iter_unambiguous_runs(reference_genome_assembly_sequence, k):
+            num_kmers += end - start - k + 1
+            low_complexity = \
+              pruning.low_complexity_flags(reference_genome_assembly_sequence[start:end], k) if pruning else None
+            for batch_start in range(start, end - k + 1, PROGRESS_BATCH_SIZE):
+              batch_end = min(batch_start + PROGRESS_BATCH_SIZE, end - k + 1)
+              for i in range(batch_start, batch_end):
+                kmer = reference_genome_assembly_sequence[i:i + k]
+                if low_complexity and low_complexity[i - start]:
+                  low_complexity_kmers.add(kmer)
+                  num_kmers -= 1
+                  num_low_complexity += 1
+                  continue
+
+                # If it is a kmer we haven't seen before, then set it to the tax_id corresponding
+                # to the accession id of this FASTA file
+                if (kmer not in kmers_to_lca.keys()):
+                  # kmers_to_lca[kmer] = [tax_id]
+                  kmers_to_lca[kmer] = tax_id
+                else:
+                  # If it is a kmer we have seen before, then update the LCA of this kmer
+                  kmers_to_lca[kmer] = lca(taxonomy_id_to_parent_id, kmers_to_lca[kmer], tax_id)
+              database_progress.advance(batch_end - batch_start, kmers=batch_end - batch_start)
+              database_progress.set("table_size", len(kmers_to_lca))
+
+          if stats is not None:
+            # every kmer that wasn't new went through an lca() call,
+            # so these can all be counted outside of the loop above
+            num_new_kmers = len(kmers_to_lca) - num_kmers_before
+            add_to_stats(stats, "references_used", 1)
+            add_to_stats(stats, "bases_read", len(reference_genome_assembly_sequence))
+            add_to_stats(stats, "kmers_inserted", num_kmers)
+            add_to_stats(stats, "ambiguous_kmers_skipped", count_kmer_windows(reference_genome_assembly_sequence, k) - num_kmers - num_low_complexity)
+            add_to_stats(stats, "new_kmers", num_new_kmers)
+            add_to_stats(stats, "lca_calls", num_kmers - num_new_kmers)
+        else:
+          # Not silently, since a missing line in the taxonomy ids file is an easy mistake to make
+          print(f"Warning: skipped {f}, its accession id is not in {custom_taxonomy_ids_filename}", file=sys.stderr)
+          if stats is not None:
+            add_to_stats(stats, "references_skipped", 1)
+          continue
+
+  if pruning is not None:
+    num_pruned = pruning.prune_table(kmers_to_lca)
+    if stats is not None:
+      add_to_stats(stats, "low_complexity_kmers_pruned", len(low_complexity_kmers))
+      add_to_stats(stats, "rank_kmers_pruned", num_pruned)
 
   return kmers_to_lca
 
+def add_to_stats(stats : Dict[str, int], name : str, n : int) -> None:
+  """
+  Add n to the counter called name in the stats dictionary.
+  """
+  stats[name] = stats.get(name, 0) + n
+
 def make_ncbi_accession_id_to_tax_id_mapping(
     custom_taxonomy_ids_filename : str) -> List[str]:
   """
@@ -0,0 +1,64 @@
+import re
+from typing import Iterator, List, Tuple
+
+"""
+kmer_windows.py
+
+Ambiguity-aware k-mer windowing, shared by the database build (kmer_to_lca_mapping.py,
+kmer_database.py) and the query scan (get_kmer_hit_counts.py).
+
+Assemblies contain IUPAC ambiguity codes such as N and Y (see e.g.
+covid-assemblies/covid-contaminated-with-phiX174.txt), and a k-mer containing one can
+never match a reference k-mer made of A, C, G and T only. So rather than slicing out and
+looking up every k-mer window, any base other than A, C, G or T is treated as a window
+reset: we jump straight to the next run of at least k unambiguous bases, and only the
+windows inside such runs are ever inserted or looked up. The windows that were jumped
+over are counted, so they can be reported.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# What a k-mer window containing an ambiguous base is recorded as
+# in a read's list of k-mer LCAs (the same 'A' that Kraken uses in its output)
+AMBIGUOUS_KMER = "A"
+
+# Compiled run patterns, one per k
+unambiguous_run_patterns = {}
+
+def iter_unambiguous_runs(sequence : str, k : int) -> Iterator[Tuple[int, int]]:
+  """
+  Yield the (start, end) of every maximal run of at least k bases of the sequence
+  that are all A, C, G or T, from left to right.
+  """
+  if k not in unambiguous_run_patterns:
+    unambiguous_run_patterns[k] = re.compile(f"[ACGT]{{{k},}}")
+  for match in unambiguous_run_patterns[k].finditer(sequence):
+    yield match.start(), match.end()
+
+def count_kmer_windows(sequence : str, k : int) -> int:
+  """
+  The number of k-mer windows in the sequence, ambiguous or not.
+  """
+  return max(0, len(sequence) - k + 1)
+
+def split_into_unambiguous_kmers(sequence : str, k : int) -> Tuple[List[int], List[str]]:
+  """
+  Split the sequence into its k-mers, leaving out every window with an ambiguous base.
+
+  @return: the start positions of the unambiguous k-mers and the k-mers themselves
+  """
+  positions : List[int] = []
+  kmers : List[str] = []
+  for start, end in iter_unambiguous_runs(sequence, k):
+    run_positions = range(start, end - k + 1)
+    positions.extend(run_positions)
+    kmers.extend(sequence[i:i + k] for i in run_positions)
+  return positions, kmers
@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# helper files
+import taxonomy_tree
+from benchmark import git_commit
+
+"""
+kraken_comparison.py
+
+Runs our classifier (main.py) over every bundled assembly in covid-assemblies/ and
+compares it with the Kraken results stored next to them:
+
+  - per-read agreement: our call for every read (from main.py's --output) against Kraken's
+    call for the same read (covid-assemblies/kraken-output/), where two calls agree if they
+    are the same taxon at --rank (e.g. the same genus) or both unclassified
+  - per-taxon abundance deltas: the percentage of reads assigned to every taxon at --rank,
+    ours against Kraken's report (covid-assemblies/kraken-report-output/)
+  - our wall time, database build and query time, reads per second, peak RSS and database size
+    (from main.py's --metrics)
+
+The reads are the same on both sides: the Kraken outputs were made from FASTQ files
+written by read_simulator.py with its default options, i.e. our pseudoreads.
+
+Kraken uses the full NCBI taxonomy, so its calls are usually a different (often older or more
+specific) taxonomy id than ours. The lineages are taken from our parent map (taxonomy_tree.py),
+completed with the lineages spelled out by the Kraken reports, and the ranks from the reports.
+
+Results can be written as JSON with --output, and a run can be checked against an earlier one
+with --baseline, which exits with a non-zero status if the agreement, speed or memory regressed.
+
+How to run
+----------
+
+$ python3 src/kraken_comparison.py --output comparison.json
+
+$ python3 src/kraken_comparison.py --baseline comparison.json -- --k 25 --max-memory 64M
+
+$ python3 src/kraken_comparison.py --baseline comparison.json -- --prune-rank genus --dust-threshold 2.5
+
+shows what pruning the database (see database_pruning.py) does to its size and to the agreement.
+
+Everything after -- is passed on to main.py.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Version of the results file layout, bump this if the layout changes
+RESULTS_FORMAT_VERSION = 1
+
+# The repository root, which main.py's default paths are relative to
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ASSEMBLY_DIRECTORY = os.path.join(REPOSITORY_DIRECTORY, "covid-assemblies")
+
+# (sample name, query assembly, Kraken per-read output or None, Kraken report) for every bundled input.
+# Kraken's per-read output of the phiX174 contaminated reads was not kept, only its report.
+SAMPLES = [
+  (
+    f"covid-assembly-{i}",
+    os.path.join(ASSEMBLY_DIRECTORY, f"covid-assembly-{i}.txt"),
+    os.path.join(ASSEMBLY_DIRECTORY, "kraken-output", f"kraken-fastq-covid-assembly-{i}-output.txt"),
+    os.path.join(ASSEMBLY_DIRECTORY, "kraken-report-output", f"kraken-report-fastq-covid-assembly-{i}-output.txt"),
+  )
+  for i in range(1, 10)
+] + [
+  (
+    "covid-contaminated-with-phiX174",
+    os.path.join(ASSEMBLY_DIRECTORY, "covid-contaminated-with-phiX174.txt"),
+    None,
+    os.path.join(ASSEMBLY_DIRECTORY, "kraken-classification-output", "fastq-kraken-output-1.txt"),
+  ),
+]
+
+# Kraken report rank codes, from the root down
+RANK_CODES = {
+  "superkingdom": "D", "kingdom": "K", "phylum": "P", "class": "C",
+  "order": "O", "family": "F", "genus": "G", "species": "S",
+}
+
+# Taxonomy id that unclassified reads are counted under
+UNCLASSIFIED = "0"
+
+def read_kraken_report(report_filename : str) -> List[Tuple[int, str, str, int, str]]:
+  """
+  Parse a Kraken report into (depth, taxonomy id, rank code, reads assigned directly, name) rows,
+  where depth is the indentation of the name (two spaces per level).
+  """
+  rows = []
+  with open(report_filename, 'r') as fp:
+    for line in fp:
+      tokens = line.rstrip("\n").split("\t")
+      if len(tokens) < 6:
+        continue
+      name = tokens[5]
+      depth = (len(name) - len(name.lstrip(" "))) // 2
+      rows.append((depth, tokens[4], tokens[3], int(tokens[2]), name.strip()))
+  return rows
+
+def iter_kraken_calls(output_filename : str) -> Iterator[Tuple[str, Optional[str]]]:
+  """
+  Yield (read id, taxonomy id or None if unclassified) for every line of a file
+  in Kraken's per-read output format, which main.py's --output also uses.
+  """
+  with open(output_filename, 'r') as fp:
+    for line in fp:
+      tokens = line.split("\t", 3)
+      if len(tokens) < 3:
+        continue
+      yield tokens[1], tokens[2] if tokens[0] == "C" and tokens[2] != UNCLASSIFIED else None
+
+class ComparisonTaxonomy:
+  """
+  Our parent map, completed with the lineages and ranks spelled out by the Kraken reports,
+  used to find the taxon at a given rank above any call from either side.
+  """
+  def __init__(self, taxonomy_id_to_parent_id : Dict[str, str]):
+    self.taxonomy_id_to_parent_id = dict(taxonomy_id_to_parent_id)
+    self.ranks : Dict[str, str] = {}
+    self.names : Dict[str, str] = {UNCLASSIFIED: "unclassified"}
+    self.cache : Dict[Tuple[Optional[str], str], str] = {}
+
+  def add_report(self, rows : List[Tuple[int, str, str, int, str]]) -> None:
+    lineage : List[str] = []
+    for depth, taxonomy_id, rank, _, name in rows:
+      self.ranks[taxonomy_id] = rank
+      self.names.setdefault(taxonomy_id, name)
+      del lineage[depth:]
+      # our own parent map wins where the two disagree
+      if lineage and taxonomy_id not in self.taxonomy_id_to_parent_id:
+        self.taxonomy_id_to_parent_id[taxonomy_id] = lineage[-1]
+      lineage.append(taxonomy_id)
+    self.cache.clear()
+
+  def taxon_at_rank(self, taxonomy_id : Optional[str], rank : str) -> str:
+    """
+    The taxon at rank (a Kraken rank code) that taxonomy_id falls under. If the lineage has no
+    taxon at that rank, the taxon itself is used, and None (unclassified) is UNCLASSIFIED.
+    """
+    if taxonomy_id is None:
+      return UNCLASSIFIED
+    key = (taxonomy_id, rank)
+    if key not in self.cache:
+      result = taxonomy_id
+      current = taxonomy_id
+      seen = set()
+      while current is not None and current not in seen:
+        if self.ranks.get(current) == rank:
+          result = current
+          break
+        seen.add(current)
+        current = self.taxonomy_id_to_parent_id.get(current)
+      self.cache[key] = result
+    return self.cache[key]
+
+def compare_reads(our_calls : Dict[str, Optional[str]], kraken_output_filename : str, taxonomy : ComparisonTaxonomy, rank : str) -> Dict[str, object]:
+  """
+  Compare our call for every read with Kraken's.
+  """
+  counts = {
+    "reads_compared": 0,
+    "both_unclassified": 0,
+    "same_taxon": 0,
+    "same_at_rank": 0,
+    "different_at_rank": 0,
+    "only_ours_classified": 0,
+    "only_kraken_classified": 0,
+    "reads_missing": 0,
+  }
+  for read_id, kraken_call in iter_kraken_calls(kraken_output_filename):
+    if read_id not in our_calls:
+      counts["reads_missing"] += 1
+      continue
+    our_call = our_calls[read_id]
+    counts["reads_compared"] += 1
+    if our_call is None and kraken_call is None:
+      counts["both_unclassified"] += 1
+    elif kraken_call is None:
+      counts["only_ours_classified"] += 1
+    elif our_call is None:
+      counts["only_kraken_classified"] += 1
+    elif our_call == kraken_call:
+      counts["same_taxon"] += 1
+      counts["same_at_rank"] += 1
+    elif taxonomy.taxon_at_rank(our_call, rank) == taxonomy.taxon_at_rank(kraken_call, rank):
+      counts["same_at_rank"] += 1
+    else:
+      counts["different_at_rank"] += 1
+  counts["reads_missing"] += len(our_calls) - counts["reads_compared"]
+  agreeing = counts["both_unclassified"] + counts["same_at_rank"]
+  counts["agreement"] = agreeing / counts["reads_compared"] if counts["reads_compared"] else None
+  return counts
+
+def abundances_at_rank(read_counts : Dict[str, int], taxonomy : ComparisonTaxonomy, rank : str) -> Dict[str, float]:
+  """
+  The percentage of reads under every taxon at rank (and unclassified), given the number of
+  reads assigned directly to every taxonomy id (with UNCLASSIFIED for the unclassified reads).
+  """
+  total = sum(read_counts.values())
+  percentages : Dict[str, float] = {}
+  for taxonomy_id, count in read_counts.items():
+    taxon = taxonomy.taxon_at_rank(None if taxonomy_id == UNCLASSIFIED else taxonomy_id, rank)
+    percentages[taxon] = percentages.get(taxon, 0.0) + 100.0 * count / total
+  return percentages
+
+def run_classifier(query_filename : str, work_directory : str, main_args : List[str]) -> Tuple[Dict[str, Optional[str]], Dict[str, object]]:
+  """
+  Run main.py on the query, in its own process so that its time and memory are measured in isolation.
+
+  @return: our call for every read, and our performance numbers
+  """
+  output_filename = os.path.join(work_directory, "classifications.tsv")
+  metrics_filename = os.path.join(work_directory, "metrics.json")
+  subprocess.run(
+    [sys.executable, os.path.join(REPOSITORY_DIRECTORY, "src", "main.py"),
+     "--input-query", query_filename, "--output", output_filename, "--metrics", metrics_filename] + main_args,
+    cwd=REPOSITORY_DIRECTORY, stdout=subprocess.DEVNULL, check=True
+  )
+  with open(metrics_filename, 'r') as fp:
+    metrics = json.load(fp)
+  stages = {stage["name"]: stage for stage in metrics["stages"]}
+  our_calls = dict(iter_kraken_calls(output_filename))
+  query_seconds = stages["hit_counts"]["wall_seconds"]
+  performance = {
+    "wall_seconds": metrics["wall_seconds"],
+    "database_seconds": stages["database"]["wall_seconds"],
+    "query_seconds": query_seconds,
+    "reads": len(our_calls),
+    "reads_per_second": len(our_calls) / query_seconds if query_seconds > 0 else None,
+    "peak_rss_bytes": metrics["peak_rss_bytes"],
+    "database_kmers": stages["database"]["counters"].get("database_kmers"),
+  }
+  return our_calls, performance
+
+def run_comparison(args, main_args : List[str]) -> Dict[str, object]:
+  """
+  Run our classifier on every sample and compare it with Kraken.
+  """
+  rank = RANK_CODES[args.rank]
+  _, taxonomy_id_to_parent_id, _ = taxonomy_tree.build_parent_map(
+    taxonomy_directory=os.path.join(REPOSITORY_DIRECTORY, "taxonomy"),
+    custom_taxonomy_ids_filename=os.path.join(REPOSITORY_DIRECTORY, "taxonomy", "custom_taxonomy_ids.txt")
+  )
+  taxonomy = ComparisonTaxonomy(taxonomy_id_to_parent_id)
+  reports = {name: read_kraken_report(report) for name, _, _, report in SAMPLES}
+  for rows in reports.values():
+    taxonomy.add_report(rows)
+
+  results = []
+  for name, query_filename, kraken_output_filename, _ in SAMPLES:
+    if args.samples and name not in args.samples:
+      continue
+    print(f"Running {name}", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as work_directory:
+      our_calls, performance = run_classifier(query_filename, work_directory, main_args)
+
+    our_read_counts : Dict[str, int] = {}
+    for call in our_calls.values():
+      our_read_counts[call or UNCLASSIFIED] = our_read_counts.get(call or UNCLASSIFIED, 0) + 1
+    kraken_read_counts = {taxonomy_id: count for _, taxonomy_id, _, count, _ in reports[name] if count}
+    ours = abundances_at_rank(our_read_counts, taxonomy, rank)
+    kraken = abundances_at_rank(kraken_read_counts, taxonomy, rank)
+    deltas = [
+      {
+        "taxonomy_id": taxon,
+        "name": taxonomy.names.get(taxon, ""),
+        "ours_percent": ours.get(taxon, 0.0),
+        "kraken_percent": kraken.get(taxon, 0.0),
+        "delta_percent": ours.get(taxon, 0.0) - kraken.get(taxon, 0.0),
+      }
+      for taxon in set(ours) | set(kraken)
+    ]
+    deltas.sort(key=lambda delta: abs(delta["delta_percent"]), reverse=True)
+
+    result = {"sample": name, **performance}
+    if kraken_output_filename is not None:
+      result["reads_compared"] = compare_reads(our_calls, kraken_output_filename, taxonomy, rank)
+    result["abundances"] = deltas
+    results.append(result)
+    print_result(result, args.top_taxa)
+
+  return {
+    "format_version": RESULTS_FORMAT_VERSION,
+    "commit": git_commit(),
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "rank": args.rank,
+    "main_args": main_args,
+    "results": results,
+  }
+
+def print_result(result : Dict[str, object], top_taxa : int) -> None:
+  """
+  Print one sample's comparison side by side with our performance numbers.
+  """
+  print(f"{result['sample']}")
+  reads_per_second = result["reads_per_second"]
+  print(
+    f"\tours: {result['reads']} reads, {result['wall_seconds']:.2f}s wall "
+    f"(database {result['database_seconds']:.2f}s, query {result['query_seconds']:.2f}s), "
+    f"{reads_per_second:.0f} reads/s, peak RSS {result['peak_rss_bytes'] / 2 ** 20:.1f} MiB, "
+    f"{result.get('database_kmers')} k-mers in the database"
+    if reads_per_second is not None else f"\tours: {result['reads']} reads"
+  )
+  compared = result.get("reads_compared")
+  if compared is None:
+    print("\tper-read agreement: no Kraken per-read output")
+  elif compared["agreement"] is not None:
+    print(
+      f"\tper-read agreement: {compared['agreement']:.2%} of {compared['reads_compared']} reads "
+      f"({compared['same_at_rank']} same taxon at rank, of which {compared['same_taxon']} identical, "
+      f"{compared['both_unclassified']} both unclassified, {compared['different_at_rank']} different, "
+      f"{compared['only_ours_classified']} only ours classified, {compared['only_kraken_classified']} only Kraken classified, "
+      f"{compared['reads_missing']} missing on one side)"
+    )
+  for delta in result["abundances"][:top_taxa]:
+    print(
+      f"\t{delta['ours_percent']:6.2f}% ours vs {delta['kraken_percent']:6.2f}% Kraken "
+      f"({delta['delta_percent']:+.2f}) {delta['taxonomy_id']} {delta['name']}"
+    )
+
+# The metrics compared by --baseline, and whether bigger is better for them
+COMPARED_METRICS = {
+  "agreement": True,
+  "reads_per_second": True,
+  "wall_seconds": False,
+  "peak_rss_bytes": False,
+  "database_kmers": False,
+}
+
+def compare_with_baseline(baseline : Dict[str, object], current : Dict[str, object], tolerance : float, agreement_tolerance : float) -> bool:
+  """
+  Print the change of every compared metric per sample since the baseline results.
+  Agreement is compared by its absolute change (against agreement_tolerance), everything
+  else by its relative change (against tolerance).
+
+  @return: True if nothing regressed
+  """
+  def metrics_by_sample(results):
+    by_sample = {}
+    for result in results["results"]:
+      values = {metric: result.get(metric) for metric in COMPARED_METRICS}
+      values["agreement"] = (result.get("reads_compared") or {}).get("agreement")
+      by_sample[result["sample"]] = values
+    return by_sample
+
+  old = metrics_by_sample(baseline)
+  new = metrics_by_sample(current)
+  ok = True
+  for sample in [result["sample"] for result in current["results"] if result["sample"] in old]:
+    print(f"{sample} since the baseline")
+    for metric, bigger_is_better in COMPARED_METRICS.items():
+      old_value, new_value = old[sample][metric], new[sample][metric]
+      if old_value is None or new_value is None:
+        continue
+      if metric == "agreement":
+        change = new_value - old_value
+        regressed = change < -agreement_tolerance
+        description = f"{old_value:.2%} -> {new_value:.2%} ({change * 100:+.2f} points)"
+      elif old_value:
+        change = (new_value - old_value) / old_value
+        regressed = (change < -tolerance) if bigger_is_better else (change > tolerance)
+        description = f"{old_value:.4g} -> {new_value:.4g} ({change:+.1%})"
+      else:
+        continue
+      ok = ok and not regressed
+      print(f"\t{metric}: {description}{' REGRESSION' if regressed else ''}")
+  return ok
+
+def parse_args():
+  parse = argparse.ArgumentParser(
+    description="Compare our classifier's speed and accuracy with the stored Kraken results of the bundled assemblies",
+    epilog="Arguments after -- are passed on to main.py (e.g. -- --k 25 --max-memory 64M)"
+  )
+  parse.add_argument("--rank", default="genus", choices=list(RANK_CODES), help="Rank that calls and abundances are compared at (default: genus)")
+  parse.add_argument("--samples", nargs="+", choices=[name for name, _, _, _ in SAMPLES], help="Only run these samples (default: all of them)")
+  parse.add_argument("--top-taxa", default=5, type=int, help="Number of taxa printed per sample, by largest abundance delta (default: 5)")
+  parse.add_argument("--output", help="Filename to write the JSON results to (default: only print them)")
+  parse.add_argument("--baseline", help="JSON results of an earlier run to check this one against for regressions")
+  parse.add_argument("--tolerance", default=0.1, type=float, help="Relative change in speed or memory counted as a regression (default: 0.1)")
+  parse.add_argument("--agreement-tolerance", default=0.0, type=float, help="Drop in per-read agreement (a fraction) counted as a regression (default: 0)")
+  argv = sys.argv[1:]
+  main_args = argv[argv.index("--") + 1:] if "--" in argv else []
+  args = parse.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+  return args, main_args
+
+def main():
+  args, main_args = parse_args()
+  results = run_comparison(args, main_args)
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(results, fp, indent=2)
+    print(f"Wrote comparison results to {args.output}", file=sys.stderr)
+  if args.baseline:
+    with open(args.baseline, 'r') as fp:
+      baseline = json.load(fp)
+    ok = compare_with_baseline(baseline, results, args.tolerance, args.agreement_tolerance)
+    exit(0 if ok else 1)
+
+if __name__ == "__main__":
+  main()
@@ -1,14 +1,25 @@
 import os
 import sys
+import json
 import argparse
-from typing import List, Dict
 import time
 
 # helper files
 import taxonomy_tree
 import kmer_to_lca_mapping
-import get_kmer_hit_counts
-import pseudoreads
+import query_pipeline
+import metrics
+import kmer_database
+import classification_output
+import result_cache
+import database_manifest
+import succinct_index
+import database_pruning
+import contig_localization
+import cohort
+import progress
+import abundance_estimation
+import host_depletion
 
 # Command line option parsing
 def parse_args():
@@ -60,10 +71,41 @@ def parse_args():
     # Here, the genome assembly to search for contamination in is specified
     # ------------------------
 
-  parse.add_argument(
+  # one of these is required since we need to know which sequence(s) to search for contaminants in
+  query = parse.add_mutually_exclusive_group(required=True)
+  query.add_argument(
     "--input-query",
-    required=True, # this argument is required since we need to know which sequence to search for contaminants in
-    help="Filename of the sequence in which the program will search for contaminants (required)"
+    help="Filename of the sequence in which the program will search for contaminants (required, unless --cohort is given)"
+  )
+
+  query.add_argument(
+    "--cohort",
+    default=None,
+    help="Classify a cohort of samples instead of a single --input-query: a directory of query files, or a file \
+      listing their filenames one per line, which are classified by --cohort-workers processes against one \
+      shared, memory mapped copy of the database into a sample x taxon --matrix"
+  )
+
+  parse.add_argument(
+    "--cohort-workers",
+    default=os.cpu_count() or 1,
+    type=int,
+    help="Number of worker processes classifying the --cohort samples, each taking whole samples \
+      (default: the number of CPUs)"
+  )
+
+  parse.add_argument(
+    "--matrix",
+    default="cohort-matrix.tsv",
+    help="Filename of the TSV sample x taxon abundance matrix written in --cohort mode (default: cohort-matrix.tsv)"
+  )
+
+  parse.add_argument(
+    "--matrix-values",
+    default="percent",
+    choices=cohort.MATRIX_VALUES,
+    help="What the --matrix holds for every sample and taxon: the percentage of the classified pseudoreads \
+      classified as the taxon, the number of them, or the number of k-mer hits to it (default: percent)"
   )
 
   parse.add_argument(
@@ -73,14 +115,541 @@ def parse_args():
     help="k, the length of the kmer (default: k = 31, which runs on the ugrad machines well using the new-tutorial-reference-database (within memory constraints). k = 31 is ideal if the computer has enough memory. Otherwise, k = 12 may work better.)"
   )
 
-  # parse.add_argument(
-  #   "--output",
-  #   default=sys.stdout,
-  #   help="Output stream to output results of contamination detection and classification to \
-  #       (default: sys.stdout)"
-  # )
+  parse.add_argument(
+    "--prune-rank",
+    default=None,
+    choices=database_pruning.RANK_ORDER,
+    help="Leave the kmers whose LCA is at or above this rank (e.g. genus) out of the database, \
+      since they can't tell the taxa apart at that rank (default: keep them)"
+  )
+
+  parse.add_argument(
+    "--dust-threshold",
+    default=None,
+    type=float,
+    help="Leave the low-complexity kmers, whose DUST score is above this threshold (e.g. 2.5), \
+      out of the database (default: keep them)"
+  )
+
+  parse.add_argument(
+    "--max-memory",
+    default=None,
+    help="Build the database on disk within about this much memory (e.g. 500M, 4G), by partitioning \
+      the kmers into buckets by prefix, instead of building it all in memory (default: build in memory)"
+  )
+
+  parse.add_argument(
+    "--index",
+    default=None,
+    help="Filename of the kmer index written by a --max-memory build \
+      (default: <db>-k<k>.kdb next to the --db directory)"
+  )
+
+  parse.add_argument(
+    "--tmp-dir",
+    default=None,
+    help="Directory for the temporary kmer buckets of a --max-memory build (default: next to the --index)"
+  )
+
+  parse.add_argument(
+    "--checkpoint-dir",
+    default=None,
+    help="Directory to keep the kmer buckets and checkpoints of a --max-memory build in, so that a build \
+      that was killed continues from its last checkpoint when run again with the same options (default: none)"
+  )
+
+  parse.add_argument(
+    "--shard-dir",
+    default=None,
+    help="Directory of a sharded kmer index to query, where only the shards that the query's kmers \
+      fall in are loaded. If it doesn't contain one yet, the database is built and sharded into it \
+      first (default: don't shard)"
+  )
+
+  parse.add_argument(
+    "--shard-prefix-length",
+    default=3,
+    type=int,
+    help="Number of leading kmer bases to shard by when sharding the database, i.e. 4^n shards (default: 3)"
+  )
+
+  parse.add_argument(
+    "--max-open-shards",
+    default=64,
+    type=int,
+    help="Most shards of a --shard-dir index kept open at once (default: 64)"
+  )
+
+  parse.add_argument(
+    "--succinct",
+    action="store_true",
+    help="Query a succinct copy of the --index (Elias-Fano coded kmers and bit-packed taxa, see \
+      succinct_index.py), written next to it as <index>.ski, which takes a fraction of the memory \
+      (default: query the --index, or the in-memory database)"
+  )
+
+  parse.add_argument(
+    "--verify",
+    action="store_true",
+    help="Recompute the checksum of every block of the persisted --index or --shard-dir database \
+      before querying it, in parallel, and stop if any of them is corrupt (default: only check \
+      that the database was built from the current --db, --taxonomy-ids and --k)"
+  )
+
+  parse.add_argument(
+    "--host",
+    default=None,
+    help="FASTA file of the expected (host) genome, e.g. the SARS-CoV-2 reference genome: pseudoreads that \
+      clearly belong to it, by the fraction of their k-mers in it, are depleted (counted, but not looked up \
+      in the contaminant database) before the classification (default: classify every pseudoread)"
+  )
+
+  parse.add_argument(
+    "--host-threshold",
+    default=host_depletion.DEFAULT_THRESHOLD,
+    type=float,
+    help=f"Fraction of the k-mers checked that have to be in the --host genome for a pseudoread \
+      to be depleted (default: {host_depletion.DEFAULT_THRESHOLD})"
+  )
+
+  parse.add_argument(
+    "--host-stride",
+    default=host_depletion.DEFAULT_STRIDE,
+    type=int,
+    help=f"Check every this many k-mers of a pseudoread against the --host genome (default: {host_depletion.DEFAULT_STRIDE})"
+  )
+
+  parse.add_argument(
+    "--query-threads",
+    default=1,
+    type=int,
+    help="Number of worker threads classifying the query's pseudoreads, while another thread reads \
+      the query and the main thread writes the results (default: 1)"
+  )
+
+  parse.add_argument(
+    "--batch-size",
+    default=query_pipeline.DEFAULT_BATCH_SIZE,
+    type=int,
+    help=f"Number of pseudoreads handed from the reader to the workers at a time (default: {query_pipeline.DEFAULT_BATCH_SIZE})"
+  )
+
+  parse.add_argument(
+    "--queue-depth",
+    default=query_pipeline.DEFAULT_QUEUE_DEPTH,
+    type=int,
+    help=f"Most batches waiting between two stages of the query pipeline, after which the stage \
+      before waits for the one after (default: {query_pipeline.DEFAULT_QUEUE_DEPTH})"
+  )
+
+  parse.add_argument(
+    "--progress",
+    default=progress.DEFAULT_INTERVAL,
+    type=float,
+    metavar="SECONDS",
+    help=f"Report the progress, throughput, memory use and ETA of the database build and merge, \
+      the query and the --cohort to stderr every this many seconds, 0 to never (default: {progress.DEFAULT_INTERVAL:g})"
+  )
+
+  parse.add_argument(
+    "--progress-file",
+    default=None,
+    help="Filename of a Prometheus text file to rewrite with the same numbers every --progress seconds, \
+      e.g. for the node exporter's textfile collector (default: none)"
+  )
+
+  parse.add_argument(
+    "--metrics",
+    default=None,
+    help="Filename of a JSON report to write with the wall time, CPU time, memory and item counts \
+      of every stage of the program (default: no report)"
+  )
+
+  parse.add_argument(
+    "--profile",
+    default=None,
+    choices=metrics.PROFILERS,
+    help="Also profile every stage with cProfile or tracemalloc and include the top functions / \
+      allocation sites in the --metrics report (default: no profiling)"
+  )
+
+  parse.add_argument(
+    "--output",
+    default=None,
+    help="Filename to stream the classification of every pseudoread to as it is classified, \
+      in Kraken's output format plus a top taxa column, gzip compressed if it ends in .gz \
+      (default: only print the summary)"
+  )
+
+  parse.add_argument(
+    "--localize",
+    default=None,
+    help="Filename of a BED file to write the intervals of every contig of the query that the \
+      contaminants were localized to, found in the same scan as the classification (default: don't localize)"
+  )
+
+  parse.add_argument(
+    "--localize-smoothing",
+    default=contig_localization.DEFAULT_SMOOTHING,
+    type=int,
+    help=f"Number of pseudoreads on either side of a pseudoread whose majority call replaces its own \
+      before the pseudoreads are merged into --localize intervals, 0 for none (default: {contig_localization.DEFAULT_SMOOTHING})"
+  )
+
+  parse.add_argument(
+    "--estimate",
+    default=None,
+    type=float,
+    metavar="WIDTH",
+    help="Only estimate the percentages of the pseudoreads classified as each contaminant, from a sample \
+      of them grown until every confidence interval is at most this many percentage points wide, \
+      instead of classifying every pseudoread (default: classify every pseudoread)"
+  )
+
+  parse.add_argument(
+    "--estimate-sampling",
+    default="stratified",
+    choices=abundance_estimation.SAMPLING_METHODS,
+    help="How the --estimate sample is drawn: evenly spread along the query, or at random (default: stratified)"
+  )
+
+  parse.add_argument(
+    "--estimate-seed",
+    default=abundance_estimation.DEFAULT_SEED,
+    type=int,
+    help=f"Seed of the --estimate sample, so that the same seed gives the same estimates (default: {abundance_estimation.DEFAULT_SEED})"
+  )
+
+  parse.add_argument(
+    "--estimate-confidence",
+    default=abundance_estimation.DEFAULT_CONFIDENCE,
+    type=float,
+    help=f"Confidence level of the --estimate intervals (default: {abundance_estimation.DEFAULT_CONFIDENCE})"
+  )
+
+  parse.add_argument(
+    "--cache-dir",
+    default=None,
+    help="Directory of a cache of classification results, keyed by the query's contents and the \
+      database's fingerprint, so that classifying the same query against the same database again \
+      returns the cached results right away (default: no cache)"
+  )
+
+  parse.add_argument(
+    "--cache-max-size",
+    default="1G",
+    help="Most disk space the --cache-dir may use, after which the least recently used results \
+      are evicted (default: 1G)"
+  )
+
+  args = parse.parse_args()
+  if args.succinct and args.shard_dir:
+    parse.error("--succinct can't be combined with --shard-dir")
+  if args.checkpoint_dir and not args.max_memory:
+    parse.error("--checkpoint-dir needs --max-memory, only the on disk build can be resumed")
+  if args.progress_file and args.progress <= 0:
+    parse.error("--progress-file needs --progress to be more than 0 seconds")
+  if args.host and not 0 < args.host_threshold <= 1:
+    parse.error("--host-threshold needs to be more than 0 and at most 1")
+  if args.estimate is not None:
+    if args.estimate <= 0:
+      parse.error("--estimate needs an interval width of more than 0 percentage points")
+    if not 0 < args.estimate_confidence < 1:
+      parse.error("--estimate-confidence needs to be between 0 and 1")
+    for option in ("output", "localize"):
+      if getattr(args, option):
+        parse.error(f"--{option} can't be combined with --estimate, which doesn't classify every pseudoread")
+  if args.cohort:
+    for option in ("output", "localize", "cache_dir", "estimate"):
+      if getattr(args, option):
+        parse.error(f"--{option.replace('_', '-')} can't be combined with --cohort")
+  return args
+
+def load_database(args, k, pruned_taxonomy_id_to_parent_id, run_metrics):
+  """
+  Step 2: build the database, or load the one persisted by an earlier run.
+  In --cohort mode, the database is always persisted and memory mapped, so that
+  the worker processes can all map the same copy of it.
+
+  :return: the k-mer to LCA database, the database build stats and the filename (or
+           directory, for --shard-dir) of the persisted database, None if it was only built in memory
+  """
+  # Step 2. After the parent map (i.e. taxonomy tree) is built in taxonomy_tree.py,
+  # We will build the database with actual cross-references to kmers and lcas
+  # This method is found in the kmer_to_lca_mapping.py file
+  # Dict[str, str]
+  with run_metrics.stage("database"):
+    database_stats = {}
+    pruning = None
+    if args.prune_rank or args.dust_threshold is not None:
+      pruning = database_pruning.DatabasePruning(
+        pruned_taxonomy_id_to_parent_id, taxonomy_tree.build_rank_map(), args.prune_rank, args.dust_threshold
+      )
+    pruning_options = pruning.options() if pruning else None
+    index_filename = args.index or f"{os.path.normpath(args.db)}-k{k}.kdb"
+    shard_manifest_filename = \
+      os.path.join(args.shard_dir, kmer_database.SHARD_MANIFEST_FILENAME) if args.shard_dir else None
+
+    # A database persisted by an earlier run is reused if its manifest (see database_manifest.py)
+    # matches the reference files as they are now, which only takes a stat of each of them
+    reuse_shards = False
+    reuse_index = False
+    if shard_manifest_filename and os.path.exists(shard_manifest_filename):
+      with open(shard_manifest_filename, 'r') as fp:
+        database = json.load(fp).get("database")
+      problems = database_manifest.check_manifest(database, args.db, args.taxonomy_ids, k, pruned_taxonomy_id_to_parent_id, pruning_options)
+      reuse_shards = not problems
+      for problem in problems:
+        print(f"Not using the sharded K-mer to LCA index in {args.shard_dir}: {problem}")
+    elif (args.max_memory or args.succinct or args.cohort) and os.path.exists(index_filename):
+      try:
+        database = kmer_database.read_index_metadata(index_filename).get("manifest")
+      except ValueError as e:
+        database = None
+        print(f"Not using the K-mer to LCA index {index_filename}: {e}")
+      problems = database_manifest.check_manifest(database, args.db, args.taxonomy_ids, k, pruned_taxonomy_id_to_parent_id, pruning_options)
+      reuse_index = not problems
+      for problem in problems:
+        print(f"Not using the K-mer to LCA index {index_filename}: {problem}")
+
+    # Anything persisted gets a manifest of what it was built from
+    manifest = None
+    if not reuse_shards and not reuse_index and (args.max_memory or args.shard_dir or args.succinct or args.cohort):
+      manifest = database_manifest.build_manifest(
+        args.db, args.taxonomy_ids, k, pruned_taxonomy_id_to_parent_id, kmer_database.KMER_ENCODING, pruning_options
+      )
+
+    if reuse_shards:
+      # An already sharded database is queried as is, nothing is loaded up front
+      print(f"Using the sharded K-mer to LCA index in {args.shard_dir}")
+      kmer_to_lca = None
+    elif reuse_index:
+      print(f"Using the K-mer to LCA index {index_filename}")
+      kmer_to_lca = None
+    elif args.max_memory:
+      # Build the database on disk in bounded memory, then load the finished index
+      # This method is found in the kmer_database.py file
+      kmer_database.build_database_external(
+        args.db,
+        args.taxonomy_ids,
+        k,
+        pruned_taxonomy_id_to_parent_id,
+        index_filename,
+        kmer_database.parse_memory_size(args.max_memory),
+        temporary_directory=args.tmp_dir,
+        checkpoint_directory=args.checkpoint_dir,
+        stats=database_stats,
+        manifest=manifest,
+        pruning=pruning
+      )
+      kmer_to_lca = None
+    else:
+      kmer_to_lca = \
+        kmer_to_lca_mapping.build_database(
+          args.db,
+          args.taxonomy_ids,
+          k,
+          pruned_taxonomy_id_to_parent_id,
+          stats=database_stats,
+          pruning=pruning
+        )
+      if args.shard_dir or args.succinct or args.cohort:
+        kmer_database.write_kmer_index(index_filename, kmer_to_lca, k, manifest=manifest)
+        kmer_to_lca = None
+
+    database_filename = index_filename if kmer_to_lca is None else None
+    if args.shard_dir:
+      database_filename = args.shard_dir
+      if not reuse_shards:
+        print(f"Sharding the K-mer to LCA index {index_filename} into {args.shard_dir}")
+        kmer_database.shard_kmer_index(index_filename, args.shard_dir, args.shard_prefix_length)
+      kmer_to_lca = kmer_database.ShardedKmerIndex(args.shard_dir, max_open_shards=args.max_open_shards)
+
+    if args.succinct:
+      # The succinct copy of the index is rebuilt whenever the index belongs to another database
+      succinct_filename = f"{os.path.splitext(index_filename)[0]}.ski"
+      with open(index_filename, 'rb') as fp:
+        fingerprint = kmer_database.read_index_header(fp)[6]
+      try:
+        reuse_succinct = succinct_index.read_succinct_fingerprint(succinct_filename) == fingerprint
+      except (OSError, ValueError):
+        reuse_succinct = False
+      if reuse_succinct:
+        print(f"Using the succinct K-mer to LCA index {succinct_filename}")
+      else:
+        print(f"Compressing the K-mer to LCA index {index_filename} into {succinct_filename}")
+        sizes = succinct_index.build_succinct_index(index_filename, succinct_filename)
+        print(f"Succinct index: {sizes['bytes']} bytes, {sizes['bits_per_kmer']:.2f} bits per k-mer (" + ", ".join(
+          f"{name} {bits:.2f}" for name, bits in sizes["bits_per_kmer_by_section"].items()
+        ) + f"), compared to {8 * (8 + 4)} bits per k-mer in the index")
+      kmer_to_lca = succinct_index.load_succinct_index(succinct_filename, use_mmap=bool(args.cohort), expected_fingerprint=fingerprint)
+      run_metrics.count("succinct_index_bytes", os.path.getsize(succinct_filename))
+      database_filename = succinct_filename
+
+    if kmer_to_lca is None:
+      # the index persisted (or reused) above
+      kmer_to_lca = kmer_database.load_kmer_index(index_filename, use_mmap=bool(args.cohort))
+
+    if args.verify:
+      # Deep verify: recompute the checksum of every block of the persisted database
+      if isinstance(kmer_to_lca, kmer_database.ShardedKmerIndex):
+        problems = kmer_to_lca.verify()
+      elif isinstance(kmer_to_lca, kmer_database.KmerIndex):
+        problems = kmer_database.verify_kmer_index(index_filename)
+      elif isinstance(kmer_to_lca, succinct_index.SuccinctKmerIndex):
+        problems = succinct_index.verify_succinct_index(succinct_filename)
+      else:
+        problems = []
+        print("Nothing to verify, the database was built in memory")
+      for problem in problems:
+        print(f"Verification failed: {problem}", file=sys.stderr)
+      if problems:
+        sys.exit(1)
+
+    for name, count in database_stats.items():
+      run_metrics.count(name, count)
+    run_metrics.count("database_kmers", len(kmer_to_lca))
+
+  return kmer_to_lca, database_stats, database_filename
+
+def classify_cohort(args, k, pruned_taxonomy_id_to_parent_id, run_metrics):
+  """
+  Steps 2 to 4 for every sample of the --cohort: build (or load) the database once,
+  then classify the samples on --cohort-workers worker processes sharing it.
+  Samples that can't be read are reported on stderr and left out.
+
+  :return: the names of the samples, their summaries (see ClassificationSummary.to_dict)
+           and the database build stats
+  """
+  kmer_to_lca, database_stats, database_filename = load_database(args, k, pruned_taxonomy_id_to_parent_id, run_metrics)
+
+  host_filter = load_host_filter(args, k, run_metrics)
+
+  with run_metrics.stage("cohort"):
+    filenames = cohort.read_cohort(args.cohort)
+    names = cohort.sample_names(filenames)
+    pipeline_options = {
+      "num_workers": args.query_threads,
+      "batch_size": args.batch_size,
+      "queue_depth": args.queue_depth,
+      "host_filter": host_filter,
+    }
+    print(f"Classifying {len(filenames)} samples on {max(1, min(args.cohort_workers, len(filenames)))} worker processes")
+    sample_names = []
+    summaries = []
+    num_failed = 0
+    results = cohort.classify_cohort(
+      filenames, kmer_to_lca, database_filename, k, args.cohort_workers, args.max_open_shards, pipeline_options
+    )
+    with progress.task("cohort", unit="samples", total=len(filenames)) as cohort_progress:
+      for name, result in zip(names, results):
+        cohort_progress.advance(1)
+        if "error" in result:
+          print(f"Skipping sample {name}: {result['error']}", file=sys.stderr)
+          num_failed += 1
+          continue
+        sample_names.append(name)
+        summaries.append(result["summary"])
+        cohort_progress.advance(0, reads=result["summary"]["num_reads"])
+        run_metrics.count("samples", 1)
+        run_metrics.count("reads", result["summary"]["num_reads"])
+        run_metrics.count("reads_classified", result["summary"]["num_reads_classified"])
+        for counter, count in result["counters"].items():
+          run_metrics.count(counter, count)
+    run_metrics.count("samples_failed", num_failed)
+
+  return sample_names, summaries, database_stats
+
+def classify_query(args, k, pruned_taxonomy_id_to_parent_id, run_metrics, output_filename, localization_filename=None):
+  """
+  Steps 2 to 4: build (or load) the database, read the query and classify its pseudoreads,
+  streaming the per-read classifications to output_filename and the contaminants'
+  intervals to localization_filename (if any).
+
+  :return: the ClassificationSummary of the query and the database build stats
+  """
+  kmer_to_lca, database_stats, _ = load_database(args, k, pruned_taxonomy_id_to_parent_id, run_metrics)
+
+  # Steps 3 and 4. Stream the query into pseudoreads and count how many times each of their k-mers
+  # is hit (matches exactly) with a kmer in the database of contaminants.
+  # These methods are found in the pseudoreads.py and get_kmer_hit_counts.py files
+  # Reading the query, classifying its pseudoreads and writing out the classifications
+  # run as a pipeline (see query_pipeline.py), where each pseudoread's classification is streamed
+  # to output_filename and added to the summary counters, so nothing is kept per read
+  host_filter = load_host_filter(args, k, run_metrics)
+
+  with run_metrics.stage("hit_counts"):
+    summary = classification_output.ClassificationSummary()
+    writer = classification_output.ClassificationWriter(output_filename) if output_filename else None
+    pipeline = query_pipeline.QueryPipeline(
+      kmer_to_lca, k, num_workers=args.query_threads, batch_size=args.batch_size, queue_depth=args.queue_depth,
+      host_filter=host_filter
+    )
+    localizer = None
+    if localization_filename:
+      localizer = contig_localization.ContigLocalizer(
+        localization_filename, pipeline.contigs, k, smoothing=args.localize_smoothing
+      )
+    try:
+      pipeline_counters = pipeline.run(args.input_query, summary, writer, localizer)
+    finally:
+      if writer is not None:
+        writer.close()
+      if localizer is not None:
+        run_metrics.count("intervals", localizer.close())
+    run_metrics.count("reads", summary.num_reads)
+    for name, count in pipeline_counters.items():
+      run_metrics.count(name, count)
+    run_metrics.count("reads_classified", summary.num_reads_classified)
+    if isinstance(kmer_to_lca, kmer_database.ShardedKmerIndex):
+      run_metrics.count("shard_loads", kmer_to_lca.shard_loads)
+
+  return summary, database_stats
+
+def load_host_filter(args, k, run_metrics):
+  """
+  Index the k-mers of the --host genome (see host_depletion.py), if one is given, in a stage of
+  its own (stages can't be nested, as each one has its own profiler).
+
+  :return: the HostFilter, or None
+  """
+  if not args.host:
+    return None
+  with run_metrics.stage("host_index"):
+    host_filter = host_depletion.build_host_filter(args.host, k, args.host_threshold, args.host_stride)
+    print(f"Depleting the pseudoreads of the host genome {args.host} ({len(host_filter)} k-mers) before the classification")
+    run_metrics.count("host_kmers", len(host_filter))
+  return host_filter
+
+def estimate_query(args, k, pruned_taxonomy_id_to_parent_id, run_metrics):
+  """
+  Steps 2 to 4 for --estimate: build (or load) the database, and classify a sample of the
+  query's pseudoreads, grown until the intervals of the estimates are narrow enough.
+
+  :return: the AbundanceEstimate of the query and the database build stats
+  """
+  kmer_to_lca, database_stats, _ = load_database(args, k, pruned_taxonomy_id_to_parent_id, run_metrics)
 
-  return parse.parse_args()
+  host_filter = load_host_filter(args, k, run_metrics)
+
+  with run_metrics.stage("estimate"):
+    estimate = abundance_estimation.estimate_abundances(
+      args.input_query,
+      kmer_to_lca,
+      k,
+      args.estimate,
+      seed=args.estimate_seed,
+      sampling=args.estimate_sampling,
+      confidence=args.estimate_confidence,
+      host_filter=host_filter
+    )
+    run_metrics.count("reads", estimate.num_reads)
+    run_metrics.count("reads_sampled", estimate.summary.num_reads)
+    run_metrics.count("reads_classified", estimate.summary.num_reads_classified)
+    run_metrics.count("reads_depleted", estimate.summary.num_reads_depleted)
+    run_metrics.count("sample_rounds", estimate.num_rounds)
+
+  return estimate, database_stats
 
 def main():
 
@@ -100,6 +669,16 @@ def main():
 
   start_time = time.time()
 
+  # Live progress of the long running stages on stderr (see progress.py)
+  if args.progress > 0:
+    progress.configure(args.progress, args.progress_file)
+
+  # Per-stage timing, memory and item counts, written out if --metrics is given
+  run_metrics = metrics.Metrics(
+    profile=args.profile,
+    profile_directory=f"{args.metrics}.profiles" if args.metrics and args.profile == "cprofile" else None
+  )
+
   # Step 0. Pick k
   # the kmer length
   k = args.k
@@ -108,37 +687,90 @@ def main():
 
   # Step 1. Build the taxonomy
   # This method is found in the taxonomy_tree.py file
-  pruned_taxonomy_id_to_node, pruned_taxonomy_id_to_parent_id, pruned_tree_root_node = \
-    taxonomy_tree.build_parent_map(
-      taxonomy_directory=args.taxonomy,
-      custom_taxonomy_ids_filename=args.taxonomy_ids
+  with run_metrics.stage("taxonomy"):
+    pruned_taxonomy_id_to_node, pruned_taxonomy_id_to_parent_id, pruned_tree_root_node = \
+      taxonomy_tree.build_parent_map(
+        taxonomy_directory=args.taxonomy,
+        custom_taxonomy_ids_filename=args.taxonomy_ids
+      )
+    run_metrics.count("taxa", len(pruned_taxonomy_id_to_parent_id))
+
+  # Steps 2 to 4, or their results from the cache (see result_cache.py)
+  # if this query was already classified against the same database
+  cache = None
+  cached_summary = None
+  if args.cache_dir:
+    with run_metrics.stage("cache_lookup"):
+      cache = result_cache.ResultCache(args.cache_dir, kmer_database.parse_memory_size(args.cache_max_size))
+      known_checksums = cache.load_checksums()
+      fingerprint = result_cache.database_fingerprint(
+        args.db, args.taxonomy_ids, k, pruned_taxonomy_id_to_parent_id, known_checksums
+      )
+      cache.save_checksums(known_checksums)
+      options = {"pruning": database_pruning.pruning_options(args.prune_rank, args.dust_threshold)}
+      if args.localize:
+        # an entry without the intervals can't serve a run that asks for them
+        options["localize_smoothing"] = args.localize_smoothing
+      if args.host:
+        # the depleted pseudoreads aren't classified
+        options["host"] = {
+          "sha256": database_manifest.file_checksum(args.host),
+          "threshold": args.host_threshold,
+          "stride": args.host_stride,
+        }
+      if args.estimate is not None:
+        # an estimate isn't the full classification, nor another estimate
+        options["estimate"] = {
+          "width": args.estimate,
+          "sampling": args.estimate_sampling,
+          "seed": args.estimate_seed,
+          "confidence": args.estimate_confidence,
+        }
+      cache_key = cache.key(args.input_query, fingerprint, options=options)
+      cached_summary = cache.get(cache_key)
+
+  estimate = None
+  if args.cohort:
+    # Steps 2 to 4 for every sample of the cohort (see cohort.py)
+    cohort_names, cohort_summaries, database_stats = classify_cohort(args, k, pruned_taxonomy_id_to_parent_id, run_metrics)
+  elif args.estimate is not None:
+    # Steps 2 to 4 for a sample of the pseudoreads (see abundance_estimation.py)
+    if cached_summary is not None:
+      print(f"Using the cached results in {cache.entry_directory(cache_key)}")
+      estimate = abundance_estimation.AbundanceEstimate.from_dict(cached_summary["estimate"])
+      database_stats = cached_summary["database_stats"]
+    else:
+      estimate, database_stats = estimate_query(args, k, pruned_taxonomy_id_to_parent_id, run_metrics)
+      if cache is not None:
+        entry_directory = cache.new_entry(cache_key)
+        cache.put(cache_key, entry_directory, {"estimate": estimate.to_dict(), "database_stats": database_stats})
+    summary = estimate.summary
+  elif cached_summary is not None:
+    print(f"Using the cached results in {cache.entry_directory(cache_key)}")
+    summary = classification_output.ClassificationSummary.from_dict(cached_summary["summary"])
+    database_stats = cached_summary["database_stats"]
+    if args.output:
+      cache.restore_per_read_output(cache_key, args.output)
+    if args.localize:
+      cache.restore_localization(cache_key, args.localize)
+  elif cache is not None:
+    # the per-read output (and the intervals) always go into the new cache entry,
+    # and are copied to --output (and --localize) from there
+    entry_directory = cache.new_entry(cache_key)
+    summary, database_stats = classify_query(
+      args, k, pruned_taxonomy_id_to_parent_id, run_metrics, cache.per_read_filename(entry_directory),
+      cache.localization_filename(entry_directory) if args.localize else None
     )
-
-  # Step 2. After the parent map (i.e. taxonomy tree) is built in taxonomy_tree.py,
-  # We will build the database with actual cross-references to kmers and lcas
-  # This method is found in the kmer_to_lca_mapping.py file
-  # Dict[str, str]
-  kmer_to_lca = \
-    kmer_to_lca_mapping.build_database(
-      args.db,
-      args.taxonomy_ids,
-      k,
-      pruned_taxonomy_id_to_parent_id
+    cache.put(cache_key, entry_directory, {"summary": summary.to_dict(), "database_stats": database_stats})
+    if args.output:
+      cache.restore_per_read_output(cache_key, args.output)
+    if args.localize:
+      cache.restore_localization(cache_key, args.localize)
+  else:
+    summary, database_stats = classify_query(
+      args, k, pruned_taxonomy_id_to_parent_id, run_metrics, args.output, args.localize
     )
 
-  # Step 3. Make the pseudoreads from the query sequence
-  pseudoreads_list = pseudoreads.split_genome_into_pseudo_reads_from_fasta(args.input_query)
-  
-  # Step 4. Scan through the query pseudoreads and count how many times each k-mer
-  # is hit (matches exactly) with a kmer in the database of contaminants.
-  # This method is found in the get_kmer_hit_counts.py file
-  pseudoread_to_hit_counts = {}
-  # total_accumulated_hit_counts = {}
-  for pseudoread in pseudoreads_list:
-    # Feed each psuedoread to the function to get the hit counts
-    hit_counts = get_kmer_hit_counts.get_kmer_hit_counts_with_database_from_psuedoreads(pseudoread, kmer_to_lca, k)
-    pseudoread_to_hit_counts[pseudoread] = hit_counts
-
   # Step 5. print data and summary below of contaminants found
 
   # Dictionary of taxonomy ids to assembly name
@@ -170,46 +802,88 @@ def main():
       '1': "root"
   }
   
-  print("#############################################")  
-  print("############## SUMMARY ######################")
-  print("#############################################")  
-  print()
-  print("############## SEQUENCE CLASSIFICATION ######")
-  print("#############################################")  
-  print_pseudoreads_classified(pseudoread_to_hit_counts, genome_data=genome_data)
-  print()
-  print("###### KMER MATCHES FOR CLASSIFICATION ######")
-  print("#############################################")  
-  print_kmers_classified(pseudoread_to_hit_counts, genome_data=genome_data)
-  print()
-
+  if args.cohort:
+    with run_metrics.stage("summary"):
+      print_cohort_summary(cohort_names, cohort_summaries, genome_data=genome_data)
+      taxa = cohort.write_matrix(args.matrix, cohort_names, cohort_summaries, args.matrix_values)
+      print(f"Abundance matrix of {len(cohort_names)} samples x {len(taxa)} taxa written to {args.matrix}")
+      print()
+    finish(args, run_metrics, start_time)
+
+  with run_metrics.stage("summary"):
+    print("#############################################")  
+    print("############## SUMMARY ######################")
+    print("#############################################")  
+    print()
+    print("############## SEQUENCE CLASSIFICATION ######")
+    print("#############################################")  
+    if args.host:
+      print(f"Pseudoreads depleted as the host genome {args.host}: {summary.num_reads_depleted} of {summary.num_reads} "
+            f"({summary.num_reads_depleted / max(1, summary.num_reads):.2%}{', in the sample' if estimate else ''}), "
+            f"the percentages below are of the rest")
+    if estimate is not None:
+      print_pseudoreads_estimated(estimate, genome_data=genome_data)
+    else:
+      print_pseudoreads_classified(summary.read_counts, genome_data=genome_data)
+    print()
+    print("###### KMER MATCHES FOR CLASSIFICATION ######")
+    print("#############################################")  
+    # the k-mers of the depleted pseudoreads are never looked up, so they aren't in these counts
+    not_depleted = ""
+    if args.host:
+      not_depleted = f" (only the {summary.num_reads - summary.num_reads_depleted} pseudoreads not depleted as the host)"
+      print(f"K-mer hits{not_depleted}, {summary.num_reads_depleted} pseudoreads depleted:")
+    print_kmers_classified(summary.kmer_counts, genome_data=genome_data)
+    print()
+    # k-mers with a base other than A, C, G or T are neither stored nor looked up
+    print(f"K-mers skipped for ambiguous bases: {summary.num_ambiguous_kmers} in the {'sample' if estimate else 'query'}"
+          f"{not_depleted}, {database_stats.get('ambiguous_kmers_skipped', 0)} in the database build")
+    if args.prune_rank or args.dust_threshold is not None:
+      # how much each filter shrank the table (only known when the database was just built)
+      database_size = database_stats.get("new_kmers", 0) + database_stats.get("low_complexity_kmers_pruned", 0)
+      filters = []
+      if args.dust_threshold is not None:
+        filters.append(("low_complexity_kmers_pruned", f"with a DUST score above {args.dust_threshold}"))
+      if args.prune_rank:
+        filters.append(("rank_kmers_pruned", f"with an LCA at or above {args.prune_rank}"))
+      for name, description in filters:
+        if name in database_stats:
+          print(f"K-mers pruned {description}: {database_stats[name]} "
+                f"({database_stats[name] / max(1, database_size):.2%} of the database)")
+    print()
+    if args.localize:
+      print("############## CONTAMINANT LOCALIZATION #####")
+      print("#############################################")
+      print_localized_intervals(contig_localization.read_intervals(args.localize), genome_data=genome_data)
+      print(f"Intervals written to {args.localize}")
+      print()
+
+  finish(args, run_metrics, start_time)
+
+def finish(args, run_metrics, start_time):
+  """
+  Prints how long the program took, writes the --metrics report and exits.
+  """
+  progress.reporter.close()
   end_time = time.time()
   print("############## TIME TAKEN ###################")
   print(f"Total time taken: {end_time - start_time} seconds")
 
+  if args.metrics:
+    run_metrics.write(args.metrics)
+    print(f"Metrics written to {args.metrics}")
+
   # The program has finished at this point
   exit(0)
 
 
 # Step 6. print data and summary below of contaminants found
-def print_pseudoreads_classified(pseudoread_to_hit_counts, genome_data):
+def print_pseudoreads_classified(tax_count, genome_data):
   """
   Prints to stdout a summary of what percentage of pseudoreads
-  were mapped to each contaminant
+  were mapped to each contaminant, given how many pseudoreads were
+  classified as each taxonomy id (ClassificationSummary.read_counts)
   """
-  tax_count = {}
-  for pseudoread, hit_counts in pseudoread_to_hit_counts.items():
-      # Find what the pseudoread mapped to the most
-      # add a bounds check to avoid an error in
-      # the case where hit_counts is empty
-      if len(hit_counts) != 0:
-        taxonomy_id_with_max_hits = \
-          max(hit_counts.keys(), key=lambda x : hit_counts[x])
-        # Keep track of what taxonomy ids have been mapped to so far and how often
-        if taxonomy_id_with_max_hits in tax_count:
-            tax_count[taxonomy_id_with_max_hits] += 1
-        else:
-            tax_count[taxonomy_id_with_max_hits] = 1
   print("Psuedoreads classified:")
   total_hit_count = sum(tax_count.values())
   for taxonomy_id, count in tax_count.items():
@@ -220,29 +894,48 @@ def print_pseudoreads_classified(pseudoread_to_hit_counts, genome_data):
       
   print()
   for tax_id, count in tax_count.items():
-    if taxonomy_id in genome_data:
-      print(f"Tax ID: {tax_id}, {genome_data[taxonomy_id]}, Number of Pseudoreads: {count}")
+    if tax_id in genome_data:
+      print(f"Tax ID: {tax_id}, {genome_data[tax_id]}, Number of Pseudoreads: {count}")
     else:
       print(f"Tax ID: {tax_id}, Number of Pseudoreads: {count}")
 
   print()
 
+# Step 6. print data and summary below of contaminants estimated from a sample of the pseudoreads
+def print_pseudoreads_estimated(estimate, genome_data):
+  """
+  Prints to stdout the same percentages as print_pseudoreads_classified, as estimated
+  from a sample of the pseudoreads (an AbundanceEstimate), with their confidence intervals
+  """
+  summary = estimate.summary
+  (classified, classified_low, classified_high), taxa = estimate.intervals()
+  confidence = f"{estimate.confidence:.0%} CI"
+  print(f"Estimated from a {estimate.sampling} sample of {summary.num_reads} of {estimate.num_reads} pseudoreads "
+        f"({summary.num_reads / max(1, estimate.num_reads):.2%}, seed {estimate.seed})")
+  print(f"{round(classified*100, 2)}% of pseudoreads classified ({confidence}: "
+        f"{round(classified_low*100, 2)}%-{round(classified_high*100, 2)}%)")
+  print("Psuedoreads classified:")
+  for taxonomy_id, (fraction, low, high) in taxa.items():
+    name = f", {genome_data[taxonomy_id]}" if taxonomy_id in genome_data else ""
+    print(f"{round(fraction*100, 2)}% of reads mapped to Taxonomy ID {taxonomy_id}{name} "
+          f"({confidence}: {round(low*100, 2)}%-{round(high*100, 2)}%)")
+
+  print()
+  for tax_id, count in summary.read_counts.items():
+    name = f", {genome_data[tax_id]}" if tax_id in genome_data else ""
+    print(f"Tax ID: {tax_id}{name}, Number of Pseudoreads: {count} sampled, "
+          f"about {round(count / max(1, summary.num_reads) * estimate.num_reads)} in the query")
+
+  print()
+
 # Step 6. print data and summary below of kmer hits
-def print_kmers_classified(reads_dict, genome_data):
+def print_kmers_classified(tax_count, genome_data):
   """
   Prints to stdout a summary of how many kmers from the pseudoreads
-  were mapped to each taxid inputted into the database
+  were mapped to each taxid inputted into the database, given the total
+  number of kmer hits to each taxonomy id (ClassificationSummary.kmer_counts)
   """
-  tax_count = {}
-  overal = 0
-  for tax_info in reads_dict.values():
-      for tax_id, count in tax_info.items():
-          if tax_id in tax_count:
-              tax_count[tax_id] += count
-              overal += count
-          else:
-              tax_count[tax_id] = count
-              overal += count
+  overal = sum(tax_count.values())
   
   for tax_id, total_count in tax_count.items():
     if tax_id in genome_data:
@@ -252,5 +945,35 @@ def print_kmers_classified(reads_dict, genome_data):
 
     print(f"Total Accumulated Hit Counts: {total_count} out of {overal}\n")
 
+# Step 6. print data and summary below of where the contaminants are
+def print_localized_intervals(intervals, genome_data, max_intervals=20):
+  """
+  Prints to stdout the first max_intervals intervals of the query's contigs
+  that the contaminants were localized to (as read back from the --localize BED file)
+  """
+  for contig, start, end, tax_id, score in intervals[:max_intervals]:
+    name = f", {genome_data[tax_id]}" if tax_id in genome_data else ""
+    print(f"{contig}:{start + 1}-{end} ({end - start} bp): Tax ID: {tax_id}{name}, "
+          f"{score / 10:.1f}% of its pseudoreads classified as it before smoothing")
+  if len(intervals) > max_intervals:
+    print(f"... and {len(intervals) - max_intervals} more")
+
+# Step 6. print data and summary below of the contaminants found in every sample of a cohort
+def print_cohort_summary(names, summaries, genome_data, max_taxa=3):
+  """
+  Prints to stdout, for every sample of a cohort, how many of its pseudoreads were classified
+  (and depleted as the --host), and what percentage of them were mapped to its max_taxa most common taxonomy ids
+  """
+  for name, summary in zip(names, summaries):
+    tax_count = summary["read_counts"]
+    total_hit_count = sum(tax_count.values())
+    top_taxa = sorted(tax_count.items(), key=lambda item: -item[1])[:max_taxa]
+    mapped = "; ".join(
+      f"{round(count/total_hit_count*100, 2)}% {tax_id}" + (f" ({genome_data[tax_id]})" if tax_id in genome_data else "")
+      for tax_id, count in top_taxa
+    )
+    depleted = f" ({summary['num_reads_depleted']} depleted as the host)" if summary["num_reads_depleted"] else ""
+    print(f"{name}: {summary['num_reads_classified']} of {summary['num_reads']} pseudoreads classified{depleted}" + (f", {mapped}" if mapped else ""))
+
 if __name__ == "__main__":
   main()
\ No newline at end of file
@@ -0,0 +1,195 @@
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+"""
+metrics.py
+
+A lightweight instrumentation layer for recording where time and memory go
+in each stage of main.py (taxonomy, database build, pseudoreads, hit counting
+and summary).
+
+For every stage we record
+
+  - wall time and CPU time
+  - the resident set size (RSS) at the start and end of the stage, and how much
+    the peak RSS of the process grew during the stage
+  - item counters (bases read, k-mers inserted, LCA calls, lookups, hits, ...)
+    that the code running in the stage adds to with Metrics.count
+
+Optionally, a stage can also be profiled with cProfile (top functions by cumulative
+time) or tracemalloc (top allocation sites by size), behind the --profile option.
+
+The recorded metrics are written out as a JSON report with Metrics.write.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Profilers that can be enabled with --profile
+PROFILERS = ["cprofile", "tracemalloc"]
+
+# Number of functions / allocation sites kept per stage in the report when profiling
+PROFILE_TOP_N = 25
+
+def peak_rss_bytes() -> int:
+  """
+  Peak resident set size of this process so far, in bytes.
+  (ru_maxrss is in kilobytes on Linux but in bytes on macOS)
+  """
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak if sys.platform == "darwin" else peak * 1024
+
+def current_rss_bytes() -> Optional[int]:
+  """
+  Current resident set size of this process in bytes, or None
+  if it can't be read on this platform (it is read from /proc on Linux).
+  """
+  try:
+    with open("/proc/self/statm", 'r') as fp:
+      return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, IndexError):
+    return None
+
+class Metrics:
+  """
+  Collects per-stage timing, memory and counter metrics.
+
+  Usage:
+
+    metrics = Metrics()
+    with metrics.stage("database"):
+      ...
+      metrics.count("kmers_inserted", n)
+    metrics.write("out.json")
+  """
+  def __init__(self, profile : Optional[str] = None, profile_directory : Optional[str] = None):
+    self.profile = profile
+    # where to write the raw cProfile .prof files, if anywhere
+    self.profile_directory = profile_directory
+    self.stages : List[Dict[str, object]] = []
+    self.current_stage : Optional[Dict[str, object]] = None
+    self.start_time = time.perf_counter()
+    self.start_cpu_time = time.process_time()
+    if profile not in (None, *PROFILERS):
+      raise ValueError(f"Unknown profiler {profile}, expected one of {PROFILERS}")
+    if profile == "tracemalloc":
+      tracemalloc.start()
+
+  @contextmanager
+  def stage(self, name : str):
+    """
+    Record the metrics of the code run inside the with block as stage `name`.
+    """
+    stage : Dict[str, object] = {"name": name, "counters": {}}
+    previous_stage = self.current_stage
+    self.current_stage = stage
+
+    rss_before = current_rss_bytes()
+    peak_rss_before = peak_rss_bytes()
+    profiler = None
+    snapshot_before = None
+    if self.profile == "cprofile":
+      profiler = cProfile.Profile()
+      profiler.enable()
+    elif self.profile == "tracemalloc":
+      snapshot_before = tracemalloc.take_snapshot()
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+
+    try:
+      yield stage
+    finally:
+      stage["wall_seconds"] = time.perf_counter() - start_time
+      stage["cpu_seconds"] = time.process_time() - start_cpu_time
+      if profiler is not None:
+        profiler.disable()
+        stage["profile"] = self.summarize_cprofile(profiler, name)
+      elif snapshot_before is not None:
+        stage["profile"] = self.summarize_tracemalloc(snapshot_before)
+      stage["rss_before_bytes"] = rss_before
+      stage["rss_after_bytes"] = current_rss_bytes()
+      stage["peak_rss_bytes"] = peak_rss_bytes()
+      stage["peak_rss_delta_bytes"] = stage["peak_rss_bytes"] - peak_rss_before
+      self.stages.append(stage)
+      self.current_stage = previous_stage
+
+  def count(self, counter : str, n : int = 1) -> None:
+    """
+    Add n to the counter named `counter` of the current stage.
+    Call this once per batch of items rather than once per item in hot loops.
+    """
+    if self.current_stage is None:
+      return
+    counters = self.current_stage["counters"]
+    counters[counter] = counters.get(counter, 0) + n
+
+  def summarize_cprofile(self, profiler : cProfile.Profile, stage_name : str) -> List[Dict[str, object]]:
+    """
+    The PROFILE_TOP_N functions with the highest cumulative time in the stage.
+    """
+    if self.profile_directory is not None:
+      os.makedirs(self.profile_directory, exist_ok=True)
+      profiler.dump_stats(os.path.join(self.profile_directory, f"{stage_name}.prof"))
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line_number, function_name), (_, num_calls, total_time, cumulative_time, _) in stats.stats.items():
+      rows.append({
+        "function": f"{os.path.basename(filename)}:{line_number}({function_name})",
+        "calls": num_calls,
+        "total_seconds": total_time,
+        "cumulative_seconds": cumulative_time,
+      })
+    rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+    return rows[:PROFILE_TOP_N]
+
+  def summarize_tracemalloc(self, snapshot_before) -> List[Dict[str, object]]:
+    """
+    The PROFILE_TOP_N source lines whose allocations grew the most during the stage.
+    """
+    snapshot_after = tracemalloc.take_snapshot()
+    differences = snapshot_after.compare_to(snapshot_before, "lineno")
+    return [
+      {
+        "location": str(difference.traceback),
+        "size_delta_bytes": difference.size_diff,
+        "size_bytes": difference.size,
+        "count_delta": difference.count_diff,
+      }
+      for difference in differences[:PROFILE_TOP_N]
+    ]
+
+  def report(self) -> Dict[str, object]:
+    """
+    All recorded metrics as a JSON serializable dictionary.
+    """
+    return {
+      "argv": sys.argv,
+      "wall_seconds": time.perf_counter() - self.start_time,
+      "cpu_seconds": time.process_time() - self.start_cpu_time,
+      "peak_rss_bytes": peak_rss_bytes(),
+      "profile": self.profile,
+      "stages": self.stages,
+    }
+
+  def write(self, filename : str) -> None:
+    """
+    Write the JSON report to filename.
+    """
+    with open(filename, 'w') as fp:
+      json.dump(self.report(), fp, indent=2)
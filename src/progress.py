@@ -0,0 +1,287 @@
+import os
+import sys
+import time
+import resource
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, TextIO
+
+# helper files
+from metrics import current_rss_bytes
+
+"""
+progress.py
+
+Live progress and throughput telemetry for the long running stages (the database build
+and the query), so that a production run can be watched, and a stall
+or swap pressure spotted, while it runs rather than afterwards.
+
+The code running a stage opens a task with task() and adds to it as it goes:
+
+  with progress.task("database", unit="bases", total=total_bases) as database_progress:
+    for block in ...:
+      ...
+      database_progress.advance(len(block), kmers=num_kmers)
+      database_progress.set("table_size", len(kmer_to_lca))
+
+Adding to a task only adds to a few integers, and the hot loops do it once per batch (a block,
+a run of k-mers, a batch of pseudoreads) rather than once per k-mer, so it costs next to
+nothing. Everything else happens on a reporter thread that wakes up every interval seconds
+and, for every open task,
+
+  - prints a line to stderr with how far it got (and out of how much), its throughput in units
+    and in every other counter per second since the last report, its gauges (e.g. the number of
+    k-mers in the table), the RSS and swapped out memory of the process, the major page faults
+    per second and an ETA, or for how long it has made no progress at all
+  - rewrites a Prometheus text file (e.g. for the node exporter's textfile collector) with the
+    same numbers, if one was given, atomically so that a scrape never sees half of it
+
+Nothing is printed for a task that finishes within the first interval, so short runs are as quiet as before.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Seconds between progress reports, unless --progress says otherwise
+DEFAULT_INTERVAL = 10.0
+
+# Prefix of the metric names in the Prometheus text file
+METRIC_PREFIX = "contaminant_classifier"
+
+class ProgressTask:
+  """
+  The progress of one stage: how many units of it are done (out of total, if known),
+  other counters (e.g. k-mers) and gauges (e.g. the size of the table).
+  """
+  def __init__(self, stage : str, unit : str, total : Optional[int] = None):
+    self.stage = stage
+    self.unit = unit
+    self.total = total
+    self.done = 0
+    self.counters : Dict[str, int] = {}
+    self.gauges : Dict[str, int] = {}
+    self.start_time = time.monotonic()
+    # when anything was last added, to tell a stall
+    self.last_advance_time = self.start_time
+
+  def advance(self, n : int, **counters : int) -> None:
+    """
+    Add n units done, and counts to the other counters.
+    """
+    self.done += n
+    for name, count in counters.items():
+      self.counters[name] = self.counters.get(name, 0) + count
+    if n or counters:
+      self.last_advance_time = time.monotonic()
+
+  def set(self, name : str, value : int) -> None:
+    """
+    Set a gauge to its current value.
+    """
+    self.gauges[name] = value
+
+def format_count(n : float) -> str:
+  for factor, suffix in ((1e9, "G"), (1e6, "M"), (1e3, "k")):
+    if abs(n) >= factor:
+      return f"{n / factor:.2f}{suffix}"
+  return f"{n:.0f}" if n == int(n) else f"{n:.2f}"
+
+def format_bytes(n : Optional[int]) -> str:
+  if n is None:
+    return "?"
+  for factor, suffix in ((1 << 30, "GiB"), (1 << 20, "MiB"), (1 << 10, "KiB")):
+    if n >= factor:
+      return f"{n / factor:.1f} {suffix}"
+  return f"{n} B"
+
+def format_seconds(seconds : float) -> str:
+  seconds = int(seconds)
+  return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def swapped_bytes() -> Optional[int]:
+  """
+  How much of this process is swapped out, in bytes, or None if it can't be
+  read on this platform (it is read from /proc on Linux).
+  """
+  try:
+    with open("/proc/self/status", 'r') as fp:
+      for line in fp:
+        if line.startswith("VmSwap:"):
+          return int(line.split()[1]) * 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+class ProgressReporter:
+  """
+  Reports the progress of the open tasks every interval seconds (never, if interval is 0)
+  to stream and to the Prometheus text file prometheus_filename (if any), on a thread of its own.
+  """
+  def __init__(self, interval : float = 0, prometheus_filename : Optional[str] = None, stream : TextIO = sys.stderr):
+    self.interval = interval
+    self.prometheus_filename = prometheus_filename
+    self.stream = stream
+    self.tasks : List[ProgressTask] = []
+    self.tasks_lock = threading.Lock()
+    # (time, done, counters) of every task at the last report, for the rates since then
+    self.previous : Dict[int, tuple] = {}
+    self.previous_major_faults = (time.monotonic(), resource.getrusage(resource.RUSAGE_SELF).ru_majflt)
+    self.stopped = threading.Event()
+    self.thread : Optional[threading.Thread] = None
+    if interval > 0:
+      self.thread = threading.Thread(target=self.run, name="progress-reporter", daemon=True)
+      self.thread.start()
+
+  @contextmanager
+  def task(self, stage : str, unit : str = "bases", total : Optional[int] = None):
+    """
+    Open a task for the code run inside the with block.
+    """
+    progress_task = ProgressTask(stage, unit, total)
+    with self.tasks_lock:
+      self.tasks.append(progress_task)
+    try:
+      yield progress_task
+    finally:
+      with self.tasks_lock:
+        self.tasks.remove(progress_task)
+      self.previous.pop(id(progress_task), None)
+
+  def run(self) -> None:
+    while not self.stopped.wait(self.interval):
+      self.report()
+
+  def report(self) -> None:
+    """
+    Report the progress of every open task now.
+    """
+    now = time.monotonic()
+    with self.tasks_lock:
+      # not the ones opened since the last report, which may be over before the next one
+      tasks = [progress_task for progress_task in self.tasks if now - progress_task.start_time >= self.interval]
+    rss = current_rss_bytes()
+    swap = swapped_bytes()
+    major_faults = resource.getrusage(resource.RUSAGE_SELF).ru_majflt
+    previous_time, previous_faults = self.previous_major_faults
+    fault_rate = (major_faults - previous_faults) / max(now - previous_time, 1e-9)
+    self.previous_major_faults = (now, major_faults)
+
+    samples = []
+    for progress_task in tasks:
+      done = progress_task.done
+      counters = dict(progress_task.counters)
+      gauges = dict(progress_task.gauges)
+      previous_time, previous_done, previous_counters = self.previous.get(
+        id(progress_task), (progress_task.start_time, 0, {})
+      )
+      elapsed = max(now - previous_time, 1e-9)
+      rates = {progress_task.unit: (done - previous_done) / elapsed}
+      for name, count in counters.items():
+        rates[name] = (count - previous_counters.get(name, 0)) / elapsed
+      self.previous[id(progress_task)] = (now, done, counters)
+      # from the average rate since the start, as units may be added in large blocks
+      eta = None
+      if progress_task.total and done > 0:
+        eta = max(0, progress_task.total - done) * (now - progress_task.start_time) / done
+      samples.append((progress_task, done, counters, gauges, rates, eta, now - progress_task.last_advance_time))
+
+    for progress_task, done, counters, gauges, rates, eta, idle in samples:
+      parts = [f"{format_count(done)} {progress_task.unit}"]
+      if progress_task.total:
+        parts[0] += f" of {format_count(progress_task.total)} ({min(done / progress_task.total, 1):.1%})"
+      parts += [f"{format_count(rate)} {name}/s" for name, rate in rates.items()]
+      parts += [f"{name} {format_count(value)}" for name, value in gauges.items()]
+      parts.append(f"RSS {format_bytes(rss)}")
+      if swap:
+        parts.append(f"swapped {format_bytes(swap)}")
+      if fault_rate:
+        parts.append(f"{fault_rate:.0f} major faults/s")
+      if idle >= max(self.interval, 1):
+        parts.append(f"no progress for {format_seconds(idle)}")
+      elif eta is not None:
+        parts.append(f"ETA {format_seconds(eta)}")
+      print(f"[progress] {progress_task.stage}: " + ", ".join(parts), file=self.stream, flush=True)
+
+    if self.prometheus_filename:
+      self.write_prometheus(samples, rss, swap, major_faults)
+
+  def write_prometheus(self, samples : list, rss : Optional[int], swap : Optional[int], major_faults : int) -> None:
+    """
+    Rewrite the Prometheus text file with the latest progress.
+    """
+    lines = []
+    def metric(name, kind, help_text, values):
+      lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+      lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+      for labels, value in values:
+        label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value}" if label_text else f"{METRIC_PREFIX}_{name} {value}")
+
+    metric("progress_done", "counter", "Units of the stage done so far.", [
+      ({"stage": task.stage, "unit": task.unit}, done) for task, done, _, _, _, _, _ in samples
+    ])
+    metric("progress_total", "gauge", "Units of the stage in all, where known.", [
+      ({"stage": task.stage, "unit": task.unit}, task.total) for task, _, _, _, _, _, _ in samples if task.total
+    ])
+    metric("progress_counter", "counter", "Other counters of the stage.", [
+      ({"stage": task.stage, "counter": name}, count)
+      for task, _, counters, _, _, _, _ in samples for name, count in counters.items()
+    ])
+    metric("progress_rate", "gauge", "Units and counters of the stage per second since the last report.", [
+      ({"stage": task.stage, "counter": name}, f"{rate:.3f}")
+      for task, _, _, _, rates, _, _ in samples for name, rate in rates.items()
+    ])
+    metric("progress_gauge", "gauge", "Gauges of the stage, such as the size of the table.", [
+      ({"stage": task.stage, "gauge": name}, value)
+      for task, _, _, gauges, _, _, _ in samples for name, value in gauges.items()
+    ])
+    metric("progress_eta_seconds", "gauge", "Estimated seconds until the stage is done.", [
+      ({"stage": task.stage}, f"{eta:.1f}") for task, _, _, _, _, eta, _ in samples if eta is not None
+    ])
+    metric("progress_idle_seconds", "gauge", "Seconds since the stage last made progress.", [
+      ({"stage": task.stage}, f"{idle:.1f}") for task, _, _, _, _, _, idle in samples
+    ])
+    metric("resident_memory_bytes", "gauge", "Resident set size of the process.", [({}, rss)] if rss is not None else [])
+    metric("swapped_memory_bytes", "gauge", "Swapped out memory of the process.", [({}, swap)] if swap is not None else [])
+    metric("major_page_faults_total", "counter", "Major page faults of the process.", [({}, major_faults)])
+    metric("last_report_timestamp_seconds", "gauge", "When this file was last written.", [({}, f"{time.time():.3f}")])
+
+    temporary_filename = f"{self.prometheus_filename}.tmp-{os.getpid()}"
+    with open(temporary_filename, 'w') as fp:
+      fp.write("\n".join(lines) + "\n")
+    os.replace(temporary_filename, self.prometheus_filename)
+
+  def close(self) -> None:
+    """
+    Stop reporting, rewriting the Prometheus text file one last time.
+    """
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+      if self.prometheus_filename:
+        self.report()
+
+# The reporter of this process, which reports nothing until configure() is called
+reporter = ProgressReporter()
+
+def configure(interval : float = DEFAULT_INTERVAL, prometheus_filename : Optional[str] = None) -> ProgressReporter:
+  """
+  Start reporting the progress of this process every interval seconds (see ProgressReporter).
+  """
+  global reporter
+  reporter.close()
+  reporter = ProgressReporter(interval, prometheus_filename)
+  return reporter
+
+def task(stage : str, unit : str = "bases", total : Optional[int] = None):
+  """
+  Open a task of the reporter of this process (see ProgressReporter.task).
+  """
+  return reporter.task(stage, unit, total)
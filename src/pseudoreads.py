@@ -1,11 +1,31 @@
+import gzip
+
+# Number of bases read from the FASTA file at once while streaming it
+FASTA_BLOCK_SIZE = 1 << 20
+
+# Length of the pseudo-reads a query is cut into, and the overlap of consecutive ones
+READ_LENGTH = 100
+READ_OVERLAP = 50
+
+def open_fasta_file(fasta_file_path, binary=False):
+    # Opens a FASTA file for reading as text (or as bytes), decompressing it if its name ends in .gz.
+    # Parameters:
+    # fasta_file_path (str): The path to the FASTA file.
+    # binary (bool): Whether to open it for reading bytes rather than text.
+    # Returns:
+    # file: The opened file.
+    if fasta_file_path.endswith(".gz"):
+        return gzip.open(fasta_file_path, 'rb' if binary else 'rt')
+    return open(fasta_file_path, 'rb' if binary else 'r')
+
 def read_fasta_file(fasta_file_path):
-    # Reads a FASTA file and returns the sequence as a string.
+    # Reads a FASTA file (gzip compressed if its name ends in .gz) and returns the sequence as a string.
     # Parameters:
     # fasta_file_path (str): The path to the FASTA file.
     # Returns:
     # str: The genome sequence from the FASTA file.
     sequence = ""
-    with open(fasta_file_path, 'r') as file:
+    with open_fasta_file(fasta_file_path) as file:
         for line in file:
             # Skip the header line
             if line.startswith('>'):
@@ -14,7 +34,78 @@ def read_fasta_file(fasta_file_path):
             sequence += line.strip()
     return sequence
 
-def split_genome_into_pseudo_reads_from_fasta(fasta_file_path, read_length=100, overlap=50):
+def iter_pseudo_reads(genome_sequence, read_length=READ_LENGTH, overlap=READ_OVERLAP):
+    # Yields the overlapping pseudo-reads of a genome sequence one at a time,
+    # so that they never all have to be held in memory at once.
+    # Parameters:
+    # genome_sequence (str): The genome sequence.
+    # read_length (int): The length of each pseudo-read.
+    # overlap (int): The length of the overlap between consecutive reads.
+    # Yields:
+    # str: The pseudo-reads, in order along the genome.
+
+    # Calculate the step size for the next read (read length minus overlap)
+    step_size = read_length - overlap
+    for i in range(0, len(genome_sequence) - read_length + 1, step_size):
+        yield genome_sequence[i:i + read_length]
+
+def iter_fasta_blocks(fasta_file_path, block_size=FASTA_BLOCK_SIZE, contigs=None):
+    # Streams the sequence of a FASTA file (gzip compressed if its name ends in .gz)
+    # in blocks of about block_size bases, without ever holding all of it in memory.
+    # Concatenating the blocks gives the same sequence as read_fasta_file.
+    # Parameters:
+    # fasta_file_path (str): The path to the FASTA file.
+    # block_size (int): The number of bases per block.
+    # contigs (list): If given, the (name, start) of every contig, i.e. the first word of its
+    #   header and where its bases start in the concatenated sequence, is appended to it
+    #   as its header is read (before any of its bases are yielded).
+    # Yields:
+    # str: The blocks of the genome sequence, in order.
+    lines = []
+    num_bases = 0
+    # bases yielded so far
+    position = 0
+    with open_fasta_file(fasta_file_path) as file:
+        for line in file:
+            # Skip the header line
+            if line.startswith('>'):
+                if contigs is not None:
+                    words = line[1:].split()
+                    contigs.append((words[0] if words else "", position + num_bases))
+                continue
+            line = line.strip()
+            lines.append(line)
+            num_bases += len(line)
+            if num_bases >= block_size:
+                yield "".join(lines)
+                position += num_bases
+                lines = []
+                num_bases = 0
+    if lines:
+        yield "".join(lines)
+
+def iter_pseudo_reads_from_blocks(blocks, read_length=READ_LENGTH, overlap=READ_OVERLAP):
+    # Yields the same pseudo-reads as iter_pseudo_reads, from a genome sequence
+    # given as consecutive blocks (e.g. from iter_fasta_blocks), so that only
+    # about one block of it is held in memory at a time.
+    # Parameters:
+    # blocks (iterable of str): The consecutive blocks of the genome sequence.
+    # read_length (int): The length of each pseudo-read.
+    # overlap (int): The length of the overlap between consecutive reads.
+    # Yields:
+    # str: The pseudo-reads, in order along the genome.
+    step_size = read_length - overlap
+    # the sequence from the start of the next pseudo-read onwards
+    remainder = ""
+    for block in blocks:
+        remainder += block
+        start = 0
+        while start + read_length <= len(remainder):
+            yield remainder[start:start + read_length]
+            start += step_size
+        remainder = remainder[start:]
+
+def split_genome_into_pseudo_reads_from_fasta(fasta_file_path, read_length=READ_LENGTH, overlap=READ_OVERLAP):
     # Splits a genome sequence from a FASTA file into overlapping pseudo-reads.
     # Parameters:
     # fasta_file_path (str): The path to the FASTA file containing the genome sequence.
@@ -25,17 +116,8 @@ def split_genome_into_pseudo_reads_from_fasta(fasta_file_path, read_length=100,
     
     # Read the genome sequence from the FASTA file
     genome_sequence = read_fasta_file(fasta_file_path)
-    # Calculate the step size for the next read (read length minus overlap)
-    step_size = read_length - overlap
-    # Initialize an empty list to store the pseudo-reads
-    pseudo_reads = []
-    # Iterate over the genome sequence to create pseudo-reads
-    for i in range(0, len(genome_sequence) - read_length + 1, step_size):
-        # Extract the pseudo-read from the genome sequence
-        read = genome_sequence[i:i + read_length]
-        # Add the pseudo-read to the list
-        pseudo_reads.append(read)
-    return pseudo_reads
+    # Collect the pseudo-reads of the genome sequence into a list
+    return list(iter_pseudo_reads(genome_sequence, read_length, overlap))
 
 
 #pseudo_reads = split_genome_into_pseudo_reads_from_fasta("ncbi_dataset/ncbi_dataset/data/GCA_001500975.1/GCA_001500975.1_ViralProj306529_genomic.fna")
\ No newline at end of file
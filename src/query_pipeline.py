@@ -0,0 +1,263 @@
+import os
+import queue
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# helper files
+import pseudoreads
+import get_kmer_hit_counts
+import classification_output
+import contig_localization
+import progress
+import host_depletion
+
+"""
+query_pipeline.py
+
+Steps 3 and 4 as a pipeline, so that reading (and decompressing) the query, classifying its
+pseudoreads and writing out the results overlap instead of running one after the other:
+
+  reader  --(read queue)-->  workers  --(result queue)-->  writer
+
+  - the reader thread streams the query file (gzip compressed if it ends in .gz) in blocks,
+    cuts it into pseudoreads and puts them on the read queue in batches
+  - every worker thread takes a batch, looks up the k-mers of its pseudoreads and classifies them
+    (after depleting the host's pseudoreads, if a host filter is given, see host_depletion.py)
+  - the writer (the calling thread) puts the batches back in read order, streams them to the
+    per-read output and adds them to the summary (and the contig localization, if any)
+
+Both queues are bounded, so a stage that falls behind makes the stage before it wait
+(backpressure) rather than letting batches pile up in memory: at most about
+(2 * queue depth + number of workers) batches are ever in flight. How often the reader
+had to wait for the workers, and the workers for the writer, is counted, to tell which stage
+is the bottleneck.
+
+Reads and decompression (zlib releases the GIL) run while the workers classify. The workers
+share the GIL with each other, so more than one of them only helps while the others wait
+on the database (e.g. on the pages of a memory mapped index or shard being read from disk).
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Number of pseudoreads per batch
+DEFAULT_BATCH_SIZE = 256
+
+# Most batches waiting in each of the queues
+DEFAULT_QUEUE_DEPTH = 8
+
+# Seconds a blocked stage waits before checking whether the pipeline was stopped
+POLL_SECONDS = 0.1
+
+# Put on the queues to tell the next stage there is nothing more to come
+END_OF_STREAM = None
+
+class QueryPipeline:
+  """
+  Classifies every pseudoread of a query file against kmer_to_lca (anything supporting the same
+  lookups as the kmer_to_lca dictionary) on a reader thread, num_workers worker threads and the
+  calling thread as the writer (see the top of this file).
+  """
+  def __init__(
+      self,
+      kmer_to_lca,
+      k : int,
+      num_workers : int = 1,
+      batch_size : int = DEFAULT_BATCH_SIZE,
+      queue_depth : int = DEFAULT_QUEUE_DEPTH,
+      host_filter : Optional[host_depletion.HostFilter] = None):
+    self.kmer_to_lca = kmer_to_lca
+    self.host_filter = host_filter
+    self.k = k
+    self.num_workers = max(1, num_workers)
+    self.batch_size = max(1, batch_size)
+    self.read_queue : queue.Queue = queue.Queue(maxsize=max(1, queue_depth))
+    self.result_queue : queue.Queue = queue.Queue(maxsize=max(1, queue_depth))
+    # set when a stage fails, so that the others stop instead of waiting on it forever
+    self.stopped = threading.Event()
+    self.errors : List[BaseException] = []
+    self.counters : Dict[str, int] = {}
+    self.counters_lock = threading.Lock()
+    # the (name, start) of every contig of the query, recorded by the reader as it goes
+    self.contigs : List[Tuple[str, int]] = []
+
+  def count(self, counters : Dict[str, int]) -> None:
+    with self.counters_lock:
+      for name, n in counters.items():
+        self.counters[name] = self.counters.get(name, 0) + n
+
+  def put(self, destination : queue.Queue, item, waits_counter : str) -> bool:
+    """
+    Put item on the destination queue, waiting while it is full (counting the wait once).
+
+    @return: False if the pipeline was stopped before the item could be put
+    """
+    waited = False
+    while not self.stopped.is_set():
+      try:
+        destination.put(item, timeout=POLL_SECONDS)
+        return True
+      except queue.Full:
+        if not waited:
+          self.count({waits_counter: 1})
+          waited = True
+    return False
+
+  def get(self, source : queue.Queue):
+    """
+    Take the next item off the source queue, re-raising the error of any stage that failed meanwhile.
+    """
+    while True:
+      if self.errors:
+        raise self.errors[0]
+      try:
+        return source.get(timeout=POLL_SECONDS)
+      except queue.Empty:
+        continue
+
+  def run_stage(self, stage, *stage_args) -> None:
+    try:
+      stage(*stage_args)
+    except BaseException as e:
+      self.errors.append(e)
+      self.stopped.set()
+
+  def read(self, query_filename : str) -> None:
+    """
+    The reader stage: stream the query into batches of (batch number, first read number, pseudoreads).
+    """
+    try:
+      batch : List[str] = []
+      batch_number = 0
+      first_read_number = 1
+      blocks = pseudoreads.iter_fasta_blocks(query_filename, contigs=self.contigs)
+      for pseudoread in pseudoreads.iter_pseudo_reads_from_blocks(blocks):
+        batch.append(pseudoread)
+        if len(batch) >= self.batch_size:
+          if not self.put(self.read_queue, (batch_number, first_read_number, batch), "reader_waits"):
+            return
+          batch_number += 1
+          first_read_number += len(batch)
+          batch = []
+      if batch:
+        self.put(self.read_queue, (batch_number, first_read_number, batch), "reader_waits")
+    finally:
+      for _ in range(self.num_workers):
+        self.put(self.read_queue, END_OF_STREAM, "reader_waits")
+
+  def classify(self) -> None:
+    """
+    A worker stage: classify the pseudoreads of every batch until the end of the stream.
+    """
+    try:
+      while not self.stopped.is_set():
+        try:
+          item = self.read_queue.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+          continue
+        if item is END_OF_STREAM:
+          return
+        batch_number, first_read_number, batch = item
+        results : List[Tuple[str, int, List[Optional[str]], Dict[str, int], Optional[str], bool]] = []
+        num_bases = 0
+        num_lookups = 0
+        num_skipped = 0
+        num_hits = 0
+        num_depleted = 0
+        for read_number, pseudoread in enumerate(batch, start=first_read_number):
+          num_bases += len(pseudoread)
+          if self.host_filter is not None and self.host_filter.is_host(pseudoread):
+            kmer_lcas = [host_depletion.HOST_KMER] * get_kmer_hit_counts.count_kmer_windows(pseudoread, self.k)
+            results.append((f"Read{read_number}", len(pseudoread), kmer_lcas, {}, None, True))
+            num_depleted += 1
+            continue
+          kmer_lcas = get_kmer_hit_counts.get_kmer_lcas_from_psuedoread(pseudoread, self.kmer_to_lca, self.k)
+          hit_counts = get_kmer_hit_counts.count_kmer_hits(kmer_lcas)
+          call = classification_output.classify(hit_counts)
+          results.append((f"Read{read_number}", len(pseudoread), kmer_lcas, hit_counts, call, False))
+          # counted in local variables and added to the counters once per batch
+          read_skipped = kmer_lcas.count(get_kmer_hit_counts.AMBIGUOUS_KMER)
+          num_skipped += read_skipped
+          num_lookups += len(kmer_lcas) - read_skipped
+          num_hits += sum(hit_counts.values())
+        self.count({
+          "bases_read": num_bases,
+          "lookups": num_lookups,
+          "ambiguous_kmers_skipped": num_skipped,
+          "hits": num_hits,
+          "reads_depleted": num_depleted,
+          "batches": 1,
+        })
+        if not self.put(self.result_queue, (batch_number, results), "worker_waits"):
+          return
+    finally:
+      self.put(self.result_queue, END_OF_STREAM, "worker_waits")
+
+  def run(
+      self,
+      query_filename : str,
+      summary : classification_output.ClassificationSummary,
+      writer : Optional[classification_output.ClassificationWriter] = None,
+      localizer : Optional[contig_localization.ContigLocalizer] = None) -> Dict[str, int]:
+    """
+    Classify every pseudoread of query_filename, adding them to summary in read order
+    and streaming them to writer and localizer (if any) as they are classified.
+    The localizer should have been given this pipeline's contigs.
+
+    @return: the counters of the pipeline (bases read, lookups, hits, batches and waits)
+    """
+    # a compressed query's size doesn't tell how many bases it has, so it gets no ETA
+    total_bases = None if query_filename.endswith(".gz") else os.path.getsize(query_filename)
+    with progress.task("query", unit="bases", total=total_bases) as query_progress:
+      threads = [threading.Thread(target=self.run_stage, args=(self.read, query_filename), name="query-reader", daemon=True)]
+      threads += [
+        threading.Thread(target=self.run_stage, args=(self.classify,), name=f"query-worker-{i}", daemon=True)
+        for i in range(self.num_workers)
+      ]
+      for thread in threads:
+        thread.start()
+
+      try:
+        # The writer stage: the batches can finish out of order with more than one worker,
+        # so they wait in pending until all the ones before them are written
+        pending : Dict[int, list] = {}
+        next_batch_number = 0
+        num_finished_workers = 0
+        while num_finished_workers < self.num_workers:
+          item = self.get(self.result_queue)
+          if item is END_OF_STREAM:
+            num_finished_workers += 1
+            continue
+          batch_number, results = item
+          pending[batch_number] = results
+          while next_batch_number in pending:
+            results = pending.pop(next_batch_number)
+            num_kmers = 0
+            for read_id, read_length, kmer_lcas, hit_counts, call, depleted in results:
+              if depleted:
+                summary.add_depleted()
+              else:
+                summary.add(hit_counts, call)
+              if writer is not None:
+                writer.write(read_id, read_length, kmer_lcas, hit_counts, call)
+              if localizer is not None:
+                localizer.add(kmer_lcas, call)
+              num_kmers += len(kmer_lcas)
+            # every pseudoread starts READ_LENGTH - READ_OVERLAP bases after the one before
+            query_progress.advance(len(results) * (pseudoreads.READ_LENGTH - pseudoreads.READ_OVERLAP), reads=len(results), kmers=num_kmers)
+            next_batch_number += 1
+        if self.errors:
+          raise self.errors[0]
+      finally:
+        self.stopped.set()
+        for thread in threads:
+          thread.join()
+    summary.num_ambiguous_kmers += self.counters.get("ambiguous_kmers_skipped", 0)
+    return dict(self.counters)
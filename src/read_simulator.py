@@ -0,0 +1,260 @@
+import io
+import os
+import sys
+import gzip
+import math
+import random
+import argparse
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
+
+# helper files
+from synthetic_data import read_sequence
+
+"""
+read_simulator.py
+
+Simulates sequencing reads from FASTA assemblies and writes them as FASTQ files,
+e.g. to feed the same reads to Kraken that main.py classifies, or to generate large
+benchmark and validation datasets.
+
+Reads are placed along the assembly in one of two ways:
+
+  - tiled (the default): a read of --read-length bases every --read-length - --overlap bases,
+    which with the default 100/50 gives exactly the pseudoreads of pseudoreads.py
+  - sampled: with --coverage, enough reads to cover the assembly that many times over
+    are started at uniformly random positions
+
+Reads are always taken from the forward strand, since the k-mer database isn't canonical
+(a reverse complemented read wouldn't match anything).
+
+Optionally, --error-rate of the bases are substituted with a different base, and each read
+gets its quality string from a --quality-profile (see QUALITY_PROFILES). Everything is driven
+by --seed, so the same arguments always produce byte-identical files, and with the defaults
+the files are the same as the ones pseudoreads-to-fastq-generator.py used to write.
+
+Each input is simulated in its own worker process, and every worker writes its FASTQ
+(gzip compressed with --gzip) in large batches through a large buffer.
+
+How to run
+----------
+
+$ python3 src/read_simulator.py covid-assemblies/covid-assembly-*.txt --output-dir kraken-fastq
+
+writes kraken-fastq/kraken-fastq-covid-assembly-1.fastq, ..., kraken-fastq/kraken-fastq-covid-assembly-9.fastq
+
+$ python3 src/read_simulator.py bench-data/query.fasta --read-length 150 --coverage 30 \
+    --error-rate 0.002 --quality-profile illumina --gzip
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Bytes buffered before the FASTQ output is written to disk
+OUTPUT_BUFFER_SIZE = 1 << 22
+
+# Number of FASTQ records formatted before they are handed to the (buffered) file in one write
+RECORDS_PER_WRITE = 4096
+
+# Number of distinct quality strings generated per read for the random profiles,
+# which each read then picks one of (much cheaper than drawing every base's quality)
+QUALITY_STRINGS_PER_PROFILE = 1024
+
+# Phred+33 encoding of quality scores in FASTQ
+PHRED_OFFSET = 33
+
+def constant_qualities(read_length : int, rng : random.Random) -> List[int]:
+  # Q40 ('I') everywhere, which is what pseudoreads-to-fastq-generator.py wrote
+  return [40] * read_length
+
+def illumina_qualities(read_length : int, rng : random.Random) -> List[int]:
+  # High quality at the start of the read, decaying towards its end,
+  # with some noise per base (roughly what short read sequencers produce)
+  qualities = []
+  for position in range(read_length):
+    mean = 38 - 12 * (position / max(1, read_length - 1)) ** 2
+    qualities.append(min(41, max(2, int(rng.gauss(mean, 3)))))
+  return qualities
+
+def uniform_qualities(read_length : int, rng : random.Random) -> List[int]:
+  # Independent qualities between Q20 and Q40
+  return [rng.randint(20, 40) for _ in range(read_length)]
+
+# Quality profile name -> function giving the phred qualities of one read
+QUALITY_PROFILES = {
+  "constant": constant_qualities,
+  "illumina": illumina_qualities,
+  "uniform": uniform_qualities,
+}
+
+def make_quality_strings(profile : str, read_length : int, rng : random.Random) -> List[bytes]:
+  """
+  The quality strings that reads of read_length bases are given under the profile.
+  """
+  num_strings = 1 if profile == "constant" else QUALITY_STRINGS_PER_PROFILE
+  return [
+    bytes(quality + PHRED_OFFSET for quality in QUALITY_PROFILES[profile](read_length, rng))
+    for _ in range(num_strings)
+  ]
+
+def iter_read_starts(sequence_length : int, read_length : int, overlap : int, coverage : Optional[float], rng : random.Random):
+  """
+  Yield the start position of every read, tiled every read_length - overlap bases,
+  or sampled uniformly at random if a coverage is given.
+  """
+  if sequence_length < read_length:
+    return
+  if coverage is None:
+    yield from range(0, sequence_length - read_length + 1, read_length - overlap)
+    return
+  num_reads = int(math.ceil(sequence_length * coverage / read_length))
+  for _ in range(num_reads):
+    yield rng.randrange(0, sequence_length - read_length + 1)
+
+def distance_to_next_error(error_rate : float, rng : random.Random) -> int:
+  # Geometric number of bases until (and including) the next error
+  return 1 + int(math.log(1.0 - rng.random()) / math.log(1.0 - error_rate))
+
+def substitute_errors(read : bytearray, error_rate : float, next_error : int, rng : random.Random) -> Tuple[int, int]:
+  """
+  Substitute the bases of the read that errors fall on, in place.
+
+  The distance between errors is drawn from a geometric distribution, so only the
+  erroneous bases cost a random draw rather than every base.
+
+  @param next_error: the position (in the read) of the next error, carried over from the previous read
+  @return: the position of the next error relative to the start of the next read,
+    and the number of bases substituted
+  """
+  num_errors = 0
+  while next_error < len(read):
+    base = read[next_error]
+    if base in b"ACGT":
+      # always substitute a different base
+      read[next_error] = b"ACGT"[(b"ACGT".index(base) + rng.randint(1, 3)) % 4]
+      num_errors += 1
+    next_error += distance_to_next_error(error_rate, rng)
+  return next_error - len(read), num_errors
+
+def open_fastq(output_filename : str):
+  """
+  Open output_filename for writing through a large buffer, gzip compressed if it ends with .gz.
+  """
+  if output_filename.endswith(".gz"):
+    # level 1 keeps compression from being the bottleneck
+    raw = gzip.open(output_filename, 'wb', compresslevel=1)
+  else:
+    raw = open(output_filename, 'wb', buffering=0)
+  return io.BufferedWriter(raw, buffer_size=OUTPUT_BUFFER_SIZE)
+
+def simulate_reads(
+    input_filename : str,
+    output_filename : str,
+    read_length : int = 100,
+    overlap : int = 50,
+    coverage : Optional[float] = None,
+    error_rate : float = 0.0,
+    quality_profile : str = "constant",
+    seed : int = 47) -> Dict[str, int]:
+  """
+  Simulate reads from the FASTA assembly input_filename into the FASTQ file output_filename,
+  with read ids Read1, Read2, ... (the same ids as main.py's --output).
+
+  @return: the number of reads and bases written, and the number of errors substituted
+  """
+  # every input gets its own random stream, so the output doesn't depend on the other inputs
+  rng = random.Random(f"{seed}-{os.path.basename(input_filename)}")
+  sequence = read_sequence(input_filename)
+  quality_strings = make_quality_strings(quality_profile, read_length, rng)
+  separator = b"\n+\n"
+
+  num_reads = 0
+  num_errors = 0
+  next_error = distance_to_next_error(error_rate, rng) - 1 if error_rate > 0 else None
+  records : List[bytes] = []
+  with open_fastq(output_filename) as fp:
+    for start in iter_read_starts(len(sequence), read_length, overlap, coverage, rng):
+      read = sequence[start:start + read_length]
+      if next_error is not None:
+        read = bytearray(read)
+        next_error, num_read_errors = substitute_errors(read, error_rate, next_error, rng)
+        num_errors += num_read_errors
+      num_reads += 1
+      quality = quality_strings[0] if len(quality_strings) == 1 else rng.choice(quality_strings)
+      records.append(b"@Read%d\n%s%s%s\n" % (num_reads, read, separator, quality))
+      if len(records) >= RECORDS_PER_WRITE:
+        fp.write(b"".join(records))
+        records = []
+    fp.write(b"".join(records))
+
+  return {"reads": num_reads, "bases": num_reads * read_length, "errors": num_errors}
+
+def output_filename_for(input_filename : str, output_directory : str, prefix : str, compress : bool) -> str:
+  """
+  The FASTQ filename that the reads of input_filename are written to,
+  e.g. covid-assemblies/covid-assembly-1.txt -> <output_directory>/kraken-fastq-covid-assembly-1.fastq
+  """
+  name = os.path.splitext(os.path.basename(input_filename))[0]
+  return os.path.join(output_directory, f"{prefix}{name}.fastq{'.gz' if compress else ''}")
+
+def simulate_reads_task(task : Tuple[str, str, dict]) -> Tuple[str, str, Dict[str, int]]:
+  # Pool.imap only passes a single argument
+  input_filename, output_filename, options = task
+  return input_filename, output_filename, simulate_reads(input_filename, output_filename, **options)
+
+def parse_args():
+  parse = argparse.ArgumentParser(
+    description="Simulate FASTQ reads from FASTA assemblies (e.g. to classify them with Kraken)"
+  )
+  parse.add_argument("inputs", nargs="+", help="FASTA assemblies to simulate reads from")
+  parse.add_argument("--output-dir", default=".", help="Directory to write the FASTQ files to (default: the current directory)")
+  parse.add_argument("--prefix", default="kraken-fastq-", help="Prefix of the FASTQ filenames, which are <prefix><input name>.fastq (default: kraken-fastq-)")
+  parse.add_argument("--gzip", action="store_true", help="Write gzip compressed FASTQ (.fastq.gz)")
+  parse.add_argument("--read-length", default=100, type=int, help="Length of each read (default: 100)")
+  parse.add_argument("--overlap", default=50, type=int, help="Overlap between consecutive tiled reads (default: 50)")
+  parse.add_argument("--coverage", default=None, type=float, help="Sample reads at random positions up to this coverage instead of tiling them (default: tile)")
+  parse.add_argument("--error-rate", default=0.0, type=float, help="Fraction of bases substituted with a different base (default: 0)")
+  parse.add_argument("--quality-profile", default="constant", choices=sorted(QUALITY_PROFILES), help="Quality strings of the reads (default: constant, i.e. all 'I')")
+  parse.add_argument("--seed", default=47, type=int, help="Random seed (default: 47)")
+  parse.add_argument("--processes", default=os.cpu_count() or 1, type=int, help="Number of inputs simulated in parallel (default: the number of CPUs)")
+  args = parse.parse_args()
+  if args.read_length < 1 or not 0 <= args.overlap < args.read_length:
+    parse.error("--overlap must be at least 0 and less than --read-length")
+  if not 0 <= args.error_rate < 1:
+    parse.error("--error-rate must be at least 0 and less than 1")
+  if args.coverage is not None and args.coverage <= 0:
+    parse.error("--coverage must be positive")
+  return args
+
+def main():
+  args = parse_args()
+  os.makedirs(args.output_dir, exist_ok=True)
+  options = {
+    "read_length": args.read_length,
+    "overlap": args.overlap,
+    "coverage": args.coverage,
+    "error_rate": args.error_rate,
+    "quality_profile": args.quality_profile,
+    "seed": args.seed,
+  }
+  tasks = [
+    (input_filename, output_filename_for(input_filename, args.output_dir, args.prefix, args.gzip), options)
+    for input_filename in args.inputs
+  ]
+  with multiprocessing.Pool(max(1, min(args.processes, len(tasks)))) as pool:
+    for input_filename, output_filename, counts in pool.imap_unordered(simulate_reads_task, tasks):
+      print(
+        f"Wrote {counts['reads']} reads ({counts['bases']} bases, {counts['errors']} errors) "
+        f"from {input_filename} to {output_filename}",
+        file=sys.stderr
+      )
+
+if __name__ == "__main__":
+  main()
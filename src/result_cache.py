@@ -0,0 +1,222 @@
+import os
+import json
+import gzip
+import shutil
+import hashlib
+from typing import Dict, List, Optional
+
+# helper files
+from database_manifest import file_checksum, parent_map_checksum
+
+"""
+result_cache.py
+
+A content-addressed cache of classification results, so that classifying the same query
+against an unchanged reference database again (a rerun, or the same sample in another
+pipeline) returns immediately instead of rebuilding the database and rescanning the query.
+
+Cache key
+---------
+
+A result is stored under the SHA-256 of
+
+  - the SHA-256 of the query file's contents, hashed as a stream in blocks
+  - the database fingerprint (see database_fingerprint): k, the name, size and SHA-256 of
+    every file of the reference database directory, the SHA-256 of the custom taxonomy ids
+    file and of the taxonomy parent map
+  - any other options that change the results
+  - CACHE_FORMAT_VERSION, to bump whenever the way results are computed changes
+
+so a changed query, database or option can never be served a stale result. Checksums of the
+reference files are remembered in the cache directory by path, size and modification time,
+so an unchanged database isn't rehashed on every run.
+
+Cache layout
+------------
+
+  <cache directory>/<key>/summary.json           the per-sample summary (see main.py)
+  <cache directory>/<key>/classifications.tsv.gz the per-read output (see classification_output.py)
+  <cache directory>/<key>/localization.bed       the contaminant intervals, if asked for (see contig_localization.py)
+  <cache directory>/checksums.json               the remembered reference file checksums
+
+Entries are written to a temporary directory and renamed into place, so a reader never sees a
+half written entry. Every lookup that hits an entry touches its summary, and whenever the cache
+grows past its maximum size the least recently used entries are deleted.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Bump this whenever a change to the program changes the results it computes
+CACHE_FORMAT_VERSION = 1
+
+# Bytes copied at a time while restoring the per-read output
+COPY_BLOCK_SIZE = 1 << 20
+
+SUMMARY_FILENAME = "summary.json"
+PER_READ_FILENAME = "classifications.tsv.gz"
+LOCALIZATION_FILENAME = "localization.bed"
+CHECKSUMS_FILENAME = "checksums.json"
+
+def database_fingerprint(
+    file_directory : str,
+    custom_taxonomy_ids_filename : str,
+    k : int,
+    taxonomy_id_to_parent_id : Dict[str, str],
+    known_checksums : Optional[Dict[str, Dict[str, object]]] = None) -> Dict[str, object]:
+  """
+  Everything about the reference database that the results depend on.
+
+  @param known_checksums: previously computed checksums by absolute path, each with the size and
+    modification time it was computed for, which are reused when those haven't changed (and updated otherwise)
+  """
+  if known_checksums is None:
+    known_checksums = {}
+  files = []
+  for f in sorted(os.listdir(file_directory)):
+    file_path = os.path.abspath(os.path.join(file_directory, f))
+    status = os.stat(file_path)
+    known = known_checksums.get(file_path)
+    if known is None or known["size"] != status.st_size or known["mtime_ns"] != status.st_mtime_ns:
+      known = {"size": status.st_size, "mtime_ns": status.st_mtime_ns, "sha256": file_checksum(file_path)}
+      known_checksums[file_path] = known
+    files.append({"name": f, "size": status.st_size, "sha256": known["sha256"]})
+
+  return {
+    "k": k,
+    "files": files,
+    "taxonomy_ids_sha256": file_checksum(custom_taxonomy_ids_filename),
+    "parent_map_sha256": parent_map_checksum(taxonomy_id_to_parent_id),
+  }
+
+class ResultCache:
+  """
+  Classification results on disk, by cache key, with a maximum total size.
+  """
+  def __init__(self, cache_directory : str, max_size : int):
+    self.cache_directory = cache_directory
+    self.max_size = max_size
+    os.makedirs(cache_directory, exist_ok=True)
+
+  def load_checksums(self) -> Dict[str, Dict[str, object]]:
+    try:
+      with open(os.path.join(self.cache_directory, CHECKSUMS_FILENAME), 'r') as fp:
+        return json.load(fp)
+    except (OSError, ValueError):
+      return {}
+
+  def save_checksums(self, known_checksums : Dict[str, Dict[str, object]]) -> None:
+    filename = os.path.join(self.cache_directory, CHECKSUMS_FILENAME)
+    with open(f"{filename}.tmp", 'w') as fp:
+      json.dump(known_checksums, fp)
+    os.replace(f"{filename}.tmp", filename)
+
+  def key(self, query_filename : str, fingerprint : Dict[str, object], options : Optional[Dict[str, object]] = None) -> str:
+    """
+    The cache key of classifying query_filename against the fingerprinted database with options.
+    """
+    return hashlib.sha256(json.dumps({
+      "version": CACHE_FORMAT_VERSION,
+      "query_sha256": file_checksum(query_filename),
+      "database": fingerprint,
+      "options": options or {},
+    }, sort_keys=True).encode()).hexdigest()
+
+  def entry_directory(self, key : str) -> str:
+    return os.path.join(self.cache_directory, key)
+
+  def get(self, key : str) -> Optional[Dict[str, object]]:
+    """
+    The cached summary for key, or None on a miss. A hit counts as a use for the LRU eviction.
+    """
+    summary_filename = os.path.join(self.entry_directory(key), SUMMARY_FILENAME)
+    try:
+      with open(summary_filename, 'r') as fp:
+        summary = json.load(fp)
+    except (OSError, ValueError):
+      return None
+    os.utime(summary_filename)
+    return summary
+
+  def restore_per_read_output(self, key : str, output_filename : str) -> None:
+    """
+    Write the cached per-read output of key to output_filename (gzip compressed if it ends in .gz).
+    """
+    cached_filename = os.path.join(self.entry_directory(key), PER_READ_FILENAME)
+    if output_filename.endswith(".gz"):
+      shutil.copyfile(cached_filename, output_filename)
+    else:
+      with gzip.open(cached_filename, 'rb') as source, open(output_filename, 'wb') as destination:
+        shutil.copyfileobj(source, destination, COPY_BLOCK_SIZE)
+
+  def restore_localization(self, key : str, bed_filename : str) -> None:
+    """
+    Write the cached contaminant intervals of key to bed_filename.
+    """
+    shutil.copyfile(os.path.join(self.entry_directory(key), LOCALIZATION_FILENAME), bed_filename)
+
+  def new_entry(self, key : str) -> str:
+    """
+    A fresh temporary directory to write the entry for key into, before put() publishes it.
+    Its per-read output goes to <directory>/classifications.tsv.gz.
+    """
+    temporary_directory = f"{self.entry_directory(key)}.tmp-{os.getpid()}"
+    shutil.rmtree(temporary_directory, ignore_errors=True)
+    os.makedirs(temporary_directory)
+    return temporary_directory
+
+  def per_read_filename(self, entry_directory : str) -> str:
+    return os.path.join(entry_directory, PER_READ_FILENAME)
+
+  def localization_filename(self, entry_directory : str) -> str:
+    return os.path.join(entry_directory, LOCALIZATION_FILENAME)
+
+  def put(self, key : str, entry_directory : str, summary : Dict[str, object]) -> None:
+    """
+    Write the summary into the entry written to entry_directory, publish it under key
+    and evict the least recently used entries if the cache has grown too large.
+    """
+    with open(os.path.join(entry_directory, SUMMARY_FILENAME), 'w') as fp:
+      json.dump(summary, fp)
+    try:
+      os.rename(entry_directory, self.entry_directory(key))
+    except OSError:
+      # another run published the same entry first, and it's identical
+      shutil.rmtree(entry_directory, ignore_errors=True)
+    self.evict(keep=key)
+
+  def evict(self, keep : Optional[str] = None) -> List[str]:
+    """
+    Delete the least recently used entries until the cache fits in max_size,
+    except for the entry of keep (the one just written).
+
+    @return: the keys of the evicted entries
+    """
+    entries = []
+    total_size = 0
+    for key in os.listdir(self.cache_directory):
+      directory = self.entry_directory(key)
+      summary_filename = os.path.join(directory, SUMMARY_FILENAME)
+      if not os.path.isfile(summary_filename):
+        continue
+      size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+      entries.append((os.stat(summary_filename).st_mtime_ns, key, size))
+      total_size += size
+
+    evicted = []
+    for _, key, size in sorted(entries):
+      if total_size <= self.max_size:
+        break
+      if key == keep:
+        continue
+      shutil.rmtree(self.entry_directory(key), ignore_errors=True)
+      total_size -= size
+      evicted.append(key)
+    return evicted
@@ -0,0 +1,391 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import tempfile
+from array import array
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+# helper files
+import kmer_database
+import database_manifest
+
+"""
+succinct_index.py
+
+A succinct, read-only copy of a k-mer index (see kmer_database.py) for hosts with little memory.
+
+The sorted 2-bit encoded k-mers of an index are stored as an Elias-Fano coded sequence:
+with n k-mers out of the 4^k possible ones, every k-mer is split into its low L = floor(log2(4^k / n))
+bits, stored as they are in a bit-packed array, and its remaining high bits, stored in unary as the
+gaps between consecutive k-mers in a bitvector of about 2n bits. That takes about L + 2 bits per k-mer,
+compared to the 64 bits of the index file and the hundreds of bytes per k-mer of the kmer_to_lca
+dictionary.
+
+Lookups use a sampled skip directory, the value of every SKIP_INTERVAL-th k-mer: a binary search
+over it finds the block of SKIP_INTERVAL k-mers that the k-mer would be in, and the block's part of
+the high bitvector (where the sampled k-mer's bit position follows from its value) is then searched
+with popcounts for the k-mers with the same high bits, whose low bits are compared last.
+
+The LCA of every k-mer is stored as its index in the taxonomy id list, bit-packed in as few bits as
+there are taxa (5 bits for the current 25 taxa, instead of 32).
+
+Succinct index file layout (all integers little endian, bits packed least significant first):
+
+  header      magic, version, k, number of k-mers, number of low bits, bits per taxon index,
+              skip interval, length of the high bitvector in bits, the offsets of the sections
+              below and the fingerprint of the database (see database_manifest.py)
+  skips       the sampled k-mers, as uint64
+  high        the high bitvector
+  low         the low bits of every k-mer
+  taxa        the taxon index of every k-mer
+  metadata    JSON, including the taxonomy id list, the bits per k-mer of each section,
+              the CRC-32 of every block of the other sections and the database manifest
+
+How to run
+----------
+
+$ python3 src/main.py --input-query covid-assemblies/covid-assembly-1.txt --max-memory 500M --succinct
+
+Otherwise, this script is designed to be part of the larger program in main.py.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+SUCCINCT_MAGIC = b"KMERSKI\0"
+SUCCINCT_VERSION = 1
+# magic, version, k, number of kmers, low bits, taxon bits, skip interval, high bits,
+# skips offset, high offset, low offset, taxa offset, metadata offset, metadata length, fingerprint
+SUCCINCT_HEADER = struct.Struct("<8sIIQIIIQQQQQQQ32s")
+SUCCINCT_SECTIONS_OFFSET = -(-SUCCINCT_HEADER.size // kmer_database.INDEX_ALIGNMENT) * kmer_database.INDEX_ALIGNMENT
+
+# Every this many kmers, the kmer is sampled into the skip directory
+SKIP_INTERVAL = 64
+
+# Number of kmers of the index encoded at a time while building
+BUILD_BATCH_SIZE = 1 << 16
+
+class BitWriter:
+  """
+  Writes a stream of bit fields to a file, least significant bit first.
+  """
+  # pending bits are written out once there are this many
+  FLUSH_BITS = 1 << 12
+
+  def __init__(self, fp):
+    self.fp = fp
+    self.pending = 0
+    self.num_pending = 0
+    # total number of bits written
+    self.length = 0
+
+  def write(self, value : int, width : int) -> None:
+    self.pending |= value << self.num_pending
+    self.num_pending += width
+    self.length += width
+    if self.num_pending >= self.FLUSH_BITS:
+      num_bytes = self.num_pending >> 3
+      self.fp.write((self.pending & ((1 << (8 * num_bytes)) - 1)).to_bytes(num_bytes, "little"))
+      self.pending >>= 8 * num_bytes
+      self.num_pending -= 8 * num_bytes
+
+  def finish(self) -> int:
+    """
+    Write out the last, partial byte.
+
+    @return: the number of bytes written
+    """
+    num_bytes = (self.num_pending + 7) >> 3
+    self.fp.write(self.pending.to_bytes(num_bytes, "little"))
+    self.pending = 0
+    self.num_pending = 0
+    return (self.length + 7) >> 3
+
+def read_bits(buffer, offset : int, width : int) -> int:
+  """
+  The width bits starting at bit offset of buffer (least significant bit first).
+  """
+  start = offset >> 3
+  return (int.from_bytes(buffer[start:(offset + width + 7) >> 3], "little") >> (offset & 7)) & ((1 << width) - 1)
+
+def choose_low_width(k : int, num_kmers : int) -> int:
+  # floor(log2(4^k / n)), the number of low bits that minimizes the Elias-Fano size
+  if num_kmers == 0:
+    return 0
+  return max(0, (4 ** k // num_kmers).bit_length() - 1)
+
+def section_lengths(num_kmers : int, low_width : int, taxon_width : int, skip_interval : int, high_bits : int) -> Dict[str, int]:
+  """
+  The length in bytes of every section of a succinct index (without the alignment padding).
+  """
+  return {
+    "skips": 8 * (-(-num_kmers // skip_interval)),
+    "high": (high_bits + 7) >> 3,
+    "low": (num_kmers * low_width + 7) >> 3,
+    "taxa": (num_kmers * taxon_width + 7) >> 3,
+  }
+
+def build_succinct_index(index_filename : str, succinct_filename : str) -> Dict[str, float]:
+  """
+  Write a succinct copy of the index file index_filename to succinct_filename,
+  streaming through the (memory mapped) index, so the build takes little memory too.
+
+  @return: the size of the succinct index and its bits per kmer, in total and per section
+  """
+  index = kmer_database.load_kmer_index(index_filename, use_mmap=True)
+  num_kmers = len(index)
+  low_width = choose_low_width(index.k, num_kmers)
+  taxon_width = max(1, (len(index.taxonomy_ids) - 1).bit_length())
+  directory = os.path.dirname(os.path.abspath(succinct_filename))
+
+  skips = array('Q')
+  with tempfile.TemporaryFile(dir=directory) as high_fp, \
+       tempfile.TemporaryFile(dir=directory) as low_fp, \
+       tempfile.TemporaryFile(dir=directory) as taxa_fp:
+    high = BitWriter(high_fp)
+    low = BitWriter(low_fp)
+    taxa = BitWriter(taxa_fp)
+    low_mask = (1 << low_width) - 1
+    previous_high = 0
+    for batch_start in range(0, num_kmers, BUILD_BATCH_SIZE):
+      batch_end = min(num_kmers, batch_start + BUILD_BATCH_SIZE)
+      kmers = index.kmers[batch_start:batch_end].tolist()
+      taxon_indices = index.taxon_indices[batch_start:batch_end].tolist()
+      for position, (kmer, taxon_index) in enumerate(zip(kmers, taxon_indices), start=batch_start):
+        if position % SKIP_INTERVAL == 0:
+          skips.append(kmer)
+        # the gap in high bits as zeros, then a one
+        kmer_high = kmer >> low_width
+        high.write(1 << (kmer_high - previous_high), kmer_high - previous_high + 1)
+        previous_high = kmer_high
+        if low_width:
+          low.write(kmer & low_mask, low_width)
+        taxa.write(taxon_index, taxon_width)
+    high_bits = high.length
+    high.finish()
+    low.finish()
+    taxa.finish()
+    if sys.byteorder != "little":
+      skips.byteswap()
+
+    # Assemble the sections into the succinct index file, checksumming them on the way
+    checksums = {}
+    offsets = {}
+    with open(succinct_filename + ".tmp", 'wb') as fp:
+      fp.write(b"\0" * SUCCINCT_SECTIONS_OFFSET)
+      for name, section_fp in (("skips", None), ("high", high_fp), ("low", low_fp), ("taxa", taxa_fp)):
+        fp.write(b"\0" * (-fp.tell() % kmer_database.INDEX_ALIGNMENT))
+        offsets[name] = fp.tell()
+        block_checksums = database_manifest.BlockChecksums()
+        if section_fp is None:
+          skips.tofile(fp)
+          block_checksums.update(skips)
+        else:
+          section_fp.seek(0)
+          for block in iter(lambda: section_fp.read(kmer_database.STREAM_BLOCK_SIZE), b""):
+            fp.write(block)
+            block_checksums.update(block)
+        checksums[name] = block_checksums.finish()
+      fp.write(b"\0" * (-fp.tell() % kmer_database.INDEX_ALIGNMENT))
+      metadata_offset = fp.tell()
+
+      section_sizes = section_lengths(num_kmers, low_width, taxon_width, SKIP_INTERVAL, high_bits)
+      sizes = {
+        "bytes": metadata_offset,
+        "bits_per_kmer": 8 * sum(section_sizes.values()) / max(1, num_kmers),
+        "bits_per_kmer_by_section": {
+          name: 8 * size / max(1, num_kmers) for name, size in section_sizes.items()
+        },
+        "taxon_width": taxon_width,
+      }
+      metadata = {
+        "k": index.k,
+        "encoding": kmer_database.KMER_ENCODING,
+        "taxonomy_ids": index.taxonomy_ids,
+        "kmers_per_taxon": index.metadata.get("kmers_per_taxon"),
+        "manifest": index.metadata.get("manifest"),
+        "sizes": sizes,
+        "block_checksums": dict(checksums, block_size=database_manifest.CHECKSUM_BLOCK_SIZE),
+      }
+      encoded_metadata = json.dumps(metadata, sort_keys=True).encode()
+      fp.write(encoded_metadata)
+      fp.seek(0)
+      fp.write(SUCCINCT_HEADER.pack(
+        SUCCINCT_MAGIC, SUCCINCT_VERSION, index.k, num_kmers, low_width, taxon_width, SKIP_INTERVAL, high_bits,
+        offsets["skips"], offsets["high"], offsets["low"], offsets["taxa"], metadata_offset, len(encoded_metadata),
+        bytes.fromhex(index.fingerprint) if index.fingerprint else bytes(32)
+      ))
+  # only a complete succinct index ever appears under the final name
+  os.replace(succinct_filename + ".tmp", succinct_filename)
+  return sizes
+
+def read_succinct_header(fp) -> Tuple:
+  """
+  Read and check the header of an open succinct index file.
+
+  @return: the header fields after the magic and version, with the fingerprint
+    as a hex digest (or None if it has none)
+  """
+  header = fp.read(SUCCINCT_HEADER.size)
+  if len(header) != SUCCINCT_HEADER.size:
+    raise ValueError(f"{fp.name} is too short to be a succinct k-mer index")
+  magic, version, *fields, fingerprint = SUCCINCT_HEADER.unpack(header)
+  if magic != SUCCINCT_MAGIC:
+    raise ValueError(f"{fp.name} is not a succinct k-mer index")
+  if version != SUCCINCT_VERSION:
+    raise ValueError(f"{fp.name} is a version {version} succinct k-mer index, expected version {SUCCINCT_VERSION}")
+  return (*fields, fingerprint.hex() if any(fingerprint) else None)
+
+def read_succinct_fingerprint(succinct_filename : str) -> Optional[str]:
+  """
+  The database fingerprint in the header of a succinct index file (only the header is read).
+  """
+  with open(succinct_filename, 'rb') as fp:
+    return read_succinct_header(fp)[-1]
+
+class SuccinctKmerIndex:
+  """
+  A read-only k-mer to LCA database loaded from a succinct index file (see the top of this file).
+
+  Supports the same lookups as the kmer_to_lca dictionary built by kmer_to_lca_mapping.build_database
+  and as kmer_database.KmerIndex, i.e. `kmer in index`, `index[kmer]`, get and lookup_many.
+  """
+  def __init__(self, succinct_filename : str, use_mmap : bool = False):
+    with open(succinct_filename, 'rb') as fp:
+      (self.k, self.num_kmers, self.low_width, self.taxon_width, self.skip_interval, self.high_bits,
+       skips_offset, high_offset, low_offset, taxa_offset, metadata_offset, metadata_length,
+       self.fingerprint) = read_succinct_header(fp)
+      fp.seek(metadata_offset)
+      self.metadata = json.loads(fp.read(metadata_length))
+      if use_mmap:
+        data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+      else:
+        fp.seek(0)
+        data = memoryview(fp.read(metadata_offset))
+    self.taxonomy_ids : List[str] = self.metadata["taxonomy_ids"]
+    lengths = section_lengths(self.num_kmers, self.low_width, self.taxon_width, self.skip_interval, self.high_bits)
+    # the skip directory is searched with bisect, so it is always an array in memory
+    self.skips = array('Q')
+    self.skips.frombytes(data[skips_offset:skips_offset + lengths["skips"]])
+    if sys.byteorder != "little":
+      self.skips.byteswap()
+    # the other sections are only read a few bytes at a time, with read_bits
+    self.high = data[high_offset:high_offset + lengths["high"]]
+    self.low = data[low_offset:low_offset + lengths["low"]]
+    self.taxa = data[taxa_offset:taxa_offset + lengths["taxa"]]
+
+  def find_code(self, code : int) -> int:
+    """
+    Position of the encoded kmer in the sorted kmers, or -1 if it is not in the index.
+    """
+    block = bisect_right(self.skips, code) - 1
+    if block < 0:
+      return -1
+    first = block * self.skip_interval
+    last = min(self.num_kmers, first + self.skip_interval)
+    # the part of the high bitvector from the block's first kmer up to the next block's first kmer
+    first_high = self.skips[block] >> self.low_width
+    start = first_high + first
+    end = (self.skips[block + 1] >> self.low_width) + last if block + 1 < len(self.skips) else self.high_bits
+    bits = read_bits(self.high, start, end - start)
+
+    # The kmers with the same high bits as code follow the (code_high - first_high)-th zero,
+    # found by a binary search for the shortest prefix of bits with that many zeros
+    zeros = (code >> self.low_width) - first_high
+    low = zeros
+    high = end - start
+    while low < high:
+      middle = (low + high) // 2
+      if middle - (bits & ((1 << middle) - 1)).bit_count() < zeros:
+        low = middle + 1
+      else:
+        high = middle
+    bit = low
+    position = first + bit - zeros
+    code_low = code & ((1 << self.low_width) - 1)
+    while bit < end - start and position < last and (bits >> bit) & 1:
+      kmer_low = read_bits(self.low, position * self.low_width, self.low_width)
+      if kmer_low == code_low:
+        return position
+      if kmer_low > code_low:
+        break
+      bit += 1
+      position += 1
+    return -1
+
+  def find(self, kmer : str) -> int:
+    """
+    Position of kmer in the sorted kmers, or -1 if it is not in the index.
+    """
+    code = kmer_database.encode_kmer(kmer) if len(kmer) == self.k else None
+    if code is None:
+      return -1
+    return self.find_code(code)
+
+  def taxonomy_id(self, position : int) -> str:
+    return self.taxonomy_ids[read_bits(self.taxa, position * self.taxon_width, self.taxon_width)]
+
+  def get(self, kmer : str, default : Optional[str] = None) -> Optional[str]:
+    position = self.find(kmer)
+    return self.taxonomy_id(position) if position >= 0 else default
+
+  def __contains__(self, kmer : str) -> bool:
+    return self.find(kmer) >= 0
+
+  def __getitem__(self, kmer : str) -> str:
+    position = self.find(kmer)
+    if position < 0:
+      raise KeyError(kmer)
+    return self.taxonomy_id(position)
+
+  def __len__(self) -> int:
+    return self.num_kmers
+
+  def lookup_many(self, kmers : List[str]) -> List[Optional[str]]:
+    """
+    The LCA taxonomy id of each of the kmers, or None for those not in the index.
+    """
+    return [self.get(kmer) for kmer in kmers]
+
+def load_succinct_index(succinct_filename : str, use_mmap : bool = False, expected_fingerprint : Optional[str] = None) -> SuccinctKmerIndex:
+  """
+  Load a succinct index file written by build_succinct_index, read into memory (which takes
+  about its size on disk) or, with use_mmap, memory mapped.
+
+  With expected_fingerprint, a succinct index whose header has a different database
+  fingerprint is rejected before anything else is read.
+  """
+  if expected_fingerprint is not None:
+    fingerprint = read_succinct_fingerprint(succinct_filename)
+    if fingerprint != expected_fingerprint:
+      raise ValueError(f"{succinct_filename} belongs to a different database (fingerprint {fingerprint}, expected {expected_fingerprint})")
+  return SuccinctKmerIndex(succinct_filename, use_mmap=use_mmap)
+
+def verify_succinct_index(succinct_filename : str, max_workers : Optional[int] = None) -> List[str]:
+  """
+  Deep verify a succinct index file: recompute the checksum of every block of its sections,
+  in parallel (see database_manifest.py).
+
+  @return: the problems found, or an empty list if there are none
+  """
+  with open(succinct_filename, 'rb') as fp:
+    (_, num_kmers, low_width, taxon_width, skip_interval, high_bits,
+     skips_offset, high_offset, low_offset, taxa_offset, metadata_offset, metadata_length, _) = read_succinct_header(fp)
+    fp.seek(metadata_offset)
+    checksums = json.loads(fp.read(metadata_length))["block_checksums"]
+  lengths = section_lengths(num_kmers, low_width, taxon_width, skip_interval, high_bits)
+  offsets = {"skips": skips_offset, "high": high_offset, "low": low_offset, "taxa": taxa_offset}
+  return database_manifest.verify_blocks([
+    (succinct_filename, name, offsets[name], lengths[name], checksums["block_size"], checksums[name])
+    for name in offsets
+  ], max_workers)
@@ -0,0 +1,320 @@
+import os
+import sys
+import random
+import argparse
+from typing import Dict, List, Tuple
+
+"""
+synthetic_data.py
+
+Generates synthetic, reproducible inputs for benchmarking the contamination classifier:
+
+  - a synthetic taxonomy (root -> phylum-like groups -> genus-like groups -> species leaves),
+    written as a nodes.dmp file and as a custom_taxonomy_ids.txt file in the same format
+    as taxonomy/custom_taxonomy_ids.txt
+  - one reference genome FASTA file per species leaf, where species in the same genus
+    are mutated copies of a shared genus ancestor (so that many k-mers are shared and
+    the LCA merging in kmer_to_lca_mapping.py is actually exercised)
+  - a contaminated query assembly, i.e. a host genome with segments of randomly chosen
+    reference genomes spliced in, in the same FASTA format as covid-assemblies/
+
+Everything is driven by a single seed, so the same arguments always produce
+byte-identical files.
+
+How to run
+----------
+
+$ python3 src/synthetic_data.py --output-dir bench-data --genome-size 10M --num-taxa 100
+
+Otherwise, this script is used by benchmark.py to generate its datasets.
+
+Authors
+-------
+
+Computational Genomics Team 47:
+Dhruv Dubey
+Mitra Harpale
+Christopher Li
+Jaeyoon Wang
+
+"""
+
+# Number of bases per line in the FASTA files we write (same as NCBI)
+FASTA_LINE_WIDTH = 80
+
+# Sequences are generated (and written) in chunks of this many bases
+# so that a 1 Gbp reference set never has to be held in memory at once
+# (a multiple of FASTA_LINE_WIDTH so that every line is full)
+CHUNK_SIZE = 1000000
+
+# Synthetic taxonomy ids start here so they never collide with the real root '1'
+FIRST_SYNTHETIC_TAXONOMY_ID = 1000000
+
+def parse_size(size : str) -> int:
+  """
+  Parse a human readable size such as '1M', '250K', '1.5G' or '1000' into
+  a number (using powers of 1000, since these are numbers of bases).
+  """
+  multipliers = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+  size = size.strip().upper().rstrip('B')
+  if size and size[-1] in multipliers:
+    return int(float(size[:-1]) * multipliers[size[-1]])
+  return int(size)
+
+def build_synthetic_taxonomy(num_taxa : int, rng : random.Random) -> Tuple[List[str], Dict[str, str]]:
+  """
+  Build a three level synthetic taxonomy with num_taxa species leaves.
+
+  Leaves are grouped into genera of 2 to 6 species, and genera are grouped
+  into roughly sqrt(#genera) phyla, all hanging off of the root '1'.
+
+  @return: the list of leaf (species) taxonomy ids and the taxonomy_id_to_parent_id
+    dictionary, in the same shape as the one returned by taxonomy_tree.build_parent_map
+  """
+  taxonomy_id_to_parent_id : Dict[str, str] = {}
+  next_taxonomy_id = FIRST_SYNTHETIC_TAXONOMY_ID
+
+  def new_taxonomy_id() -> str:
+    nonlocal next_taxonomy_id
+    next_taxonomy_id += 1
+    return str(next_taxonomy_id)
+
+  # split the leaves into genera
+  genus_sizes = []
+  remaining = num_taxa
+  while remaining > 0:
+    size = min(remaining, rng.randint(2, 6))
+    genus_sizes.append(size)
+    remaining -= size
+
+  num_phyla = max(1, int(len(genus_sizes) ** 0.5))
+  phyla = [new_taxonomy_id() for _ in range(num_phyla)]
+  for phylum in phyla:
+    taxonomy_id_to_parent_id[phylum] = '1'
+
+  leaves = []
+  for genus_index, genus_size in enumerate(genus_sizes):
+    genus = new_taxonomy_id()
+    taxonomy_id_to_parent_id[genus] = phyla[genus_index % num_phyla]
+    for _ in range(genus_size):
+      species = new_taxonomy_id()
+      taxonomy_id_to_parent_id[species] = genus
+      leaves.append(species)
+
+  return leaves, taxonomy_id_to_parent_id
+
+def write_nodes_dmp(nodes_dmp_filename : str, taxonomy_id_to_parent_id : Dict[str, str]) -> None:
+  """
+  Write the taxonomy as a (minimal) NCBI style nodes.dmp file,
+  i.e. 'taxid\\t|\\tparent taxid\\t|\\trank\\t|' per line.
+  """
+  parents = set(taxonomy_id_to_parent_id.values())
+  with open(nodes_dmp_filename, 'w') as fp:
+    fp.write("1\t|\t1\t|\tno rank\t|\n")
+    for taxonomy_id, parent_id in taxonomy_id_to_parent_id.items():
+      if taxonomy_id not in parents:
+        rank = "species"
+      else:
+        rank = "phylum" if parent_id == '1' else "genus"
+      fp.write(f"{taxonomy_id}\t|\t{parent_id}\t|\t{rank}\t|\n")
+
+def read_nodes_dmp(nodes_dmp_filename : str) -> Dict[str, str]:
+  """
+  Read the first two columns of a nodes.dmp file into a taxonomy_id_to_parent_id dictionary.
+  """
+  taxonomy_id_to_parent_id = {}
+  with open(nodes_dmp_filename, 'r') as fp:
+    for line in fp:
+      tokens = line.split('\t|\t')
+      if tokens[0] != '1':
+        taxonomy_id_to_parent_id[tokens[0]] = tokens[1]
+  return taxonomy_id_to_parent_id
+
+def random_chunk(seed, length : int) -> bytearray:
+  """
+  A reproducible chunk of uniformly random bases, determined only by seed.
+  """
+  return bytearray(random.Random(seed).choices(b"ACGT", k=length))
+
+def mutate(sequence : bytearray, rate : float, rng : random.Random) -> bytearray:
+  """
+  Apply substitutions in place at (approximately) the given per-base rate.
+  """
+  num_mutations = int(len(sequence) * rate)
+  for position in rng.sample(range(len(sequence)), num_mutations):
+    # always substitute a different base
+    sequence[position] = b"ACGT"[(b"ACGT".index(sequence[position]) + rng.randint(1, 3)) % 4]
+  return sequence
+
+def write_fasta_record(fp, sequence : bytes) -> None:
+  """
+  Write the sequence (without a header) wrapped to FASTA_LINE_WIDTH.
+  """
+  fp.write(b"\n".join(
+    sequence[i:i + FASTA_LINE_WIDTH] for i in range(0, len(sequence), FASTA_LINE_WIDTH)
+  ))
+  fp.write(b"\n")
+
+def generate_reference_genomes(
+    output_directory : str,
+    leaves : List[str],
+    taxonomy_id_to_parent_id : Dict[str, str],
+    genome_size : int,
+    seed : int,
+    divergence : float = 0.05) -> List[Tuple[str, str]]:
+  """
+  Write one FASTA file per leaf into output_directory, with a total
+  of approximately genome_size bases across all files.
+
+  Each genus gets a random ancestral genome and each species in the genus
+  is that ancestor with `divergence` of its bases substituted.
+
+  @return: a list of (accession id, taxonomy id) pairs, one per file written
+  """
+  os.makedirs(output_directory, exist_ok=True)
+  per_genome_size = max(1, genome_size // len(leaves))
+  accession_ids_and_taxonomy_ids = []
+
+  for leaf_index, leaf in enumerate(leaves):
+    genus = taxonomy_id_to_parent_id[leaf]
+    accession_id = f"SYN_{leaf_index + 1:06d}.1"
+    mutation_rng = random.Random(f"{seed}-mutate-{leaf}")
+    file_path = os.path.join(output_directory, f"{accession_id}_genomic.fna")
+    with open(file_path, 'wb') as fp:
+      fp.write(f">{accession_id} Synthetic species {leaf}, complete genome\n".encode())
+      for offset in range(0, per_genome_size, CHUNK_SIZE):
+        length = min(CHUNK_SIZE, per_genome_size - offset)
+        # the ancestral chunk only depends on the genus, so siblings share it
+        chunk = random_chunk(f"{seed}-genus-{genus}-{offset}", length)
+        write_fasta_record(fp, mutate(chunk, divergence, mutation_rng))
+    accession_ids_and_taxonomy_ids.append((accession_id, leaf))
+
+  return accession_ids_and_taxonomy_ids
+
+def read_sequence(fasta_file_path : str) -> bytes:
+  """
+  Read all non-header lines of a FASTA file into one bytes object.
+  """
+  with open(fasta_file_path, 'rb') as fp:
+    return b"".join(line.strip() for line in fp if not line.startswith(b">"))
+
+def generate_query_assembly(
+    query_filename : str,
+    reference_directory : str,
+    query_size : int,
+    contamination : float,
+    seed : int,
+    segment_length : int = 2000,
+    error_rate : float = 0.001) -> Dict[str, int]:
+  """
+  Write a contaminated query assembly: a random host genome of query_size bases in which
+  a `contamination` fraction of the bases have been replaced by segments of segment_length
+  bases copied from randomly chosen reference genomes (with error_rate substitutions).
+
+  @return: a dictionary of accession id to number of contaminant bases inserted,
+    which is the ground truth for the query
+  """
+  rng = random.Random(f"{seed}-query")
+  reference_files = sorted(os.listdir(reference_directory))
+  host = random_chunk(f"{seed}-host", query_size)
+  ground_truth : Dict[str, int] = {}
+
+  num_segments = int(query_size * contamination) // segment_length
+  # evenly spaced slots, so contaminant segments never overlap each other
+  slots = sorted(rng.sample(range(max(1, query_size // segment_length)), min(num_segments, query_size // segment_length)))
+  reference_cache : Dict[str, bytes] = {}
+  for slot in slots:
+    reference_file = rng.choice(reference_files)
+    if reference_file not in reference_cache:
+      # keep at most one reference in memory at a time
+      reference_cache = {reference_file: read_sequence(os.path.join(reference_directory, reference_file))}
+    reference = reference_cache[reference_file]
+    length = min(segment_length, len(reference))
+    start = rng.randrange(0, len(reference) - length + 1)
+    segment = mutate(bytearray(reference[start:start + length]), error_rate, rng)
+    host[slot * segment_length:slot * segment_length + length] = segment
+    accession_id = reference_file.split("_genomic")[0]
+    ground_truth[accession_id] = ground_truth.get(accession_id, 0) + length
+
+  with open(query_filename, 'wb') as fp:
+    fp.write(f">synthetic-query seed={seed} contamination={contamination}\n".encode())
+    write_fasta_record(fp, bytes(host))
+
+  return ground_truth
+
+def generate_dataset(
+    output_directory : str,
+    genome_size : int,
+    num_taxa : int,
+    query_size : int,
+    contamination : float,
+    seed : int) -> Dict[str, object]:
+  """
+  Generate a full synthetic dataset (taxonomy, references and query) into output_directory:
+
+    output_directory/references/*.fna
+    output_directory/taxonomy/nodes.dmp
+    output_directory/taxonomy/custom_taxonomy_ids.txt
+    output_directory/query.fasta
+
+  @return: a description of the dataset, including the paths and the
+    taxonomy_id_to_parent_id dictionary to pass to build_database
+  """
+  rng = random.Random(seed)
+  leaves, taxonomy_id_to_parent_id = build_synthetic_taxonomy(num_taxa, rng)
+
+  reference_directory = os.path.join(output_directory, "references")
+  taxonomy_directory = os.path.join(output_directory, "taxonomy")
+  os.makedirs(taxonomy_directory, exist_ok=True)
+
+  accession_ids_and_taxonomy_ids = generate_reference_genomes(
+    reference_directory, leaves, taxonomy_id_to_parent_id, genome_size, seed
+  )
+
+  custom_taxonomy_ids_filename = os.path.join(taxonomy_directory, "custom_taxonomy_ids.txt")
+  with open(custom_taxonomy_ids_filename, 'w') as fp:
+    for accession_id, taxonomy_id in accession_ids_and_taxonomy_ids:
+      fp.write(f"{accession_id}\t{taxonomy_id}\n")
+  write_nodes_dmp(os.path.join(taxonomy_directory, "nodes.dmp"), taxonomy_id_to_parent_id)
+
+  query_filename = os.path.join(output_directory, "query.fasta")
+  ground_truth = generate_query_assembly(
+    query_filename, reference_directory, query_size, contamination, seed
+  )
+
+  return {
+    "reference_directory": reference_directory,
+    "custom_taxonomy_ids_filename": custom_taxonomy_ids_filename,
+    "query_filename": query_filename,
+    "taxonomy_id_to_parent_id": taxonomy_id_to_parent_id,
+    "ground_truth": ground_truth,
+  }
+
+def parse_args():
+  parse = argparse.ArgumentParser(
+    description="Generate a reproducible synthetic reference database, taxonomy and contaminated query"
+  )
+  parse.add_argument("--output-dir", required=True, help="Directory to write the dataset to (required)")
+  parse.add_argument("--genome-size", default="1M", help="Total bases across all reference genomes, e.g. 1M, 100M, 1G (default: 1M)")
+  parse.add_argument("--num-taxa", default=10, type=int, help="Number of reference genomes / species leaves (default: 10)")
+  parse.add_argument("--query-size", default="100K", help="Length of the query assembly in bases (default: 100K)")
+  parse.add_argument("--contamination", default=0.1, type=float, help="Fraction of the query made of reference segments (default: 0.1)")
+  parse.add_argument("--seed", default=47, type=int, help="Random seed (default: 47)")
+  return parse.parse_args()
+
+def main():
+  args = parse_args()
+  dataset = generate_dataset(
+    args.output_dir,
+    parse_size(args.genome_size),
+    args.num_taxa,
+    parse_size(args.query_size),
+    args.contamination,
+    args.seed
+  )
+  print(f"Wrote references to {dataset['reference_directory']}", file=sys.stderr)
+  print(f"Wrote query to {dataset['query_filename']}", file=sys.stderr)
+  print(f"Contaminant bases per accession: {dataset['ground_truth']}", file=sys.stderr)
+
+if __name__ == "__main__":
+  main()
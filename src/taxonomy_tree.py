@@ -259,6 +259,187 @@ def build_parent_map(taxonomy_directory : str, custom_taxonomy_ids_filename : st
   }
   return None, map, None
 
+def build_rank_map() -> Dict[str, str]:
+  """
+  The NCBI rank of every taxon in the parent map of build_parent_map (like the parent map
+  itself, spelled out here rather than read from nodes.dmp), e.g. for pruning the database
+  of k-mers whose LCA is too high up the tree to be informative (see database_pruning.py).
+  """
+  return {
+    '1': 'no rank',
+    '131567': 'no rank',
+    '2': 'superkingdom',
+    '10239': 'superkingdom',
+    # Escherichia coli K-12 MG1655 and O157:H7 Sakai
+    '511145': 'strain',
+    '83333': 'strain',
+    '386585': 'strain',
+    '83334': 'serotype',
+    '562': 'species',
+    '561': 'genus',
+    '543': 'family',
+    '91347': 'order',
+    '1236': 'class',
+    '1224': 'phylum',
+    # Pseudomonas aeruginosa PAO1
+    '208964': 'strain',
+    '287': 'species',
+    '136841': 'species group',
+    '286': 'genus',
+    '135621': 'family',
+    '72274': 'order',
+    # Shigella flexneri 2a str. 301
+    '198214': 'strain',
+    '42897': 'serotype',
+    '623': 'species',
+    '620': 'genus',
+    # Salmonella enterica Typhimurium LT2
+    '99287': 'strain',
+    '90371': 'serotype',
+    '59201': 'subspecies',
+    '28901': 'species',
+    '590': 'genus',
+    # Bacillus subtilis 168
+    '224308': 'strain',
+    '135461': 'subspecies',
+    '1423': 'species',
+    '653685': 'species group',
+    '1386': 'genus',
+    '186817': 'family',
+    '1385': 'order',
+    '91061': 'class',
+    '1239': 'phylum',
+    '1783272': 'clade',
+    # Campylobacter jejuni NCTC 11168
+    '192222': 'strain',
+    '32022': 'subspecies',
+    '197': 'species',
+    '194': 'genus',
+    '72294': 'family',
+    '213849': 'order',
+    '3031852': 'class',
+    '29547': 'phylum',
+    # Streptomyces avermitilis MA-4680
+    '227882': 'strain',
+    '33903': 'species',
+    '1883': 'genus',
+    '2062': 'family',
+    '85011': 'order',
+    '1760': 'class',
+    '201174': 'phylum',
+    # Mycoplasma capricolum ATCC 27343
+    '340047': 'strain',
+    '40479': 'subspecies',
+    '2095': 'species',
+    '656088': 'species group',
+    '2093': 'genus',
+    '2092': 'family',
+    '2085': 'order',
+    '31969': 'class',
+    '544448': 'phylum',
+    # Staphylococcus aureus NCTC 8325
+    '93061': 'strain',
+    '1280': 'species',
+    '1279': 'genus',
+    '90964': 'family',
+    # Acinetobacter pittii PHEA-2
+    '871585': 'strain',
+    '48296': 'species',
+    '909768': 'species group',
+    '469': 'genus',
+    '468': 'family',
+    '2887326': 'order',
+    # Mycobacterium tuberculosis H37Rv
+    '83332': 'strain',
+    '1773': 'species',
+    '77643': 'species group',
+    '1763': 'genus',
+    '1762': 'family',
+    '85007': 'order',
+    # Klebsiella pneumoniae HS11286
+    '1125630': 'strain',
+    '72407': 'subspecies',
+    '573': 'species',
+    '570': 'genus',
+    '2890311': 'clade',
+    # Escherichia phage phiX174
+    '2886930': 'no rank',
+    '10847': 'species',
+    '1910954': 'genus',
+    '1910950': 'subfamily',
+    '10841': 'family',
+    '2732414': 'order',
+    '2732413': 'class',
+    '2732412': 'phylum',
+    '2732091': 'kingdom',
+    '2731342': 'realm',
+    # Human herpesvirus 6B
+    '32604': 'no rank',
+    '3050297': 'species',
+    '40272': 'genus',
+    '10357': 'subfamily',
+    '3044472': 'family',
+    '548681': 'order',
+    '2731363': 'class',
+    '2731361': 'phylum',
+    '2731360': 'kingdom',
+    '2731341': 'realm',
+    # Burkholderia pyrrocinia
+    '60550': 'species',
+    '87882': 'species group',
+    '32008': 'genus',
+    '119060': 'family',
+    '80840': 'order',
+    '28216': 'class',
+    # Human gammaherpesvirus 4
+    '10376': 'no rank',
+    '3050299': 'species',
+    '10375': 'genus',
+    '10374': 'subfamily',
+    # Neisseria subflava
+    '28449': 'species',
+    '482': 'genus',
+    '481': 'family',
+    '206351': 'order',
+    # Bradyrhizobium arachidis
+    '858423': 'species',
+    '374': 'genus',
+    '41294': 'family',
+    '356': 'order',
+    '28211': 'class',
+    # Haemophilus parahaemolyticus
+    '735': 'species',
+    '724': 'genus',
+    '712': 'family',
+    '135625': 'order',
+    # Ralstonia wenshanensis
+    '2842456': 'species',
+    '48736': 'genus',
+    # Rhodococcus coprophilus
+    '38310': 'species',
+    '1827': 'genus',
+    '85025': 'family',
+    # Streptococcus oralis ATCC 35037
+    '655813': 'strain',
+    '1303': 'species',
+    '1301': 'genus',
+    '1300': 'family',
+    '186826': 'order',
+    # Severe acute respiratory syndrome coronavirus 2
+    '2697049': 'no rank',
+    '694009': 'species',
+    '2509511': 'subgenus',
+    '694002': 'genus',
+    '2501931': 'subfamily',
+    '11118': 'family',
+    '2499399': 'suborder',
+    '76804': 'order',
+    '2732506': 'class',
+    '2732408': 'phylum',
+    '2732396': 'kingdom',
+    '2559587': 'realm',
+  }
+
 def build_parent_map_helper(taxonomy_directory : str, custom_taxonomy_ids_filename : str) -> \
   Tuple[Dict[str, TaxaTree], Dict[str, str], TaxaTree]:
   """